@@ -1243,6 +1243,24 @@ class ContadorRelatoriosPersistente:
         except:
             return {'erro': 'Não foi possível obter status'}
 
+# ========== IMAGEM EM MEMÓRIA PARA O PDF ==========
+def imagem_jpeg_em_memoria(foto_info, img, img_resized):
+    """
+    Retorna um buffer JPEG pronto para o fpdf, sem arquivo temporário.
+    Se a foto original já é JPEG e não foi redimensionada, reaproveita os bytes
+    originais: o fpdf embute o fluxo JPEG diretamente, sem nova decodificação.
+    """
+    if img_resized is img and img.format == 'JPEG' and img.mode in ('RGB', 'L', 'CMYK'):
+        return BytesIO(foto_info.image_bytes)
+    
+    if img_resized.mode not in ('RGB', 'L'):
+        img_resized = img_resized.convert('RGB')
+    
+    buffer = BytesIO()
+    img_resized.save(buffer, 'JPEG', quality=85, optimize=True)
+    buffer.seek(0)
+    return buffer
+
 # ========== CLASSES DO SISTEMA ORIGINAL ==========
 class PDF(FPDF):
     def __init__(self, logo_data=None, *args, **kwargs):
@@ -1337,9 +1355,7 @@ class PDF(FPDF):
                     new_width_mm = width_mm
                     new_height_mm = height_mm
                 
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_img:
-                    img_resized.save(temp_img.name, 'JPEG', quality=85, optimize=True)
-                    temp_img_path = temp_img.name
+                imagem_jpeg = imagem_jpeg_em_memoria(foto_info, img, img_resized)
                 
                 x_position = (210 - new_width_mm) / 2
                 self.set_font('Arial', 'B', 11)
@@ -1347,7 +1363,7 @@ class PDF(FPDF):
                 self.ln(2)
                 
                 y_position = self.get_y()
-                self.image(temp_img_path, x=x_position, y=y_position, w=new_width_mm)
+                self.image(imagem_jpeg, x=x_position, y=y_position, w=new_width_mm)
                 self.set_y(y_position + new_height_mm + 4)
                 
                 if foto_info.comentario and foto_info.comentario.strip():
@@ -1361,11 +1377,6 @@ class PDF(FPDF):
                     self.multi_cell(0, 4, f"Comentário: {comentario}")
                     self.set_font('Arial', '', 10)
                 
-                try:
-                    os.unlink(temp_img_path)
-                except:
-                    pass
-                
                 if i < len(fotos_info):
                     self.ln(5)
                 
@@ -1,28 +1,56 @@
 import streamlit as st
 import pandas as pd
 from fpdf import FPDF
-import base64
 from io import BytesIO
-from PIL import Image, ImageFilter, ImageEnhance
+from PIL import Image, ImageFilter, ImageEnhance, ImageOps
 import os
 import tempfile
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import re
 import time
 import uuid
+import random
 import pickle
 import shutil
+import unicodedata
+from functools import lru_cache
+from itertools import islice
+import threading
+import sqlite3
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import hashlib
+import email.utils
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# Suporte opcional a fotos HEIC (iPhone)
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    HEIF_DISPONIVEL = True
+except ImportError:
+    HEIF_DISPONIVEL = False
+
+# Suporte opcional ao snapshot Parquet da Planilha Master
+try:
+    import pyarrow
+    PARQUET_DISPONIVEL = True
+except ImportError:
+    PARQUET_DISPONIVEL = False
+
 # ========== IMPORTAÇÕES DO GOOGLE DRIVE ==========
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.http import HttpRequest, MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
 from googleapiclient.errors import HttpError
+from openpyxl import Workbook
+import google_auth_httplib2
+import httplib2
 
 # Configuração inicial da página
 st.set_page_config(
@@ -39,7 +67,152 @@ EXCEL_DATABASE_NAME = "Planilha Master.xlsx"
 CONTADOR_FILENAME = "contador_relatorios.json"
 SENHAS_FILENAME = "Senhas.xlsx"
 
+# ========== CONFIGURAÇÃO DO JOURNAL DA PLANILHA MASTER ==========
+# Cada relatório enviado vira um arquivo JSON pequeno no Drive; a Planilha Master
+# é materializada periodicamente a partir desses registros (compactação).
+JOURNAL_PREFIXO = "journal_relatorio_"
+JOURNAL_COMPACTACAO_INTERVALO = int(os.getenv('RF_JOURNAL_COMPACTACAO_INTERVALO', '900'))  # segundos
+# Lease no Drive que torna a compactação exclusiva entre processos (Cloud e instalações locais)
+COMPACTACAO_LEASE_FILENAME = "compactacao_lease.json"
+COMPACTACAO_LEASE_DURACAO = 600  # segundos
+# A compactação só publica ou apaga do Drive com ao menos esta folga de lease
+COMPACTACAO_LEASE_MARGEM = 120  # segundos
+# Tolerância à diferença de relógio entre máquinas ao julgar o lease de outro processo
+COMPACTACAO_LEASE_TOLERANCIA_RELOGIO = 120  # segundos
+
+# ========== CONFIGURAÇÃO DA FILA DE ENVIO (OUTBOX) ==========
+# O relatório é gravado em disco na hora do envio; uma thread em segundo plano
+# envia o PDF e o registro da Planilha Master ao Drive, com novas tentativas.
+OUTBOX_INTERVALO = int(os.getenv('RF_OUTBOX_INTERVALO', '30'))  # segundos
+OUTBOX_ESPERA_MAXIMA = 900  # segundos entre tentativas de um item com falha
+OUTBOX_RETENCAO_SINCRONIZADOS = 7 * 24 * 3600  # segundos
+
+# Banco local (SQLite) com os relatórios; a Planilha Master é exportada a partir dele
+BANCO_RELATORIOS_ARQUIVO = "relatorios.db"
+
+# Snapshot da Planilha Master no Drive, particionado por mês de DATA_RELATORIO
+# ("Planilha Master 2026-10.parquet"), com um manifesto listando as partições.
+# Sem pyarrow as partições são gravadas em xlsx. Com RF_PUBLICAR_XLSX=1 a
+# compactação também atualiza o xlsx único (usado pelas versões anteriores do app).
+PLANILHA_MASTER_PREFIXO = "Planilha Master"
+MANIFESTO_PLANILHA_MASTER_NAME = "Planilha Master - manifest.json"
+PARTICAO_SEM_DATA = "sem-data"
+PLANILHA_MASTER_PUBLICAR_XLSX = os.getenv('RF_PUBLICAR_XLSX', '0') == '1'
+COLUNAS_CATEGORICAS = ['MUNICIPIO', 'SITUACAO', 'TIPO_ACAO']
+COLUNAS_INTEIRAS = ['ORDEM', 'TOTAL_FOTOS', 'FOTOS_COM_COMENTARIOS', 'TOTAL_CONTRATADOS_REGISTROS']
+
+# Abas da Planilha Master: um relatório por linha e um contratado por linha
+ABA_RELATORIOS = "RELATORIOS"
+ABA_CONTRATADOS = "CONTRATADOS"
+CAMPOS_CONTRATADO = [
+    'MESMO_CONTRATANTE', 'NOME_CONTRATANTE', 'REGISTRO_CONTRATANTE', 'CPF_CNPJ_CONTRATANTE',
+    'CONTRATADO_PF_PJ', 'REGISTRO', 'CPF_CNPJ', 'PROFISSIONAL', 'IDENTIFICACAO_FISCALIZADO',
+    'NUMERO_ART', 'NUMERO_RRT', 'NUMERO_TRT', 'RAMO_ATIVIDADE', 'SERVICO_EXECUTADO', 'SERVICO_OUTROS',
+    'FONTE_INFORMACAO', 'QUALIFICACAO_FONTE', 'QUALIFICACAO_OUTROS',
+    'SITUACAO_CONTRATADO', 'TIPO_INFRACAO_CONTRATADO', 'INFRACOES_CONTRATADO'
+]
+
+# Exportação do xlsx em modo streaming: linhas lidas do banco por lote e arquivo em
+# memória só até o limite (acima dele, vai para disco)
+PLANILHA_EXPORTACAO_LOTE = 2000  # linhas
+PLANILHA_EXPORTACAO_LIMITE_MEMORIA = int(os.getenv('RF_EXPORTACAO_LIMITE_MB', '16')) * 1024 * 1024
+# Linhas mais recentes exibidas na visualização da Planilha Master
+PLANILHA_VISUALIZACAO_LINHAS = 1000
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Validade das entradas do cache nome -> fileId do Drive
+DRIVE_ID_CACHE_TTL = int(os.getenv('RF_DRIVE_ID_CACHE_TTL', '600'))  # segundos
+
+# Novas tentativas para falhas transitórias do Drive (429, 5xx, rede)
+DRIVE_MAX_TENTATIVAS = int(os.getenv('RF_DRIVE_MAX_TENTATIVAS', '5'))
+DRIVE_ESPERA_BASE = 1.0  # segundos
+DRIVE_ESPERA_MAXIMA = 32  # segundos
+DRIVE_PROP_IDEMPOTENCIA = "rf_chave_envio"
+
+# Downloads: tamanho de cada bloco e limite em memória antes de usar arquivo temporário
+DRIVE_DOWNLOAD_CHUNK = int(os.getenv('RF_DRIVE_DOWNLOAD_CHUNK_MB', '8')) * 1024 * 1024
+DRIVE_DOWNLOAD_LIMITE_MEMORIA = int(os.getenv('RF_DRIVE_DOWNLOAD_LIMITE_MB', '32')) * 1024 * 1024
+# Revisões (imutáveis) mantidas no cache de downloads por arquivo
+CACHE_DRIVE_REVISOES_MANTIDAS = 200
+
+# Backend do Drive: "google" (API real) ou "local" (pasta local, para testes offline
+# e de carga), com latência (segundos) e taxa de erros transitórios simuladas
+DRIVE_BACKEND = os.getenv('RF_DRIVE_BACKEND', 'google').lower()
+DRIVE_LOCAL_LATENCIA = float(os.getenv('RF_DRIVE_LOCAL_LATENCIA_MS', '0')) / 1000
+DRIVE_LOCAL_VARIACAO_LATENCIA = float(os.getenv('RF_DRIVE_LOCAL_VARIACAO_LATENCIA_MS', '0')) / 1000
+DRIVE_LOCAL_TAXA_ERRO = float(os.getenv('RF_DRIVE_LOCAL_TAXA_ERRO', '0'))
+
+# Telemetria: duração de cada etapa do envio e de cada chamada ao Drive, em JSON lines
+TELEMETRIA_ATIVA = os.getenv('RF_TELEMETRIA', '1') == '1'
+TELEMETRIA_ARQUIVO = "telemetria.jsonl"
+TELEMETRIA_MAX_BYTES = int(os.getenv('RF_TELEMETRIA_MAX_MB', '20')) * 1024 * 1024
+TELEMETRIA_RECENTES = 2000  # spans mantidos em memória para o painel
+# Matrículas (separadas por vírgula) que veem o painel de telemetria
+ADMIN_MATRICULAS = {m.strip().lstrip('0') for m in os.getenv('RF_ADMIN_MATRICULAS', '').split(',') if m.strip()}
+
+# Diretório de agentes: Senhas.xlsx (Drive) unido ao Fiscais.xlsx (local) pela
+# matrícula. Só o Fiscais.xlsx interpretado vai para o cache em disco, chaveado
+# pelo md5 do arquivo; as senhas ficam apenas em memória.
+FISCAIS_ARQUIVO = os.path.join("Template", "Fiscais.xlsx")
+DIRETORIO_AGENTES_FORMATO = 1  # mudar quando a estrutura do índice mudar
+
+# Renova o token do Drive quando faltar menos que isso para expirar
+DRIVE_TOKEN_MARGEM_RENOVACAO = 300  # segundos
+
+# Quantidade de números de relatório reservada por sessão a cada acesso ao contador
+CONTADOR_TAMANHO_BLOCO = int(os.getenv('RF_CONTADOR_TAMANHO_BLOCO', '5'))
+CONTADOR_MAX_TENTATIVAS = 10
+CONTADOR_ESPERA_BASE = 0.25  # segundos; dobra a cada conflito (com jitter)
+CONTADOR_ESPERA_MAXIMA = 8  # segundos
+# Campo dos arquivos de estado compartilhado com a revisão-base e o hash da gravação
+DRIVE_CAMPO_CAS = "_cas"
+
+# Threads usadas para preparar as fotos do PDF (decodificar, redimensionar, codificar)
+PDF_FOTO_WORKERS = int(os.getenv('RF_PDF_FOTO_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# ========== CONFIGURAÇÃO DAS FOTOS ==========
+# Tamanho máximo impresso da foto no PDF e resolução de impressão.
+# 96 dpi corresponde à escala usada no PDF desde a versão original (0,264583 mm/pixel).
+PDF_FOTO_MAX_MM = 170
+PDF_FOTO_DPI = int(os.getenv('RF_PDF_FOTO_DPI', '96'))
+MM_POR_PIXEL = 25.4 / PDF_FOTO_DPI
+FOTO_MAX_PIXELS = int(round(PDF_FOTO_MAX_MM / MM_POR_PIXEL))
+FOTO_JPEG_QUALIDADE = 85
+FOTO_THUMBNAIL_TAMANHO = (600, 400)
+
+# Orçamento de memória (por processo) para fotos em cache; o restante fica em disco
+FOTOS_MEMORIA_MAX_MB = int(os.getenv('RF_FOTOS_MEMORIA_MAX_MB', '256'))
+FOTOS_SESSAO_MAX_HORAS = 24
+# Intervalo mínimo entre duas varreduras das pastas de sessões abandonadas
+FOTOS_LIMPEZA_INTERVALO = 3600  # segundos
+
 # ========== FUNÇÃO PARA SUBSTITUIR CARACTERES ESPECIAIS ==========
+# Mapeamento de caracteres especiais para equivalentes suportados
+SUBSTITUICOES_ACENTOS = str.maketrans({
+    'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a', 'ä': 'a',
+    'é': 'e', 'è': 'e', 'ê': 'e', 'ë': 'e',
+    'í': 'i', 'ì': 'i', 'î': 'i', 'ï': 'i',
+    'ó': 'o', 'ò': 'o', 'ô': 'o', 'õ': 'o', 'ö': 'o',
+    'ú': 'u', 'ù': 'u', 'û': 'u', 'ü': 'u',
+    'ç': 'c', 'ñ': 'n',
+    'Á': 'A', 'À': 'A', 'Â': 'A', 'Ã': 'A', 'Ä': 'A',
+    'É': 'E', 'È': 'E', 'Ê': 'E', 'Ë': 'E',
+    'Í': 'I', 'Ì': 'I', 'Î': 'I', 'Ï': 'I',
+    'Ó': 'O', 'Ò': 'O', 'Ô': 'O', 'Õ': 'O', 'Ö': 'O',
+    'Ú': 'U', 'Ù': 'U', 'Û': 'U', 'Ü': 'U',
+    'Ç': 'C', 'Ñ': 'N',
+    'º': 'o', 'ª': 'a',
+    '—': '-', '–': '-',
+    '“': '"', '”': '"', '‘': "'", '’': "'",
+    '\u2013': '-',  # meia risca (en dash) para hífen
+    '\u2014': '-',  # travessão (em dash) para hífen
+    '\u2018': "'",  # aspas simples esquerda para aspas simples
+    '\u2019': "'",  # aspas simples direita para aspas simples
+    '\u201C': '"',  # aspas duplas esquerda para aspas duplas
+    '\u201D': '"',  # aspas duplas direita para aspas duplas
+    '\u2026': '...',  # reticências para três pontos
+})
+
 def remover_acentos(texto):
     """
     Substitui caracteres especiais não suportados pela fonte Helvetica do FPDF
@@ -47,40 +220,21 @@ def remover_acentos(texto):
     """
     if not isinstance(texto, str):
         return str(texto) if texto is not None else ""
+    return _remover_acentos_str(texto)
+
+@lru_cache(maxsize=4096)
+def _remover_acentos_str(texto):
+    # Textos repetidos (títulos, infrações) são resolvidos uma única vez
+    texto = texto.translate(SUBSTITUICOES_ACENTOS)
+    if texto.isascii():
+        return texto
     
-    # Mapeamento de caracteres especiais para equivalentes suportados
-    substituicoes = {
-        'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a', 'ä': 'a',
-        'é': 'e', 'è': 'e', 'ê': 'e', 'ë': 'e',
-        'í': 'i', 'ì': 'i', 'î': 'i', 'ï': 'i',
-        'ó': 'o', 'ò': 'o', 'ô': 'o', 'õ': 'o', 'ö': 'o',
-        'ú': 'u', 'ù': 'u', 'û': 'u', 'ü': 'u',
-        'ç': 'c', 'ñ': 'n',
-        'Á': 'A', 'À': 'A', 'Â': 'A', 'Ã': 'A', 'Ä': 'A',
-        'É': 'E', 'È': 'E', 'Ê': 'E', 'Ë': 'E',
-        'Í': 'I', 'Ì': 'I', 'Î': 'I', 'Ï': 'I',
-        'Ó': 'O', 'Ò': 'O', 'Ô': 'O', 'Õ': 'O', 'Ö': 'O',
-        'Ú': 'U', 'Ù': 'U', 'Û': 'U', 'Ü': 'U',
-        'Ç': 'C', 'Ñ': 'N',
-        'º': 'o', 'ª': 'a',
-        '—': '-', '–': '-',
-        '“': '"', '”': '"', '‘': "'", '’': "'",
-        '\u2013': '-',  # meia risca (en dash) para hífen
-        '\u2014': '-',  # travessão (em dash) para hífen
-        '\u2018': "'",  # aspas simples esquerda para aspas simples
-        '\u2019': "'",  # aspas simples direita para aspas simples
-        '\u201C': '"',  # aspas duplas esquerda para aspas duplas
-        '\u201D': '"',  # aspas duplas direita para aspas duplas
-        '\u2026': '...',  # reticências para três pontos
-    }
-    
-    for char_especial, char_normal in substituicoes.items():
-        texto = texto.replace(char_especial, char_normal)
+    # Caracteres fora da tabela: decompõe e descarta os acentos combinantes
+    texto = unicodedata.normalize('NFKD', texto)
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
     
     # Remove qualquer caractere que ainda não seja ASCII
-    texto = texto.encode('ascii', 'replace').decode('ascii')
-    
-    return texto
+    return texto.encode('ascii', 'replace').decode('ascii')
 
 # ========== DADOS DAS MULTAS (SANITIZADOS) ==========
 INFRACOES_PF = [
@@ -163,6 +317,51 @@ def get_pasta_local(matricula):
         
         return caminho_pasta
 
+# ========== PASTA DE DADOS INTERNOS DO APLICATIVO ==========
+def get_pasta_dados_app(subpasta=""):
+    """
+    Pasta local para dados internos do aplicativo (journal, caches, filas).
+    Pode ser definida pela variável de ambiente RF_DADOS_DIR.
+    As pastas são criadas com acesso só para o usuário atual (0700).
+    """
+    base = os.getenv('RF_DADOS_DIR')
+    if not base:
+        raiz = tempfile.gettempdir() if is_streamlit_cloud() else str(Path.home())
+        base = os.path.join(raiz, "RF-CREA-RJ-dados")
+
+    caminho_pasta = os.path.join(base, subpasta) if subpasta else base
+    for pasta in (base, caminho_pasta):
+        if not os.path.isdir(pasta):
+            os.makedirs(pasta, mode=0o700, exist_ok=True)
+            restringir_pasta(pasta)
+    return caminho_pasta
+
+def restringir_pasta(pasta):
+    """Deixa a pasta acessível só ao usuário atual, se ela for dele"""
+    if not hasattr(os, 'getuid'):
+        return
+    try:
+        if os.stat(pasta).st_uid == os.getuid():
+            os.chmod(pasta, 0o700)
+    except OSError:
+        pass
+
+def pasta_privada(pasta):
+    """
+    True se só o usuário atual pode gravar na pasta e na pasta acima dela.
+    No Windows a pasta de dados fica no perfil do usuário e é considerada privada.
+    """
+    if not hasattr(os, 'getuid'):
+        return True
+    for caminho in (pasta, os.path.dirname(os.path.abspath(pasta))):
+        try:
+            info = os.stat(caminho)
+        except OSError:
+            return False
+        if info.st_uid != os.getuid() or info.st_mode & 0o077:
+            return False
+    return True
+
 # ========== FUNÇÃO PARA DISPONIBILIZAR PDF ==========
 def disponibilizar_pdf_para_download(caminho_arquivo, nome_arquivo):
     """
@@ -236,19 +435,140 @@ def salvar_pdf_adaptado(pdf, matricula, numero_relatorio):
 # ========== FUNÇÃO DE AUTENTICAÇÃO PARA DRIVE COMPARTILHADO ==========
 def autenticar_google_drive():
     """
-    Autentica no Google Drive com suporte a:
+    Retorna o serviço do Google Drive compartilhado pelo processo, com suporte a:
     - OAuth 2.0 (ambiente local)
     - Service Account (Streamlit Cloud)
     - Drives compartilhados
+    As credenciais e o documento de descoberta são criados uma única vez;
+    a cada chamada apenas o token é renovado quando estiver perto de expirar.
+    Com RF_DRIVE_BACKEND=local, retorna o Drive simulado em pasta local.
+    """
+    if DRIVE_BACKEND == 'local':
+        return obter_drive_local()
+    
+    servico = obter_servico_drive_compartilhado()
+    
+    if servico is None:
+        # Não guarda falhas no cache: a próxima interação tenta novamente
+        obter_servico_drive_compartilhado.clear()
+        return None
+    
+    try:
+        servico.garantir_token_valido()
+    except Exception as e:
+        st.sidebar.error(f"❌ Erro ao renovar token do Google Drive: {str(e)}")
+        obter_servico_drive_compartilhado.clear()
+        return None
+    
+    return servico.service
+
+class ServicoDriveCompartilhado:
+    """
+    Serviço do Drive reutilizado entre reruns e sessões.
+    O objeto `service` é seguro entre threads: cada requisição usa a conexão
+    HTTP (keep-alive) da própria thread, criada sob demanda.
     """
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.service = build(
+            'drive', 'v3',
+            http=self._http_da_thread(),
+            requestBuilder=self._criar_request,
+            cache_discovery=False
+        )
+    
+    def _http_da_thread(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+            self._local.http = http
+        return http
+    
+    def _criar_request(self, http, *args, **kwargs):
+        return HttpRequest(self._http_da_thread(), *args, **kwargs)
+    
+    def _token_expirando(self):
+        expiry = getattr(self.credentials, 'expiry', None)
+        if not self.credentials.valid:
+            return True
+        if expiry is None:
+            return False
+        return expiry - datetime.utcnow() < timedelta(seconds=DRIVE_TOKEN_MARGEM_RENOVACAO)
     
+    def garantir_token_valido(self):
+        """Renova o token antes de expirar (evita o 401 + nova tentativa)"""
+        if not self._token_expirando():
+            return
+        with self._lock:
+            if self._token_expirando():
+                self.credentials.refresh(Request())
+
+@st.cache_resource(show_spinner=False)
+def obter_servico_drive_compartilhado():
+    """Cria (uma vez por processo) o serviço autenticado do Drive"""
     if is_streamlit_cloud():
-        return autenticar_service_account()
+        credentials = obter_credenciais_service_account()
     else:
-        return autenticar_oauth_local()
+        credentials = obter_credenciais_oauth_local()
+    
+    if not credentials:
+        return None
+    
+    try:
+        servico = ServicoDriveCompartilhado(credentials)
+    except Exception as e:
+        st.sidebar.error(f"❌ Erro ao criar serviço do Drive: {str(e)}")
+        return None
+    
+    if not verificar_acesso_drive(servico.service):
+        return None
+    
+    return servico
+
+def verificar_acesso_drive(service):
+    """Confere o acesso à pasta do Drive (executado só na criação do serviço)"""
+    list_params = {
+        'q': f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and trashed=false",
+        'fields': "files(id, name)",
+        'supportsAllDrives': True,
+        'includeItemsFromAllDrives': True,
+        'pageSize': 10
+    }
+    
+    if is_streamlit_cloud():
+        list_params['driveId'] = SHARED_DRIVE_ID
+        list_params['corpora'] = 'drive'
+    
+    try:
+        executar_drive(service.files().list(**list_params), 'files.list')
+        return True
+    except HttpError as e:
+        if is_streamlit_cloud():
+            st.sidebar.error(f"❌ Erro ao acessar Drive Compartilhado: {e}")
+        else:
+            st.sidebar.error(f"❌ Erro ao acessar Drive: {e}")
+        return False
+    except Exception as e:
+        st.sidebar.error(f"❌ Erro ao criar serviço do Drive: {str(e)}")
+        return False
+
+# ========== BACKEND LOCAL DO DRIVE (TESTES OFFLINE E DE CARGA) ==========
+@st.cache_resource(show_spinner=False)
+def obter_drive_local():
+    """Drive local único por processo (RF_DRIVE_BACKEND=local)"""
+    from drive_local import DriveLocal
+    
+    return DriveLocal(
+        os.getenv('RF_DRIVE_LOCAL_DIR') or get_pasta_dados_app("drive_local"),
+        latencia=DRIVE_LOCAL_LATENCIA,
+        variacao_latencia=DRIVE_LOCAL_VARIACAO_LATENCIA,
+        taxa_erro=DRIVE_LOCAL_TAXA_ERRO
+    )
 
-def autenticar_service_account():
-    """Autenticação via Service Account para Streamlit Cloud"""
+def obter_credenciais_service_account():
+    """Credenciais via Service Account para Streamlit Cloud"""
     try:
         if 'google_drive' not in st.secrets:
             st.sidebar.error("❌ Configuração 'google_drive' não encontrada nos secrets!")
@@ -263,37 +583,17 @@ def autenticar_service_account():
                 st.sidebar.error("❌ Erro ao fazer parse das credentials JSON")
                 return None
         
-        credentials = service_account.Credentials.from_service_account_info(
+        return service_account.Credentials.from_service_account_info(
             credentials_dict,
             scopes=SCOPES
         )
-        
-        service = build('drive', 'v3', credentials=credentials)
-        
-        try:
-            results = service.files().list(
-                q=f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and trashed=false",
-                fields="files(id, name)",
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True,
-                driveId=SHARED_DRIVE_ID,
-                corpora='drive',
-                pageSize=10
-            ).execute()
-            
-            files = results.get('files', [])
-            return service
-            
-        except HttpError as e:
-            st.sidebar.error(f"❌ Erro ao acessar Drive Compartilhado: {e}")
-            return None
                 
     except Exception as e:
         st.sidebar.error(f"❌ Erro na autenticação Service Account: {str(e)}")
         return None
 
-def autenticar_oauth_local():
-    """Autenticação OAuth 2.0 para ambiente local"""
+def obter_credenciais_oauth_local():
+    """Credenciais OAuth 2.0 para ambiente local"""
     creds = None
     
     if os.path.exists('token.json'):
@@ -337,26 +637,380 @@ def autenticar_oauth_local():
         except Exception as e:
             pass
     
+    return creds
+
+# ========== TELEMETRIA (TEMPO POR ETAPA) ==========
+class Telemetria:
+    """
+    Registro das etapas medidas (spans) em JSON lines. As mais recentes ficam
+    também em memória para o painel de administração.
+    """
+    def __init__(self, caminho, max_bytes=TELEMETRIA_MAX_BYTES, recentes=TELEMETRIA_RECENTES):
+        self.caminho = caminho
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._recentes = deque(maxlen=recentes)
+
+    def registrar(self, evento):
+        linha = json.dumps(evento, ensure_ascii=False, default=str)
+        with self._lock:
+            self._recentes.append(evento)
+            try:
+                # Rotação simples: mantém o arquivo atual e o anterior (.1)
+                if os.path.exists(self.caminho) and os.path.getsize(self.caminho) > self.max_bytes:
+                    os.replace(self.caminho, self.caminho + ".1")
+                with open(self.caminho, 'a', encoding='utf-8') as f:
+                    f.write(linha + "\n")
+            except OSError:
+                pass
+
+    def recentes(self):
+        with self._lock:
+            return list(self._recentes)
+
+    def resumo(self):
+        """Duração (ms) por etapa: quantidade, média, p50, p95, máximo e erros"""
+        duracoes = {}
+        erros = {}
+        for evento in self.recentes():
+            duracoes.setdefault(evento['etapa'], []).append(evento['duracao_ms'])
+            if evento['status'] != 'ok':
+                erros[evento['etapa']] = erros.get(evento['etapa'], 0) + 1
+
+        linhas = []
+        for etapa, valores in sorted(duracoes.items()):
+            valores.sort()
+            linhas.append({
+                'ETAPA': etapa,
+                'N': len(valores),
+                'MEDIA_MS': round(sum(valores) / len(valores), 1),
+                'P50_MS': valores[len(valores) // 2],
+                'P95_MS': valores[min(len(valores) - 1, int(len(valores) * 0.95))],
+                'MAX_MS': valores[-1],
+                'ERROS': erros.get(etapa, 0),
+            })
+        return linhas
+
+@st.cache_resource
+def obter_telemetria():
+    """Telemetria única por processo (arquivo na pasta de dados do app)"""
+    return Telemetria(os.path.join(get_pasta_dados_app("logs"), TELEMETRIA_ARQUIVO))
+
+_contexto_telemetria = threading.local()
+
+@contextmanager
+def medir_etapa(etapa, **atributos):
+    """
+    Mede a duração do bloco e registra um span. Spans abertos dentro do bloco
+    (na mesma thread) ficam ligados a ele pelo campo 'pai' e compartilham o
+    'rastreamento'. Retorna o dicionário de atributos, que o bloco pode completar.
+    """
+    if not TELEMETRIA_ATIVA:
+        yield atributos
+        return
+
+    pilha = getattr(_contexto_telemetria, 'pilha', None)
+    if pilha is None:
+        pilha = _contexto_telemetria.pilha = []
+    pai = pilha[-1] if pilha else None
+    span_id = uuid.uuid4().hex[:16]
+    evento = {
+        'etapa': etapa,
+        'span': span_id,
+        'pai': pai['span'] if pai else None,
+        'rastreamento': pai['rastreamento'] if pai else span_id,
+        'inicio': datetime.now().isoformat(timespec='milliseconds'),
+    }
+    pilha.append(evento)
+    inicio = time.perf_counter()
+    status = 'ok'
     try:
-        service = build('drive', 'v3', credentials=creds)
-        
-        results = service.files().list(
-            q=f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and trashed=false",
-            fields="files(id, name)",
-            supportsAllDrives=True,
-            includeItemsFromAllDrives=True,
-            pageSize=10
-        ).execute()
-        
-        files = results.get('files', [])
-        return service
-        
-    except HttpError as e:
-        st.sidebar.error(f"❌ Erro ao acessar Drive: {e}")
+        yield atributos
+    except Exception as erro:
+        status = 'erro'
+        evento['erro'] = f"{type(erro).__name__}: {erro}"[:200]
+        raise
+    finally:
+        pilha.pop()
+        evento.update({
+            'duracao_ms': round((time.perf_counter() - inicio) * 1000, 1),
+            'status': status,
+            'thread': threading.current_thread().name,
+            **atributos
+        })
+        obter_telemetria().registrar(evento)
+
+def usuario_administrador(matricula):
+    return bool(matricula) and str(matricula).lstrip('0') in ADMIN_MATRICULAS
+
+def exibir_painel_telemetria():
+    """Painel da barra lateral (administradores) com os tempos por etapa e as métricas do Drive"""
+    with st.expander("⏱️ Tempos por etapa (admin)"):
+        resumo = obter_telemetria().resumo()
+        if resumo:
+            st.dataframe(pd.DataFrame(resumo), hide_index=True, use_container_width=True)
+        else:
+            st.caption("Nenhuma etapa medida neste processo ainda.")
+
+        metricas = obter_metricas_drive().resumo()
+        if metricas['operacoes']:
+            st.markdown("**Chamadas ao Drive:**")
+            st.dataframe(
+                pd.DataFrame([{'OPERACAO': op, **valores} for op, valores in sorted(metricas['operacoes'].items())]),
+                hide_index=True, use_container_width=True
+            )
+        if metricas['erros']:
+            st.caption("Erros por código: " + ", ".join(f"{codigo}: {n}" for codigo, n in metricas['erros'].items()))
+
+        # Etapas do último relatório enviado neste processo
+        recentes = obter_telemetria().recentes()
+        ultimo = next((e for e in reversed(recentes) if e['etapa'] == 'envio.pdf'), None)
+        if ultimo and ultimo.get('relatorio'):
+            st.markdown(f"**Último relatório (`{ultimo['relatorio']}`):**")
+            for evento in recentes:
+                if evento.get('relatorio') == ultimo['relatorio'] and evento['etapa'].startswith('envio.'):
+                    st.caption(f"{evento['etapa']}: {evento['duracao_ms']:.0f} ms")
+        st.caption(f"Registro completo: {obter_telemetria().caminho}")
+
+# ========== TRANSPORTE DO DRIVE COM NOVAS TENTATIVAS ==========
+class MetricasDrive:
+    """Contadores de chamadas, novas tentativas e falhas do Drive por operação"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operacoes = {}
+        self._status = {}
+
+    def registrar(self, operacao, evento, erro=None):
+        with self._lock:
+            contadores = self._operacoes.setdefault(
+                operacao, {'chamadas': 0, 'retentativas': 0, 'falhas': 0}
+            )
+            if evento == 'sucesso':
+                contadores['chamadas'] += 1
+            elif evento == 'retentativa':
+                contadores['retentativas'] += 1
+            else:
+                contadores['chamadas'] += 1
+                contadores['falhas'] += 1
+            if erro is not None:
+                codigo = str(getattr(getattr(erro, 'resp', None), 'status', type(erro).__name__))
+                self._status[codigo] = self._status.get(codigo, 0) + 1
+
+    def resumo(self):
+        with self._lock:
+            return {
+                'operacoes': {op: dict(c) for op, c in self._operacoes.items()},
+                'erros': dict(self._status),
+            }
+
+@st.cache_resource
+def obter_metricas_drive():
+    """Métricas do transporte do Drive, compartilhadas pelo processo"""
+    return MetricasDrive()
+
+def tempo_espera_retentativa(erro, tentativa):
+    """
+    Segundos a aguardar antes de repetir a chamada, ou None se o erro não for
+    transitório. Respeita o cabeçalho Retry-After quando presente.
+    """
+    if isinstance(erro, HttpError):
+        status = getattr(erro.resp, 'status', None)
+        transitorio = status in (429, 500, 502, 503, 504)
+        if status == 403:
+            detalhes = getattr(erro, 'error_details', None) or []
+            razoes = {d.get('reason') for d in detalhes if isinstance(d, dict)} if isinstance(detalhes, list) else set()
+            transitorio = bool(razoes & {'rateLimitExceeded', 'userRateLimitExceeded'})
+        if not transitorio:
+            return None
+
+        retry_after = erro.resp.get('retry-after') if hasattr(erro.resp, 'get') else None
+        if retry_after:
+            try:
+                return min(float(retry_after), DRIVE_ESPERA_MAXIMA)
+            except ValueError:
+                data = email.utils.parsedate_to_datetime(retry_after)
+                if data:
+                    return min(max(0.0, data.timestamp() - time.time()), DRIVE_ESPERA_MAXIMA)
+    elif not isinstance(erro, (ConnectionError, TimeoutError, httplib2.ServerNotFoundError)):
         return None
-    except Exception as e:
-        st.sidebar.error(f"❌ Erro ao criar serviço do Drive: {str(e)}")
+
+    # Backoff exponencial com jitter completo
+    return random.uniform(0, min(DRIVE_ESPERA_MAXIMA, DRIVE_ESPERA_BASE * 2 ** tentativa))
+
+_contexto_drive = threading.local()
+
+@contextmanager
+def sem_retentativas_drive():
+    """
+    As chamadas ao Drive feitas no bloco (na mesma thread) têm uma única tentativa,
+    sem esperas: para quando a sessão aguarda a resposta e a outbox tenta de novo depois.
+    """
+    anterior = getattr(_contexto_drive, 'max_tentativas', None)
+    _contexto_drive.max_tentativas = 1
+    try:
+        yield
+    finally:
+        _contexto_drive.max_tentativas = anterior
+
+def executar_com_retentativa(operacao, nome_operacao="drive"):
+    """Executa `operacao()` repetindo falhas transitórias com backoff exponencial"""
+    metricas = obter_metricas_drive()
+    max_tentativas = getattr(_contexto_drive, 'max_tentativas', None) or DRIVE_MAX_TENTATIVAS
+    with medir_etapa(f"drive.{nome_operacao}") as span:
+        for tentativa in range(max_tentativas):
+            span['tentativas'] = tentativa + 1
+            try:
+                resultado = operacao()
+            except Exception as erro:
+                espera = tempo_espera_retentativa(erro, tentativa)
+                if espera is None or tentativa == max_tentativas - 1:
+                    metricas.registrar(nome_operacao, 'falha', erro)
+                    raise
+                metricas.registrar(nome_operacao, 'retentativa', erro)
+                time.sleep(espera)
+            else:
+                metricas.registrar(nome_operacao, 'sucesso')
+                return resultado
+
+def executar_drive(requisicao, nome_operacao="drive"):
+    """Executa uma requisição do googleapiclient com novas tentativas"""
+    return executar_com_retentativa(requisicao.execute, nome_operacao)
+
+def chave_idempotencia(nome_arquivo, conteudo_sha256):
+    """Chave de envio: nome do arquivo (com o número do relatório) + hash do conteúdo"""
+    return f"{os.path.splitext(nome_arquivo)[0]}:{conteudo_sha256[:32]}"
+
+def calcular_hashes_arquivo(caminho_arquivo):
+    """Retorna (md5, sha256) do arquivo; o md5 é comparável ao md5Checksum do Drive"""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(caminho_arquivo, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(bloco)
+            sha256.update(bloco)
+    return md5.hexdigest(), sha256.hexdigest()
+
+def buscar_arquivo_por_chave(service, folder_id, chave, fields='id, name, parents'):
+    """Arquivo já criado com a chave de envio (create repetido após resposta perdida)"""
+    query = f"appProperties has {{ key='{DRIVE_PROP_IDEMPOTENCIA}' and value='{chave}' }} and trashed = false"
+    if folder_id:
+        query += f" and '{folder_id}' in parents"
+
+    list_params = {
+        'q': query,
+        'spaces': 'drive',
+        'fields': f'files({fields})',
+        'supportsAllDrives': True,
+        'includeItemsFromAllDrives': True
+    }
+    if is_streamlit_cloud():
+        list_params['corpora'] = 'drive'
+        list_params['driveId'] = SHARED_DRIVE_ID
+
+    arquivos = executar_drive(service.files().list(**list_params), 'files.list').get('files', [])
+    return arquivos[0] if arquivos else None
+
+def criar_arquivo_idempotente(service, folder_id, chave, **create_params):
+    """
+    files().create com novas tentativas. Antes de repetir, verifica se a
+    tentativa anterior chegou a criar o arquivo, evitando duplicatas.
+    """
+    tentativas = []
+
+    def _criar():
+        if tentativas:
+            existente = buscar_arquivo_por_chave(service, folder_id, chave, create_params.get('fields', 'id'))
+            if existente:
+                return existente
+        tentativas.append(time.time())
+        return service.files().create(**create_params).execute()
+
+    return executar_com_retentativa(_criar, 'files.create')
+
+# ========== CACHE DE IDS DE ARQUIVOS DO DRIVE ==========
+class CacheIdsDrive:
+    """
+    Cache de processo nome -> arquivo do Drive, chaveado por (folder_id, nome).
+    Evita um files().list a cada upload/download. Entradas expiram após `ttl`
+    segundos e são invalidadas quando o Drive responde 404.
+    """
+    def __init__(self, ttl=DRIVE_ID_CACHE_TTL):
+        self.ttl = ttl
+        self._itens = {}
+        self._lock = threading.Lock()
+
+    def obter(self, folder_id, nome_arquivo):
+        with self._lock:
+            item = self._itens.get((folder_id, nome_arquivo))
+            if item is None:
+                return None
+            arquivo, expira_em = item
+            if time.time() >= expira_em:
+                del self._itens[(folder_id, nome_arquivo)]
+                return None
+            return arquivo
+
+    def definir(self, folder_id, nome_arquivo, arquivo):
+        with self._lock:
+            self._itens[(folder_id, nome_arquivo)] = (arquivo, time.time() + self.ttl)
+
+    def invalidar(self, folder_id, nome_arquivo):
+        with self._lock:
+            self._itens.pop((folder_id, nome_arquivo), None)
+
+@st.cache_resource
+def obter_cache_ids_drive():
+    """Instância única do cache de IDs, compartilhada entre sessões"""
+    return CacheIdsDrive(DRIVE_ID_CACHE_TTL)
+
+def erro_nao_encontrado(erro):
+    """Indica se o erro do Drive é um 404 (arquivo removido ou ID obsoleto)"""
+    return isinstance(erro, HttpError) and getattr(erro.resp, 'status', None) == 404
+
+def resolver_arquivo_drive(service, nome_arquivo, folder_id, usar_cache=True):
+    """
+    Resolve o arquivo pelo nome dentro da pasta. Retorna dict com 'id', 'name'
+    e 'parents' ou None se não existir. Resultados positivos ficam em cache.
+    """
+    cache = obter_cache_ids_drive()
+    if usar_cache:
+        arquivo = cache.obter(folder_id, nome_arquivo)
+        if arquivo:
+            return arquivo
+
+    query = f"name = '{nome_arquivo}' and trashed = false"
+    if folder_id:
+        query = f"name = '{nome_arquivo}' and '{folder_id}' in parents and trashed = false"
+    
+    list_params = {
+        'q': query,
+        'spaces': 'drive',
+        'fields': 'files(id, name, parents, md5Checksum, appProperties)',
+        'orderBy': 'createdTime',
+        'supportsAllDrives': True,
+        'includeItemsFromAllDrives': True
+    }
+    
+    if is_streamlit_cloud():
+        list_params['corpora'] = 'drive'
+        list_params['driveId'] = SHARED_DRIVE_ID
+    
+    results = executar_drive(service.files().list(**list_params), 'files.list')
+    arquivos = results.get('files', [])
+    
+    if not arquivos:
+        cache.invalidar(folder_id, nome_arquivo)
         return None
+    
+    arquivo = {
+        'id': arquivos[0]['id'],
+        'name': arquivos[0].get('name', nome_arquivo),
+        'parents': arquivos[0].get('parents', []),
+        'md5Checksum': arquivos[0].get('md5Checksum'),
+        'chave_envio': arquivos[0].get('appProperties', {}).get(DRIVE_PROP_IDEMPOTENCIA)
+    }
+    cache.definir(folder_id, nome_arquivo, arquivo)
+    return arquivo
 
 # ========== FUNÇÕES DO GOOGLE DRIVE ==========
 def upload_para_google_drive(caminho_arquivo, nome_arquivo, service, folder_id=None):
@@ -365,101 +1019,17 @@ def upload_para_google_drive(caminho_arquivo, nome_arquivo, service, folder_id=N
         if not os.path.exists(caminho_arquivo):
             return None
         
-        extensao = os.path.splitext(nome_arquivo)[1].lower()
-        mimetypes = {
-            '.pdf': 'application/pdf',
-            '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            '.xls': 'application/vnd.ms-excel',
-            '.json': 'application/json'
-        }
-        mimetype = mimetypes.get(extensao, 'application/octet-stream')
-        
-        drive_params = {
-            'supportsAllDrives': True
-        }
-        
-        if is_streamlit_cloud():
-            drive_params['driveId'] = SHARED_DRIVE_ID
-        
-        query = f"name = '{nome_arquivo}' and trashed = false"
-        if folder_id:
-            query = f"name = '{nome_arquivo}' and '{folder_id}' in parents and trashed = false"
-        
-        list_params = {
-            'q': query,
-            'spaces': 'drive',
-            'fields': 'files(id, name, parents)',
-            'supportsAllDrives': True,
-            'includeItemsFromAllDrives': True
-        }
-        
-        if is_streamlit_cloud():
-            list_params['corpora'] = 'drive'
-            list_params['driveId'] = SHARED_DRIVE_ID
-        
-        results = service.files().list(**list_params).execute()
-        arquivos = results.get('files', [])
-        
-        file_metadata = {'name': nome_arquivo}
-        
-        upload_params = {
-            'body': file_metadata,
-            'media_body': MediaFileUpload(caminho_arquivo, mimetype=mimetype, resumable=True),
-            'fields': 'id, name, webViewLink, webContentLink, size, createdTime, modifiedTime',
-            'supportsAllDrives': True
-        }
-        
-        if is_streamlit_cloud():
-            upload_params['enforceSingleParent'] = True
-        
-        if arquivos:
-            file_id = arquivos[0]['id']
-            
-            file = service.files().update(
-                fileId=file_id,
-                **upload_params
-            ).execute()
-            
-            current_parents = arquivos[0].get('parents', [])
-            if folder_id and folder_id not in current_parents:
-                move_params = {
-                    'fileId': file_id,
-                    'addParents': folder_id,
-                    'removeParents': ','.join(current_parents),
-                    'fields': 'id, parents',
-                    'supportsAllDrives': True
-                }
-                if is_streamlit_cloud():
-                    move_params['enforceSingleParent'] = True
-                
-                service.files().update(**move_params).execute()
-            
-            resultado = {
-                'id': file.get('id'),
-                'nome': file.get('name'),
-                'link_visualizacao': file.get('webViewLink'),
-                'link_download': file.get('webContentLink'),
-                'tamanho_bytes': int(file.get('size', 0)),
-                'modificado': file.get('modifiedTime'),
-                'acao': 'ATUALIZADO'
-            }
-        else:
-            if folder_id:
-                file_metadata['parents'] = [folder_id]
-            
-            file = service.files().create(**upload_params).execute()
-            
-            resultado = {
-                'id': file.get('id'),
-                'nome': file.get('name'),
-                'link_visualizacao': file.get('webViewLink'),
-                'link_download': file.get('webContentLink'),
-                'tamanho_bytes': int(file.get('size', 0)),
-                'criado': file.get('createdTime'),
-                'acao': 'CRIADO'
-            }
-        
-        return resultado
+        with medir_etapa('drive.upload', arquivo=nome_arquivo, bytes=os.path.getsize(caminho_arquivo)) as span:
+            try:
+                resultado = _upload_para_google_drive(caminho_arquivo, nome_arquivo, service, folder_id, usar_cache=True)
+            except HttpError as error:
+                if not erro_nao_encontrado(error):
+                    raise
+                # ID em cache obsoleto: resolve novamente pelo nome
+                obter_cache_ids_drive().invalidar(folder_id, nome_arquivo)
+                resultado = _upload_para_google_drive(caminho_arquivo, nome_arquivo, service, folder_id, usar_cache=False)
+            span['acao'] = resultado.get('acao') if resultado else None
+            return resultado
         
     except HttpError as error:
         st.error(f'❌ Erro HTTP do Google Drive: {error}')
@@ -468,223 +1038,699 @@ def upload_para_google_drive(caminho_arquivo, nome_arquivo, service, folder_id=N
         st.error(f'❌ Erro ao fazer upload: {str(e)}')
         return None
 
-def baixar_arquivo_do_drive(service, nome_arquivo, folder_id):
-    """Baixa um arquivo do Google Drive com suporte a drives compartilhados"""
-    try:
-        query = f"name = '{nome_arquivo}' and trashed = false"
+def _upload_para_google_drive(caminho_arquivo, nome_arquivo, service, folder_id, usar_cache):
+    extensao = os.path.splitext(nome_arquivo)[1].lower()
+    mimetypes = {
+        '.pdf': 'application/pdf',
+        '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        '.xls': 'application/vnd.ms-excel',
+        '.json': 'application/json'
+    }
+    mimetype = mimetypes.get(extensao, 'application/octet-stream')
+    
+    arquivo_existente = resolver_arquivo_drive(service, nome_arquivo, folder_id, usar_cache=usar_cache)
+    
+    md5_local, sha256_local = calcular_hashes_arquivo(caminho_arquivo)
+    chave = chave_idempotencia(nome_arquivo, sha256_local)
+    
+    # Conteúdo idêntico já está no Drive (reenvio ou nova tentativa): nada a enviar
+    if arquivo_existente and (not folder_id or folder_id in arquivo_existente.get('parents', [])):
+        if chave == arquivo_existente.get('chave_envio') or md5_local == arquivo_existente.get('md5Checksum'):
+            return {
+                'id': arquivo_existente['id'],
+                'nome': arquivo_existente.get('name', nome_arquivo),
+                'tamanho_bytes': os.path.getsize(caminho_arquivo),
+                'acao': 'SEM_ALTERACAO'
+            }
+    
+    file_metadata = {'name': nome_arquivo, 'appProperties': {DRIVE_PROP_IDEMPOTENCIA: chave}}
+    
+    upload_params = {
+        'body': file_metadata,
+        'media_body': MediaFileUpload(caminho_arquivo, mimetype=mimetype, resumable=True),
+        'fields': 'id, name, parents, md5Checksum, webViewLink, webContentLink, size, createdTime, modifiedTime',
+        'supportsAllDrives': True
+    }
+    
+    if is_streamlit_cloud():
+        upload_params['enforceSingleParent'] = True
+    
+    if arquivo_existente:
+        file_id = arquivo_existente['id']
+        
+        file = executar_drive(service.files().update(
+            fileId=file_id,
+            **upload_params
+        ), 'files.update')
+        
+        current_parents = arquivo_existente.get('parents', [])
+        if folder_id and folder_id not in current_parents:
+            move_params = {
+                'fileId': file_id,
+                'addParents': folder_id,
+                'removeParents': ','.join(current_parents),
+                'fields': 'id, parents',
+                'supportsAllDrives': True
+            }
+            if is_streamlit_cloud():
+                move_params['enforceSingleParent'] = True
+            
+            executar_drive(service.files().update(**move_params), 'files.update')
+        
+        resultado = {
+            'id': file.get('id'),
+            'nome': file.get('name'),
+            'link_visualizacao': file.get('webViewLink'),
+            'link_download': file.get('webContentLink'),
+            'tamanho_bytes': int(file.get('size', 0)),
+            'modificado': file.get('modifiedTime'),
+            'acao': 'ATUALIZADO'
+        }
+    else:
         if folder_id:
-            query = f"name = '{nome_arquivo}' and '{folder_id}' in parents and trashed = false"
-        
-        list_params = {
-            'q': query,
-            'spaces': 'drive',
-            'fields': 'files(id, name)',
-            'supportsAllDrives': True,
-            'includeItemsFromAllDrives': True
+            file_metadata['parents'] = [folder_id]
+        
+        file = criar_arquivo_idempotente(service, folder_id, chave, **upload_params)
+        
+        resultado = {
+            'id': file.get('id'),
+            'nome': file.get('name'),
+            'link_visualizacao': file.get('webViewLink'),
+            'link_download': file.get('webContentLink'),
+            'tamanho_bytes': int(file.get('size', 0)),
+            'criado': file.get('createdTime'),
+            'acao': 'CRIADO'
         }
-        
-        if is_streamlit_cloud():
-            list_params['corpora'] = 'drive'
-            list_params['driveId'] = SHARED_DRIVE_ID
-        
-        results = service.files().list(**list_params).execute()
-        arquivos = results.get('files', [])
-        
-        if arquivos:
-            arquivo_id = arquivos[0]['id']
-            request = service.files().get_media(fileId=arquivo_id, supportsAllDrives=True)
-            
-            with tempfile.NamedTemporaryFile(suffix=os.path.splitext(nome_arquivo)[1], delete=False) as temp_file:
-                caminho_temp = temp_file.name
-                fh = BytesIO()
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while done is False:
-                    status, done = downloader.next_chunk()
-                
-                with open(caminho_temp, 'wb') as f:
-                    f.write(fh.getvalue())
-            
-            return caminho_temp
-        else:
-            return None
-            
-    except Exception as e:
-        st.error(f"❌ Erro ao baixar arquivo do Drive: {str(e)}")
-        return None
+    
+    obter_cache_ids_drive().definir(folder_id, nome_arquivo, {
+        'id': file.get('id'),
+        'name': file.get('name', nome_arquivo),
+        'parents': [folder_id] if folder_id else file.get('parents', []),
+        'md5Checksum': file.get('md5Checksum', md5_local),
+        'chave_envio': chave
+    })
+    
+    return resultado
 
-# ========== FUNÇÃO PARA CARREGAR SENHAS DO GOOGLE DRIVE (CORRIGIDA) ==========
-@st.cache_data(ttl=300)  # Cache de 5 minutos
-def carregar_senhas_do_drive(_service):
+def baixar_buffer(request, nome_operacao='files.get_media'):
     """
-    Carrega o arquivo de senhas do Google Drive e retorna um dicionário
-    com matrícula como chave e senha como valor
-    O parâmetro _service tem underscore para não ser hasheado pelo cache
+    Baixa a mídia de `request` em blocos de DRIVE_DOWNLOAD_CHUNK. O conteúdo fica
+    em memória até DRIVE_DOWNLOAD_LIMITE_MEMORIA e, acima disso, em arquivo temporário.
     """
+    buffer = tempfile.SpooledTemporaryFile(max_size=DRIVE_DOWNLOAD_LIMITE_MEMORIA)
     try:
-        if not _service:
-            return None
-        
-        caminho_temp = baixar_arquivo_do_drive(_service, SENHAS_FILENAME, GOOGLE_DRIVE_FOLDER_ID)
-        
-        if not caminho_temp:
-            return None
-        
-        # Lê o arquivo Excel
-        df = pd.read_excel(caminho_temp, sheet_name='DADOS FISCAIS')
-        
-        # Remove arquivo temporário
-        try:
-            os.unlink(caminho_temp)
-        except:
-            pass
-        
-        # Verifica se as colunas necessárias existem
-        colunas_necessarias = ['MATRICULA', 'SENHA']
-        for coluna in colunas_necessarias:
-            if coluna not in df.columns:
-                st.error(f"Coluna '{coluna}' não encontrada no arquivo Senhas.xlsx")
-                return None
-        
-        # Converte matrícula para string e remove espaços
-        df['MATRICULA'] = df['MATRICULA'].astype(str).str.strip()
-        df['SENHA'] = df['SENHA'].astype(str).str.strip()
-        
-        # Filtra linhas com dados válidos
-        df = df[df['MATRICULA'].notna() & (df['MATRICULA'] != '') & 
-                df['SENHA'].notna() & (df['SENHA'] != '')]
-        
-        # Cria dicionário de senhas
-        senhas_dict = {}
-        for _, row in df.iterrows():
-            matricula = str(row['MATRICULA']).strip()
-            senhas_dict[matricula] = str(row['SENHA']).strip()
-        
-        return senhas_dict
-        
-    except Exception as e:
-        st.error(f"❌ Erro ao carregar senhas do Drive: {str(e)}")
-        return None
+        with medir_etapa('drive.download', operacao=nome_operacao) as span:
+            downloader = MediaIoBaseDownload(buffer, request, chunksize=DRIVE_DOWNLOAD_CHUNK)
+            done = False
+            while done is False:
+                status, done = executar_com_retentativa(downloader.next_chunk, nome_operacao)
+            span['bytes'] = buffer.tell()
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
 
-# ========== FUNÇÃO PARA VERIFICAR CREDENCIAIS ==========
-def verificar_credenciais(matricula, senha, senhas_dict):
+def baixar_buffer_por_id(service, arquivo_id):
+    """Baixa o conteúdo de um arquivo do Drive a partir do ID"""
+    return baixar_buffer(service.files().get_media(fileId=arquivo_id, supportsAllDrives=True))
+
+# ========== CACHE LOCAL DE DOWNLOADS DO DRIVE ==========
+class CacheDownloadsDrive:
     """
-    Verifica se a matrícula e senha fornecidas correspondem aos dados do arquivo
+    Cache em disco de arquivos do Drive, chaveado por fileId + versão
+    (md5Checksum ou headRevisionId). Guarda os bytes e o objeto já interpretado
+    (DataFrame/dict) e sobrevive a reinícios do app.
+    Os objetos são gravados com pickle; por isso o cache só é usado se a pasta
+    for privada do usuário (ver pasta_privada). Caso contrário, cada leitura
+    baixa e interpreta o arquivo sem tocar o disco.
     """
-    if not senhas_dict:
-        return False, "Erro ao carregar dados de senha"
-    
-    # Formata a matrícula para busca (remover zeros à esquerda para comparar)
-    matricula_busca = matricula.lstrip('0')
-    
-    # Tenta encontrar a matrícula no dicionário
-    for matricula_registro, senha_registro in senhas_dict.items():
-        matricula_registro_limpa = matricula_registro.lstrip('0')
-        
-        if matricula_busca == matricula_registro_limpa:
-            if senha == senha_registro:
-                return True, "Credenciais válidas"
-            else:
-                return False, "Senha incorreta"
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self._lock = threading.Lock()
+        self._downloads = {}
+        os.makedirs(pasta, mode=0o700, exist_ok=True)
+        # Pastas criadas por versões anteriores do app tinham permissões padrão
+        for caminho in (os.path.dirname(os.path.abspath(pasta)), pasta):
+            restringir_pasta(caminho)
+        self.ativo = pasta_privada(pasta)
+
+    def _trava_download(self, arquivo_id, versao):
+        """Lock por versão: threads que pedem a mesma versão esperam um único download"""
+        with self._lock:
+            return self._downloads.setdefault((arquivo_id, versao), threading.Lock())
+
+    def _caminho(self, arquivo_id, versao, extensao):
+        versao = re.sub(r'[^A-Za-z0-9_-]', '_', str(versao))
+        return os.path.join(self.pasta, f"{arquivo_id}__{versao}{extensao}")
+
+    def _gravar_atomico(self, caminho, escrever):
+        caminho_tmp = f"{caminho}.{uuid.uuid4().hex}.tmp"
+        try:
+            descritor = os.open(caminho_tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o600)
+            with os.fdopen(descritor, 'wb') as f:
+                escrever(f)
+            os.replace(caminho_tmp, caminho)
+        finally:
+            if os.path.exists(caminho_tmp):
+                os.unlink(caminho_tmp)
+
+    def _remover_versoes_antigas(self, arquivo_id, versao, manter=0):
+        """Remove as outras versões do arquivo, exceto as `manter` gravadas mais recentemente"""
+        prefixo_atual = os.path.basename(self._caminho(arquivo_id, versao, ''))
+        versoes = {}
+        for nome in os.listdir(self.pasta):
+            # Arquivos .tmp são gravações em andamento de outras threads
+            if nome.endswith('.tmp'):
+                continue
+            prefixo = nome.split('.', 1)[0]
+            if nome.startswith(f"{arquivo_id}__") and prefixo != prefixo_atual:
+                caminho = os.path.join(self.pasta, nome)
+                try:
+                    versoes.setdefault(prefixo, []).append((os.path.getmtime(caminho), caminho))
+                except OSError:
+                    pass
+
+        antigas = sorted(versoes.values(), key=lambda arquivos: max(m for m, _ in arquivos), reverse=True)
+        for arquivos in antigas[manter:]:
+            for _, caminho in arquivos:
+                try:
+                    os.unlink(caminho)
+                except OSError:
+                    pass
+
+    def obter(self, arquivo_id, versao, tipo, baixar, interpretar, imutavel=False):
+        """
+        Objeto interpretado da versão indicada. Só chama `baixar()` (que retorna
+        um buffer) se os bytes dessa versão ainda não estiverem no cache.
+        Versões mutáveis (md5Checksum do arquivo) substituem as anteriores; com
+        `imutavel=True` (IDs de revisão) as últimas CACHE_DRIVE_REVISOES_MANTIDAS
+        revisões do arquivo continuam no cache.
+        """
+        if not self.ativo:
+            with baixar() as buffer:
+                return interpretar(buffer)
+
+        caminho_objeto = self._caminho(arquivo_id, versao, f".{tipo}.pkl")
+        caminho_bytes = self._caminho(arquivo_id, versao, ".bin")
+
+        if os.path.exists(caminho_objeto):
+            try:
+                with open(caminho_objeto, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                pass
+
+        trava = self._trava_download(arquivo_id, versao)
+        try:
+            with trava:
+                if not os.path.exists(caminho_bytes):
+                    with baixar() as buffer:
+                        self._gravar_atomico(caminho_bytes, lambda f: shutil.copyfileobj(buffer, f))
+                    self._remover_versoes_antigas(arquivo_id, versao, CACHE_DRIVE_REVISOES_MANTIDAS if imutavel else 0)
+        finally:
+            with self._lock:
+                if self._downloads.get((arquivo_id, versao)) is trava:
+                    del self._downloads[(arquivo_id, versao)]
+
+        try:
+            with open(caminho_bytes, 'rb') as f:
+                objeto = interpretar(f)
+        except FileNotFoundError:
+            # Removido ao baixar em paralelo uma versão mais nova: usa o conteúdo sem cache
+            with baixar() as buffer:
+                return interpretar(buffer)
+
+        try:
+            self._gravar_atomico(caminho_objeto, lambda f: pickle.dump(objeto, f, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            pass
+        return objeto
+
+    def remover_arquivo(self, arquivo_id):
+        """Remove do cache todas as versões do arquivo"""
+        if self.ativo:
+            self._remover_versoes_antigas(arquivo_id, '')
+
+    def obter_derivado(self, nome, versao, montar):
+        """
+        Objeto montado a partir de um ou mais arquivos, sem bytes próprios no cache.
+        `versao` deve combinar as versões de todas as fontes; `montar()` só é
+        chamado quando essa combinação ainda não está em disco.
+        """
+        if not self.ativo:
+            return montar()
+
+        caminho = self._caminho(nome, versao, ".pkl")
+
+        if os.path.exists(caminho):
+            try:
+                with open(caminho, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                pass
+
+        objeto = montar()
+        if objeto is not None:
+            try:
+                self._gravar_atomico(caminho, lambda f: pickle.dump(objeto, f, pickle.HIGHEST_PROTOCOL))
+                self._remover_versoes_antigas(nome, versao)
+            except Exception:
+                pass
+        return objeto
+
+@st.cache_resource
+def obter_cache_downloads_drive():
+    """Cache de downloads único por processo (persistido na pasta de dados do app)"""
+    return CacheDownloadsDrive(get_pasta_dados_app("cache_drive"))
+
+def obter_versao_arquivo_drive(service, arquivo_id):
+    """Versão atual do arquivo (chamada só de metadados, sem baixar o conteúdo)"""
+    meta = executar_drive(service.files().get(
+        fileId=arquivo_id, fields='id, md5Checksum, headRevisionId', supportsAllDrives=True
+    ), 'files.get')
+    return meta.get('md5Checksum') or meta.get('headRevisionId')
+
+def resolver_versao_arquivo_drive(service, nome_arquivo, folder_id):
+    """(arquivo, versão atual) do arquivo do Drive, ou (None, None) se ele não existir"""
+    arquivo = resolver_arquivo_drive(service, nome_arquivo, folder_id)
+    if not arquivo:
+        return None, None
+
+    try:
+        return arquivo, obter_versao_arquivo_drive(service, arquivo['id'])
+    except HttpError as error:
+        if not erro_nao_encontrado(error):
+            raise
+        obter_cache_ids_drive().invalidar(folder_id, nome_arquivo)
+        arquivo = resolver_arquivo_drive(service, nome_arquivo, folder_id, usar_cache=False)
+        if not arquivo:
+            return None, None
+        return arquivo, obter_versao_arquivo_drive(service, arquivo['id'])
+
+def carregar_arquivo_drive_com_cache(service, nome_arquivo, folder_id, tipo, interpretar):
+    """
+    Retorna `interpretar(arquivo)` para o conteúdo atual do arquivo do Drive, ou
+    None se ele não existir. O conteúdo só é baixado quando a versão mudou.
+    """
+    arquivo, versao = resolver_versao_arquivo_drive(service, nome_arquivo, folder_id)
+    if not arquivo:
+        return None
+
+    return obter_cache_downloads_drive().obter(
+        arquivo['id'], versao, tipo,
+        lambda: baixar_buffer_por_id(service, arquivo['id']),
+        interpretar
+    )
+
+# ========== DIRETÓRIO DE AGENTES ==========
+def normalizar_matricula(matricula):
+    """Chave de comparação da matrícula: sem espaços e sem zeros à esquerda"""
+    return str(matricula).strip().lstrip('0')
+
+def _coluna_texto(serie):
+    """Coluna como texto sem espaços nas pontas; células vazias viram ''"""
+    return serie.where(serie.notna(), '').astype(str).str.strip()
+
+def _com_chave_matricula(df):
+    """Acrescenta CHAVE (normalizar_matricula, vetorizado) e descarta matrículas vazias"""
+    df = df[df['MATRICULA'] != '']
+    return df.assign(CHAVE=df['MATRICULA'].str.lstrip('0'))
+
+def _validar_colunas(df, colunas, nome_arquivo):
+    for coluna in colunas:
+        if coluna not in df.columns:
+            raise ValueError(f"Coluna '{coluna}' não encontrada no arquivo {nome_arquivo}")
+
+def ler_senhas(arquivo):
+    """
+    Aba DADOS FISCAIS do Senhas.xlsx: uma linha por matrícula normalizada, com
+    MATRICULA e SENHA como texto. Se duas matrículas coincidem após a
+    normalização, vale a primeira.
+    """
+    # Lidas como texto: senhas numéricas não viram "1234.0" quando há células vazias
+    df = pd.read_excel(arquivo, sheet_name='DADOS FISCAIS', dtype={'MATRICULA': str, 'SENHA': str})
+    _validar_colunas(df, ['MATRICULA', 'SENHA'], SENHAS_FILENAME)
+
+    df = df[df['MATRICULA'].notna() & df['SENHA'].notna()]
+    df = pd.DataFrame({
+        'MATRICULA': df['MATRICULA'].str.strip(),
+        'SENHA': df['SENHA'].str.strip()
+    })
+    df = _com_chave_matricula(df[df['SENHA'] != ''])
+    df = df.drop_duplicates('MATRICULA', keep='last')
+    return df.drop_duplicates('CHAVE', keep='first')
+
+def ler_fiscais(caminho_arquivo=FISCAIS_ARQUIVO):
+    """
+    Aba DADOS FISCAIS do Fiscais.xlsx: NOME, MATRICULA e UNIDADE por matrícula
+    normalizada, ou None se o arquivo não existir
+    """
+    if not os.path.exists(caminho_arquivo):
+        return None
+
+    df = pd.read_excel(caminho_arquivo, sheet_name='DADOS FISCAIS', dtype={'MATRICULA': str})
+    _validar_colunas(df, ['NOME', 'MATRICULA', 'UNIDADE'], os.path.basename(caminho_arquivo))
+
+    df = df[df['MATRICULA'].notna()]
+    df = pd.DataFrame({
+        'NOME': _coluna_texto(df['NOME']),
+        'MATRICULA': df['MATRICULA'].str.strip(),
+        'UNIDADE': _coluna_texto(df['UNIDADE'])
+    })
+    return _com_chave_matricula(df).drop_duplicates('CHAVE', keep='last')
+
+def indexar_agentes(senhas, fiscais=None):
+    """
+    Une senhas e fiscais pela matrícula normalizada. Retorna o índice
+    matrícula normalizada -> {'MATRICULA', 'SENHA', 'NOME', 'UNIDADE', 'MATRICULA_FISCAL'},
+    com os campos do Fiscais.xlsx em None quando o agente não está cadastrado lá.
+    """
+    if fiscais is None:
+        fiscais = pd.DataFrame(columns=['NOME', 'MATRICULA', 'UNIDADE', 'CHAVE'])
+
+    agentes = senhas.merge(
+        fiscais.rename(columns={'MATRICULA': 'MATRICULA_FISCAL'}),
+        on='CHAVE', how='left'
+    )
+    agentes = agentes.astype(object).where(agentes.notna(), None)
+    chaves = agentes.pop('CHAVE')
+    return dict(zip(chaves, agentes.to_dict('records')))
+
+def agente_do_diretorio(registro):
+    """Dados do agente como no Fiscais.xlsx, ou None se ele não estiver cadastrado"""
+    if not registro or registro.get('MATRICULA_FISCAL') is None:
+        return None
+    return {
+        'NOME': registro['NOME'],
+        'MATRICULA': registro['MATRICULA_FISCAL'],
+        'UNIDADE': registro['UNIDADE']
+    }
+
+def versao_fiscais(caminho_arquivo=FISCAIS_ARQUIVO):
+    """md5 do Fiscais.xlsx local (o arquivo é pequeno; ler os bytes é bem mais barato que interpretá-lo)"""
+    if not os.path.exists(caminho_arquivo):
+        return 'ausente'
+    return calcular_hashes_arquivo(caminho_arquivo)[0]
+
+def carregar_fiscais():
+    """
+    Fiscais.xlsx já normalizado (ver ler_fiscais), guardado no cache em disco e
+    chaveado pelo md5 do arquivo: só é interpretado de novo quando muda
+    """
+    versao = f"{DIRETORIO_AGENTES_FORMATO}-{versao_fiscais()}"
+    return obter_cache_downloads_drive().obter_derivado('fiscais', versao, ler_fiscais)
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def _carregar_senhas_versao(_service, arquivo_id, versao):
+    """
+    Senhas de uma versão do Senhas.xlsx. Ficam só na memória do processo (este
+    cache é em memória e o download não passa por arquivo): as senhas nunca são
+    gravadas em disco.
+    """
+    # Cópias gravadas em disco por versões anteriores do app
+    cache = obter_cache_downloads_drive()
+    cache.remover_arquivo(arquivo_id)
+    cache.remover_arquivo('diretorio_agentes')
     
-    return False, "Matrícula não encontrada"
+    with baixar_buffer_por_id(_service, arquivo_id) as buffer:
+        return ler_senhas(buffer)
 
-# ========== FUNÇÃO PARA CARREGAR DADOS DOS FISCAIS ==========
-@st.cache_data(ttl=3600)
-def carregar_dados_fiscais():
+@st.cache_data(ttl=300)  # Cache de 5 minutos
+def carregar_diretorio_agentes(_service):
+    """
+    Diretório de agentes (ver indexar_agentes) a partir do Senhas.xlsx do Drive e do
+    Fiscais.xlsx local, mantido só em memória. Reinícios do app e a expiração deste
+    cache custam uma consulta de metadados ao Drive; o Senhas.xlsx só é baixado de
+    novo quando muda, e o Fiscais.xlsx (lento de interpretar) vem do cache em disco.
+    O parâmetro _service tem underscore para não ser hasheado pelo cache
+    """
     try:
-        caminho_arquivo = os.path.join("Template", "Fiscais.xlsx")
-        if os.path.exists(caminho_arquivo):
-            df = pd.read_excel(caminho_arquivo, sheet_name='DADOS FISCAIS')
-            colunas_necessarias = ['NOME', 'MATRICULA', 'UNIDADE']
-            for coluna in colunas_necessarias:
-                if coluna not in df.columns:
-                    st.error(f"Coluna '{coluna}' não encontrada no arquivo Fiscais.xlsx")
-                    return None
-            df['MATRICULA'] = df['MATRICULA'].astype(str).str.strip()
-            df = df[df['MATRICULA'].notna() & (df['MATRICULA'] != '')]
-            dados_fiscais = {}
-            for _, row in df.iterrows():
-                matricula = str(row['MATRICULA']).strip()
-                dados_fiscais[matricula] = {
-                    'NOME': str(row['NOME']).strip() if pd.notna(row['NOME']) else '',
-                    'MATRICULA': matricula,
-                    'UNIDADE': str(row['UNIDADE']).strip() if pd.notna(row['UNIDADE']) else ''
-                }
-            return dados_fiscais
-        else:
+        if not _service:
+            return None
+        
+        arquivo, versao_senhas = resolver_versao_arquivo_drive(_service, SENHAS_FILENAME, GOOGLE_DRIVE_FOLDER_ID)
+        if not arquivo:
             return None
+        
+        senhas = _carregar_senhas_versao(_service, arquivo['id'], versao_senhas)
+        return indexar_agentes(senhas, carregar_fiscais())
+        
     except Exception as e:
-        st.error(f"Erro ao carregar dados dos fiscais: {str(e)}")
+        st.error(f"❌ Erro ao carregar diretório de agentes: {str(e)}")
         return None
 
+# ========== FUNÇÃO PARA VERIFICAR CREDENCIAIS ==========
+def verificar_credenciais(matricula, senha, diretorio_agentes):
+    """
+    Verifica se a matrícula e senha fornecidas correspondem aos dados do arquivo
+    """
+    if not diretorio_agentes:
+        return False, "Erro ao carregar dados de senha"
+    
+    # O índice é chaveado pela matrícula sem zeros à esquerda
+    registro = diretorio_agentes.get(normalizar_matricula(matricula))
+    
+    if registro is None:
+        return False, "Matrícula não encontrada"
+    
+    if senha == registro['SENHA']:
+        return True, "Credenciais válidas"
+    return False, "Senha incorreta"
+
 # ========== CLASSE CONTADOR DE RELATÓRIOS MELHORADA ==========
-class ContadorRelatorios:
-    def __init__(self, service=None, folder_id=GOOGLE_DRIVE_FOLDER_ID, arquivo_contador=CONTADOR_FILENAME):
+class EstadoCompartilhadoDrive:
+    """
+    Arquivo JSON pequeno no Drive atualizado por vários processos.
+    
+    A gravação é um compare-and-swap sobre as revisões do arquivo: só vale se a
+    revisão imediatamente anterior à nossa for a revisão lida. Cada gravação leva
+    no campo DRIVE_CAMPO_CAS a revisão-base e o hash dos dados, de modo que
+    qualquer leitor reconhece (e ignora) as revisões que perderam a disputa.
+    """
+    def __init__(self, service, folder_id, nome_arquivo):
         self.service = service
         self.folder_id = folder_id
-        self.arquivo_contador = arquivo_contador
-        self.contadores = self.carregar_contadores()
+        self.nome_arquivo = nome_arquivo
     
-    def carregar_contadores(self):
-        """Carrega os contadores do Google Drive ou cria um novo"""
-        if self.service:
-            caminho_temp = baixar_arquivo_do_drive(self.service, self.arquivo_contador, self.folder_id)
-            if caminho_temp:
-                try:
-                    with open(caminho_temp, 'r') as f:
-                        contadores = json.load(f)
-                    os.unlink(caminho_temp)
-                    return contadores
-                except Exception as e:
-                    pass
+    def carregar(self):
+        """
+        Lê o conteúdo da revisão válida mais recente.
+        Retorna (arquivo_id, dados, revisao) — revisao é a mais recente do
+        arquivo (a base do próximo compare-and-swap); arquivo_id None se não existir.
+        """
+        arquivo = resolver_arquivo_drive(self.service, self.nome_arquivo, self.folder_id)
+        if not arquivo:
+            return None, {}, None
         
+        try:
+            revisoes = self._listar_revisoes(arquivo['id'])
+        except HttpError as error:
+            if not erro_nao_encontrado(error):
+                raise
+            obter_cache_ids_drive().invalidar(self.folder_id, self.nome_arquivo)
+            arquivo = resolver_arquivo_drive(self.service, self.nome_arquivo, self.folder_id, usar_cache=False)
+            if not arquivo:
+                return None, {}, None
+            revisoes = self._listar_revisoes(arquivo['id'])
+        
+        if not revisoes:
+            return arquivo['id'], {}, None
+        return arquivo['id'], self._dados_validos(arquivo['id'], revisoes), revisoes[-1]
+    
+    @staticmethod
+    def _hash_dados(dados):
+        valores = {k: v for k, v in dados.items() if k != DRIVE_CAMPO_CAS}
+        return hashlib.sha256(json.dumps(valores, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+    
+    def _revisao_valida(self, dados, revisao_anterior):
+        """
+        Uma revisão vale se foi gravada sobre a revisão que a precede. Revisões
+        sem DRIVE_CAMPO_CAS coerente vêm de versões do app sem compare-and-swap
+        e valem como estão.
+        """
+        cas = dados.get(DRIVE_CAMPO_CAS)
+        if not isinstance(cas, dict) or cas.get('hash') != self._hash_dados(dados):
+            return True
+        return cas.get('base') == revisao_anterior
+    
+    def _dados_validos(self, arquivo_id, revisoes):
+        """
+        Dados da revisão válida mais recente. As revisões posteriores a ela
+        perderam o compare-and-swap e são descartadas.
+        """
+        lidas = []
+        for posicao in range(len(revisoes) - 1, -1, -1):
+            dados = self._ler_revisao(arquivo_id, revisoes[posicao])
+            anterior = revisoes[posicao - 1] if posicao > 0 else None
+            if self._revisao_valida(dados, anterior):
+                return dados
+            lidas.append(dados)
+        return self._mesclar_revisoes(lidas)
+    
+    def _mesclar_revisoes(self, lidas):
+        """
+        Estado usado quando nenhuma revisão retida pelo Drive é válida (as antigas
+        já foram descartadas). `lidas` vem da mais recente para a mais antiga.
+        """
         return {}
     
-    def salvar_contadores(self):
-        """Salva os contadores no Google Drive"""
-        if not self.service:
-            return False
+    def _ler_revisao(self, arquivo_id, revisao_id):
+        """Conteúdo exato de uma revisão do arquivo"""
+        def _interpretar(arquivo):
+            try:
+                return json.load(arquivo)
+            except ValueError:
+                return {}
+        
+        # Revisões são imutáveis: cada uma é baixada no máximo uma vez
+        dados = obter_cache_downloads_drive().obter(
+            arquivo_id, revisao_id, 'estado',
+            lambda: baixar_buffer(
+                self.service.revisions().get_media(fileId=arquivo_id, revisionId=revisao_id),
+                'revisions.get_media'
+            ),
+            _interpretar,
+            imutavel=True
+        )
+        return dados if isinstance(dados, dict) else {}
+    
+    def _listar_revisoes(self, arquivo_id):
+        revisoes = []
+        page_token = None
+        while True:
+            params = {'fileId': arquivo_id, 'fields': 'nextPageToken, revisions(id)', 'pageSize': 1000}
+            if page_token:
+                params['pageToken'] = page_token
+            resultado = executar_drive(self.service.revisions().list(**params), 'revisions.list')
+            revisoes.extend(r['id'] for r in resultado.get('revisions', []))
+            page_token = resultado.get('nextPageToken')
+            if not page_token:
+                return revisoes
+    
+    def _gravar(self, arquivo_id, dados):
+        """
+        Cria ou atualiza o arquivo. Retorna (arquivo_id, nova_revisao); nova_revisao
+        é None se outro processo criou o arquivo ao mesmo tempo e o dele prevaleceu.
+        """
+        conteudo = json.dumps(dados).encode('utf-8')
+        media = MediaIoBaseUpload(BytesIO(conteudo), mimetype='application/json', resumable=False)
+        
+        if arquivo_id:
+            file = executar_drive(self.service.files().update(
+                fileId=arquivo_id, media_body=media,
+                fields='id, headRevisionId', supportsAllDrives=True
+            ), 'files.update')
+            return file['id'], file.get('headRevisionId')
+        
+        chave = chave_idempotencia(self.nome_arquivo, hashlib.sha256(conteudo).hexdigest())
+        file_metadata = {'name': self.nome_arquivo, 'appProperties': {DRIVE_PROP_IDEMPOTENCIA: chave}}
+        if self.folder_id:
+            file_metadata['parents'] = [self.folder_id]
+        file = criar_arquivo_idempotente(
+            self.service, self.folder_id, chave,
+            body=file_metadata, media_body=media,
+            fields='id, headRevisionId', supportsAllDrives=True
+        )
         
-        try:
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
-                json.dump(self.contadores, temp_file)
-                temp_path = temp_file.name
-            
-            resultado = upload_para_google_drive(
-                caminho_arquivo=temp_path,
-                nome_arquivo=self.arquivo_contador,
-                service=self.service,
-                folder_id=self.folder_id
-            )
+        # Criação concorrente: vale o arquivo mais antigo com o nome
+        existente = resolver_arquivo_drive(self.service, self.nome_arquivo, self.folder_id, usar_cache=False)
+        if existente and existente['id'] != file['id']:
+            try:
+                executar_drive(self.service.files().delete(fileId=file['id'], supportsAllDrives=True), 'files.delete')
+            except HttpError:
+                pass
+            return existente['id'], None
+        return file['id'], file.get('headRevisionId')
+    
+    def gravar_se_inalterado(self, arquivo_id, dados, revisao_base):
+        """
+        Grava `dados` sobre `revisao_base` (compare-and-swap).
+        Retorna (arquivo_id, venceu) — venceu é False se outro processo gravou
+        depois da leitura; nesse caso a gravação não vale para nenhum leitor.
+        """
+        dados = {k: v for k, v in dados.items() if k != DRIVE_CAMPO_CAS}
+        dados[DRIVE_CAMPO_CAS] = {'base': revisao_base, 'hash': self._hash_dados(dados)}
+        
+        arquivo_id, nova_revisao = self._gravar(arquivo_id, dados)
+        if nova_revisao is None:
+            return arquivo_id, False
+        
+        revisoes = self._listar_revisoes(arquivo_id)
+        posicao = revisoes.index(nova_revisao) if nova_revisao in revisoes else len(revisoes)
+        anterior = revisoes[posicao - 1] if posicao > 0 else None
+        return arquivo_id, anterior == revisao_base
+
+class ContadorRelatorios(EstadoCompartilhadoDrive):
+    """
+    Alocador de números de relatório seguro para sessões concorrentes.
+    
+    Cada sessão reserva no Drive um bloco de números por chave ANO_MATRICULA e
+    consome o bloco localmente, sem acesso à rede. A reserva é um compare-and-swap
+    sobre o arquivo de contadores (ver EstadoCompartilhadoDrive). Em conflito a
+    reserva é refeita com espera exponencial; se não houver reserva, nenhum número
+    é emitido. Números não usados de um bloco viram lacunas, nunca duplicatas.
+    """
+    def __init__(self, service=None, folder_id=GOOGLE_DRIVE_FOLDER_ID, arquivo_contador=CONTADOR_FILENAME,
+                 tamanho_bloco=CONTADOR_TAMANHO_BLOCO):
+        super().__init__(service, folder_id, arquivo_contador)
+        self.tamanho_bloco = max(1, int(tamanho_bloco))
+        self.blocos = {}
+    
+    def carregar_contadores(self):
+        """Lê os contadores do Drive. Retorna (arquivo_id, contadores, revisao)"""
+        return self.carregar()
+    
+    def _mesclar_revisoes(self, lidas):
+        # Revisões perdedoras nunca tiveram o bloco usado: o máximo por chave é seguro
+        mesclado = {}
+        for contadores in lidas:
+            for k, v in contadores.items():
+                if k != DRIVE_CAMPO_CAS:
+                    mesclado[k] = max(int(mesclado.get(k, 0)), int(v))
+        return mesclado
+    
+    def _reservar_bloco(self, chave):
+        """Reserva no Drive o próximo bloco da chave. Retorna [inicio, fim]"""
+        for tentativa in range(CONTADOR_MAX_TENTATIVAS):
+            if tentativa:
+                # Conflito: outra sessão gravou entre a leitura e a escrita
+                espera = min(CONTADOR_ESPERA_MAXIMA, CONTADOR_ESPERA_BASE * (2 ** (tentativa - 1)))
+                time.sleep(random.uniform(0, espera))
             
-            os.unlink(temp_path)
-            return resultado is not None
+            arquivo_id, contadores, revisao_base = self.carregar_contadores()
+            ultimo = int(contadores.get(chave, 0))
+            novos_contadores = dict(contadores)
+            novos_contadores[chave] = ultimo + self.tamanho_bloco
             
-        except Exception as e:
-            return False
+            _, venceu = self.gravar_se_inalterado(arquivo_id, novos_contadores, revisao_base)
+            if venceu:
+                return [ultimo + 1, ultimo + self.tamanho_bloco]
+        
+        raise RuntimeError("Não foi possível reservar números de relatório (conflitos sucessivos)")
     
     def gerar_novo_numero(self, matricula):
         """
-        Gera um novo número de relatório de forma atômica
-        Retorna o número gerado e atualiza o contador permanentemente
+        Gera um novo número de relatório.
+        Usa o bloco reservado pela sessão; só acessa o Drive quando o bloco acaba.
+        Sem reserva no Drive levanta RuntimeError: numerar localmente repetiria
+        números já emitidos por outras sessões.
         """
         ano = datetime.now().strftime("%Y")
         matricula_formatada = matricula.zfill(4)
         chave = f"{ano}_{matricula_formatada}"
         
-        # Obtém o próximo número disponível
-        if chave in self.contadores:
-            proximo_numero = self.contadores[chave] + 1
-        else:
-            proximo_numero = 1
+        if not self.service:
+            raise RuntimeError("Sem conexão com o Google Drive para reservar o número do relatório")
         
-        # ATUALIZA o contador (número é realmente usado)
-        self.contadores[chave] = proximo_numero
+        bloco = self.blocos.get(chave)
+        if bloco is None or bloco[0] > bloco[1]:
+            self.blocos.pop(chave, None)
+            bloco = self._reservar_bloco(chave)
+            self.blocos[chave] = bloco
         
-        # Salva no Drive imediatamente
-        if self.service:
-            self.salvar_contadores()
+        proximo_numero = bloco[0]
+        bloco[0] += 1
         
         contador_formatado = str(proximo_numero).zfill(4)
         
@@ -705,46 +1751,6 @@ def inicializar_planilha_master():
         'NUM_PAVIMENTOS', 'QUANTIFICACAO', 'UNIDADE_MEDIDA', 'UNIDADE_MEDIDA_OUTROS',
         'NATUREZA', 'NATUREZA_OUTROS',
         'TIPO_CONSTRUCAO', 'TIPO_CONSTRUCAO_OUTROS',
-        'CONTRATADO_01_MESMO_CONTRATANTE',
-        'CONTRATADO_01_NOME_CONTRATANTE', 'CONTRATADO_01_REGISTRO_CONTRATANTE', 'CONTRATADO_01_CPF_CNPJ_CONTRATANTE',
-        'CONTRATADO_01_CONTRATADO_PF_PJ', 'CONTRATADO_01_REGISTRO', 'CONTRATADO_01_CPF_CNPJ',
-        'CONTRATADO_01_PROFISSIONAL', 'CONTRATADO_01_IDENTIFICACAO_FISCALIZADO',
-        'CONTRATADO_01_NUMERO_ART', 'CONTRATADO_01_NUMERO_RRT', 'CONTRATADO_01_NUMERO_TRT',
-        'CONTRATADO_01_RAMO_ATIVIDADE', 'CONTRATADO_01_SERVICO_EXECUTADO', 'CONTRATADO_01_SERVICO_OUTROS',
-        'CONTRATADO_01_FONTE_INFORMACAO', 'CONTRATADO_01_QUALIFICACAO_FONTE', 'CONTRATADO_01_QUALIFICACAO_OUTROS',
-        'CONTRATADO_01_SITUACAO_CONTRATADO', 'CONTRATADO_01_TIPO_INFRACAO_CONTRATADO', 'CONTRATADO_01_INFRACOES_CONTRATADO',
-        'CONTRATADO_02_MESMO_CONTRATANTE',
-        'CONTRATADO_02_NOME_CONTRATANTE', 'CONTRATADO_02_REGISTRO_CONTRATANTE', 'CONTRATADO_02_CPF_CNPJ_CONTRATANTE',
-        'CONTRATADO_02_CONTRATADO_PF_PJ', 'CONTRATADO_02_REGISTRO', 'CONTRATADO_02_CPF_CNPJ',
-        'CONTRATADO_02_PROFISSIONAL', 'CONTRATADO_02_IDENTIFICACAO_FISCALIZADO',
-        'CONTRATADO_02_NUMERO_ART', 'CONTRATADO_02_NUMERO_RRT', 'CONTRATADO_02_NUMERO_TRT',
-        'CONTRATADO_02_RAMO_ATIVIDADE', 'CONTRATADO_02_SERVICO_EXECUTADO', 'CONTRATADO_02_SERVICO_OUTROS',
-        'CONTRATADO_02_FONTE_INFORMACAO', 'CONTRATADO_02_QUALIFICACAO_FONTE', 'CONTRATADO_02_QUALIFICACAO_OUTROS',
-        'CONTRATADO_02_SITUACAO_CONTRATADO', 'CONTRATADO_02_TIPO_INFRACAO_CONTRATADO', 'CONTRATADO_02_INFRACOES_CONTRATADO',
-        'CONTRATADO_03_MESMO_CONTRATANTE',
-        'CONTRATADO_03_NOME_CONTRATANTE', 'CONTRATADO_03_REGISTRO_CONTRATANTE', 'CONTRATADO_03_CPF_CNPJ_CONTRATANTE',
-        'CONTRATADO_03_CONTRATADO_PF_PJ', 'CONTRATADO_03_REGISTRO', 'CONTRATADO_03_CPF_CNPJ',
-        'CONTRATADO_03_PROFISSIONAL', 'CONTRATADO_03_IDENTIFICACAO_FISCALIZADO',
-        'CONTRATADO_03_NUMERO_ART', 'CONTRATADO_03_NUMERO_RRT', 'CONTRATADO_03_NUMERO_TRT',
-        'CONTRATADO_03_RAMO_ATIVIDADE', 'CONTRATADO_03_SERVICO_EXECUTADO', 'CONTRATADO_03_SERVICO_OUTROS',
-        'CONTRATADO_03_FONTE_INFORMACAO', 'CONTRATADO_03_QUALIFICACAO_FONTE', 'CONTRATADO_03_QUALIFICACAO_OUTROS',
-        'CONTRATADO_03_SITUACAO_CONTRATADO', 'CONTRATADO_03_TIPO_INFRACAO_CONTRATADO', 'CONTRATADO_03_INFRACOES_CONTRATADO',
-        'CONTRATADO_04_MESMO_CONTRATANTE',
-        'CONTRATADO_04_NOME_CONTRATANTE', 'CONTRATADO_04_REGISTRO_CONTRATANTE', 'CONTRATADO_04_CPF_CNPJ_CONTRATANTE',
-        'CONTRATADO_04_CONTRATADO_PF_PJ', 'CONTRATADO_04_REGISTRO', 'CONTRATADO_04_CPF_CNPJ',
-        'CONTRATADO_04_PROFISSIONAL', 'CONTRATADO_04_IDENTIFICACAO_FISCALIZADO',
-        'CONTRATADO_04_NUMERO_ART', 'CONTRATADO_04_NUMERO_RRT', 'CONTRATADO_04_NUMERO_TRT',
-        'CONTRATADO_04_RAMO_ATIVIDADE', 'CONTRATADO_04_SERVICO_EXECUTADO', 'CONTRATADO_04_SERVICO_OUTROS',
-        'CONTRATADO_04_FONTE_INFORMACAO', 'CONTRATADO_04_QUALIFICACAO_FONTE', 'CONTRATADO_04_QUALIFICACAO_OUTROS',
-        'CONTRATADO_04_SITUACAO_CONTRATADO', 'CONTRATADO_04_TIPO_INFRACAO_CONTRATADO', 'CONTRATADO_04_INFRACOES_CONTRATADO',
-        'CONTRATADO_05_MESMO_CONTRATANTE',
-        'CONTRATADO_05_NOME_CONTRATANTE', 'CONTRATADO_05_REGISTRO_CONTRATANTE', 'CONTRATADO_05_CPF_CNPJ_CONTRATANTE',
-        'CONTRATADO_05_CONTRATADO_PF_PJ', 'CONTRATADO_05_REGISTRO', 'CONTRATADO_05_CPF_CNPJ',
-        'CONTRATADO_05_PROFISSIONAL', 'CONTRATADO_05_IDENTIFICACAO_FISCALIZADO',
-        'CONTRATADO_05_NUMERO_ART', 'CONTRATADO_05_NUMERO_RRT', 'CONTRATADO_05_NUMERO_TRT',
-        'CONTRATADO_05_RAMO_ATIVIDADE', 'CONTRATADO_05_SERVICO_EXECUTADO', 'CONTRATADO_05_SERVICO_OUTROS',
-        'CONTRATADO_05_FONTE_INFORMACAO', 'CONTRATADO_05_QUALIFICACAO_FONTE', 'CONTRATADO_05_QUALIFICACAO_OUTROS',
-        'CONTRATADO_05_SITUACAO_CONTRATADO', 'CONTRATADO_05_TIPO_INFRACAO_CONTRATADO', 'CONTRATADO_05_INFRACOES_CONTRATADO',
         'TOTAL_CONTRATADOS_REGISTROS',
         'DOCUMENTOS_SOLICITADOS', 'DOCUMENTOS_SOLICITADOS_OFICIO_NUMERO',
         'DOCUMENTOS_SOLICITADOS_QUADRO_TECNICO', 'DOCUMENTOS_SOLICITADOS_PRESTADORES',
@@ -762,67 +1768,777 @@ def inicializar_planilha_master():
         'DATA_GERACAO'
     ]
     
-    df = pd.DataFrame(columns=colunas)
+    return pd.DataFrame(columns=colunas)
+
+def sincronizar_planilha_master_drive(service, folder_id, incluir_journal=True, data_inicio=None, data_fim=None):
+    """
+    Banco local da Planilha Master, após sincronizá-lo com o Drive.
+    Com `incluir_journal`, inclui também os registros ainda não compactados; com
+    um período, só as partições desse período são consultadas.
+    """
+    try:
+        with medir_etapa('planilha_master.sincronizar'):
+            sincronizar_banco_relatorios(service, folder_id, incluir_journal, data_inicio, data_fim)
+    except Exception as e:
+        st.warning(f"⚠️ Não foi possível sincronizar com a Planilha Master do Drive: {str(e)}")
+
+    return obter_banco_relatorios()
+
+def _carregar_planilha_master_xlsx(service, folder_id, falhar_em_erro=False):
+    try:
+        # Só baixa novamente se a planilha mudou no Drive
+        planilhas = carregar_arquivo_drive_com_cache(service, EXCEL_DATABASE_NAME, folder_id, 'planilha_master',
+                                                     lambda arquivo: pd.read_excel(arquivo, sheet_name=None))
+        if not planilhas:
+            return inicializar_planilha_master(), None
+        # Planilhas antigas têm uma única aba, com os contratados em colunas
+        df = planilhas.get(ABA_RELATORIOS, next(iter(planilhas.values())))
+        return df, planilhas.get(ABA_CONTRATADOS)
+            
+    except Exception as e:
+        if falhar_em_erro:
+            raise
+        st.error(f"❌ Erro ao carregar Planilha Master do Drive: {str(e)}")
+        return inicializar_planilha_master(), None
+
+def tipar_planilha_master(df):
+    """Tipos do snapshot: categorias (codificadas em dicionário no Parquet), inteiros e texto"""
+    df = df.copy()
+    for coluna in df.columns:
+        if coluna in COLUNAS_CATEGORICAS:
+            df[coluna] = df[coluna].astype('string').astype('category')
+        elif coluna in COLUNAS_INTEIRAS:
+            df[coluna] = pd.to_numeric(df[coluna], errors='coerce').astype('Int64')
+        else:
+            df[coluna] = df[coluna].astype('string')
+    return df
+
+def particao_do_registro(registro):
+    """Partição (aaaa-mm) de um registro pela DATA_RELATORIO"""
+    data_iso = _data_relatorio_iso(registro.get('DATA_RELATORIO'))
+    return data_iso[:7] if data_iso else PARTICAO_SEM_DATA
+
+def particao_no_periodo(mes, data_inicio=None, data_fim=None):
+    """Indica se a partição pode conter relatórios do período (poda de partições)"""
+    if mes == PARTICAO_SEM_DATA:
+        return data_inicio is None and data_fim is None
+    if data_inicio and mes < data_inicio.strftime('%Y-%m'):
+        return False
+    if data_fim and mes > data_fim.strftime('%Y-%m'):
+        return False
+    return True
+
+def nome_particao(mes, extensao, contratados=False):
+    sufixo = " - Contratados" if contratados else ""
+    return f"{PLANILHA_MASTER_PREFIXO} {mes}{sufixo}.{extensao}"
+
+def carregar_manifesto_planilha_master(service, folder_id):
+    """Manifesto das partições no Drive ({'particoes': {mes: info}})"""
+    manifesto = carregar_arquivo_drive_com_cache(
+        service, MANIFESTO_PLANILHA_MASTER_NAME, folder_id, 'manifesto', json.load
+    )
+    return manifesto or {'particoes': {}}
+
+def publicar_manifesto_planilha_master(service, folder_id, manifesto):
+    manifesto['atualizado_em'] = datetime.now().isoformat()
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False, encoding='utf-8') as temp_file:
+        caminho = temp_file.name
+        json.dump(manifesto, temp_file, ensure_ascii=False, indent=2)
+    try:
+        return upload_para_google_drive(caminho, MANIFESTO_PLANILHA_MASTER_NAME, service, folder_id)
+    finally:
+        os.unlink(caminho)
+
+def publicar_particao_planilha_master(service, folder_id, banco, mes):
+    """
+    Envia ao Drive a partição do mês gerada a partir do banco (Parquet, ou xlsx
+    sem pyarrow). Retorna a entrada do manifesto ou None em caso de falha.
+    """
+    df = banco.para_dataframe(mes=mes)
+    df_contratados = banco.contratados_dataframe(mes=mes)
+    caminhos = []
+    try:
+        if PARQUET_DISPONIVEL:
+            info = {
+                'formato': 'parquet',
+                'relatorios': nome_particao(mes, 'parquet'),
+                'contratados': nome_particao(mes, 'parquet', contratados=True),
+            }
+            # Relatórios por último: quem vê a nova versão já encontra os contratados atualizados
+            arquivos = ((info['contratados'], df_contratados), (info['relatorios'], df))
+        else:
+            info = {'formato': 'xlsx', 'relatorios': nome_particao(mes, 'xlsx')}
+            arquivos = ((info['relatorios'], None),)
+        
+        versao = hashlib.md5()
+        for nome_arquivo, dados in arquivos:
+            with tempfile.NamedTemporaryFile(suffix=os.path.splitext(nome_arquivo)[1], delete=False) as temp_file:
+                caminhos.append(temp_file.name)
+            if dados is None:
+                gravar_planilha_master_xlsx(caminhos[-1], df, df_contratados)
+            else:
+                tipar_planilha_master(dados).to_parquet(caminhos[-1], index=False)
+            
+            if not upload_para_google_drive(caminhos[-1], nome_arquivo, service, folder_id):
+                return None
+            versao.update(calcular_hashes_arquivo(caminhos[-1])[0].encode())
+        
+        info.update({
+            'versao': versao.hexdigest(),
+            'registros': len(df),
+            'atualizado_em': datetime.now().isoformat()
+        })
+        return info
+    finally:
+        for caminho in caminhos:
+            try:
+                os.unlink(caminho)
+            except OSError:
+                pass
+
+def _carregar_particao_planilha_master(service, folder_id, info):
+    """Retorna (relatorios, contratados) de uma partição do manifesto"""
+    if info.get('formato') == 'parquet':
+        if not PARQUET_DISPONIVEL:
+            raise RuntimeError(f"pyarrow é necessário para ler {info['relatorios']}")
+        df = carregar_arquivo_drive_com_cache(service, info['relatorios'], folder_id, 'parquet', pd.read_parquet)
+        df_contratados = carregar_arquivo_drive_com_cache(
+            service, info['contratados'], folder_id, 'parquet', pd.read_parquet
+        )
+    else:
+        planilhas = carregar_arquivo_drive_com_cache(
+            service, info['relatorios'], folder_id, 'planilha_master',
+            lambda arquivo: pd.read_excel(arquivo, sheet_name=None)
+        ) or {}
+        df = planilhas.get(ABA_RELATORIOS)
+        df_contratados = planilhas.get(ABA_CONTRATADOS)
+    
+    if df is None:
+        raise RuntimeError(f"Partição {info['relatorios']} não encontrada no Drive")
+    return df, df_contratados
+
+def registros_da_planilha_master(df_relatorios, df_contratados=None):
+    """Registros da Planilha Master com a lista CONTRATADOS de cada relatório"""
+    registros = df_relatorios.to_dict('records')
+    if df_contratados is None:
+        return registros
+    
+    por_relatorio = {}
+    for contratado in df_contratados.to_dict('records'):
+        numero = _chave_relatorio(contratado.pop('NUMERO_RELATORIO'))
+        por_relatorio.setdefault(numero, []).append(contratado)
+    for registro in registros:
+        registro['CONTRATADOS'] = por_relatorio.get(_chave_relatorio(registro.get('NUMERO_RELATORIO')), [])
+    return registros
+
+# ========== BANCO LOCAL DE RELATÓRIOS (SQLITE) ==========
+def _chave_relatorio(numero_relatorio):
+    """NUMERO_RELATORIO como texto (a planilha pode trazê-lo como número)"""
+    if isinstance(numero_relatorio, float) and numero_relatorio.is_integer():
+        numero_relatorio = int(numero_relatorio)
+    return str(numero_relatorio).strip()
+
+def _data_relatorio_iso(data_relatorio):
+    """Converte DATA_RELATORIO (dd/mm/aaaa) para aaaa-mm-dd, usado em filtros por período"""
+    if hasattr(data_relatorio, 'strftime'):
+        return data_relatorio.strftime('%Y-%m-%d')
+    try:
+        return datetime.strptime(str(data_relatorio).strip(), '%d/%m/%Y').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+class BancoRelatorios:
+    """
+    Armazena os registros da Planilha Master em SQLite (modo WAL). Cada relatório
+    é uma linha com o registro completo em JSON e as colunas de busca indexadas.
+    """
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._local = threading.local()
+        conexao = self._conexao()
+        conexao.execute("PRAGMA journal_mode=WAL")
+        with conexao:
+            conexao.executescript("""
+                CREATE TABLE IF NOT EXISTS relatorios (
+                    NUMERO_RELATORIO TEXT PRIMARY KEY,
+                    AGENTE_MATRICULA TEXT,
+                    DATA_RELATORIO TEXT,
+                    DATA_RELATORIO_ISO TEXT,
+                    MUNICIPIO TEXT,
+                    CPF_CNPJ_CONTRATANTE TEXT,
+                    REGISTRO TEXT NOT NULL,
+                    ATUALIZADO_EM TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_relatorios_agente ON relatorios (AGENTE_MATRICULA);
+                CREATE INDEX IF NOT EXISTS idx_relatorios_data ON relatorios (DATA_RELATORIO_ISO);
+                CREATE INDEX IF NOT EXISTS idx_relatorios_municipio ON relatorios (MUNICIPIO);
+                CREATE INDEX IF NOT EXISTS idx_relatorios_cpf_cnpj ON relatorios (CPF_CNPJ_CONTRATANTE);
+                CREATE TABLE IF NOT EXISTS contratados (
+                    NUMERO_RELATORIO TEXT NOT NULL,
+                    ORDEM INTEGER NOT NULL,
+                    CPF_CNPJ TEXT,
+                    REGISTRO TEXT,
+                    DADOS TEXT NOT NULL,
+                    PRIMARY KEY (NUMERO_RELATORIO, ORDEM)
+                );
+                CREATE INDEX IF NOT EXISTS idx_contratados_cpf_cnpj ON contratados (CPF_CNPJ);
+                CREATE TABLE IF NOT EXISTS metadados (
+                    CHAVE TEXT PRIMARY KEY,
+                    VALOR TEXT
+                );
+            """)
+        
+        # Registros gravados no formato antigo (contratados em colunas) passam para a tabela própria
+        legados = conexao.execute(
+            "SELECT REGISTRO FROM relatorios WHERE REGISTRO LIKE '%\"CONTRATADO\\_%' ESCAPE '\\'"
+        ).fetchall()
+        if legados:
+            self.salvar_varios([json.loads(linha[0]) for linha in legados])
+
+    def _conexao(self):
+        """Uma conexão por thread (sessões, outbox e compactação usam o banco em paralelo)"""
+        conexao = getattr(self._local, 'conexao', None)
+        if conexao is None:
+            conexao = sqlite3.connect(self.caminho, timeout=30)
+            conexao.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexao = conexao
+        return conexao
+
+    def salvar_varios(self, registros):
+        """
+        Insere ou atualiza (por NUMERO_RELATORIO) os registros. A lista CONTRATADOS
+        (ou as colunas CONTRATADO_NN_* do formato antigo) substitui os contratados do relatório.
+        """
+        agora = datetime.now().isoformat()
+        linhas = []
+        contratados_por_relatorio = {}
+        for registro in registros:
+            registro = {
+                coluna: (None if not isinstance(valor, (list, dict)) and pd.isna(valor) else valor)
+                for coluna, valor in registro.items()
+            }
+            if registro.get('NUMERO_RELATORIO') is None:
+                continue
+            numero = _chave_relatorio(registro['NUMERO_RELATORIO'])
+            registro['NUMERO_RELATORIO'] = numero
+            
+            contratados = registro.pop('CONTRATADOS', None)
+            contratados_largos = extrair_contratados_formato_largo(registro)
+            if contratados is None:
+                contratados = contratados_largos
+            if contratados is not None:
+                contratados_por_relatorio[numero] = contratados
+
+            linhas.append((
+                numero,
+                None if registro.get('AGENTE_MATRICULA') is None else str(registro['AGENTE_MATRICULA']),
+                None if registro.get('DATA_RELATORIO') is None else str(registro['DATA_RELATORIO']),
+                _data_relatorio_iso(registro.get('DATA_RELATORIO')),
+                registro.get('MUNICIPIO'),
+                None if registro.get('CPF_CNPJ_CONTRATANTE') is None else str(registro['CPF_CNPJ_CONTRATANTE']),
+                json.dumps(registro, ensure_ascii=False, default=str),
+                agora
+            ))
+
+        conexao = self._conexao()
+        with conexao:
+            conexao.executemany("""
+                INSERT INTO relatorios (NUMERO_RELATORIO, AGENTE_MATRICULA, DATA_RELATORIO,
+                                        DATA_RELATORIO_ISO, MUNICIPIO, CPF_CNPJ_CONTRATANTE,
+                                        REGISTRO, ATUALIZADO_EM)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (NUMERO_RELATORIO) DO UPDATE SET
+                    AGENTE_MATRICULA = excluded.AGENTE_MATRICULA,
+                    DATA_RELATORIO = excluded.DATA_RELATORIO,
+                    DATA_RELATORIO_ISO = excluded.DATA_RELATORIO_ISO,
+                    MUNICIPIO = excluded.MUNICIPIO,
+                    CPF_CNPJ_CONTRATANTE = excluded.CPF_CNPJ_CONTRATANTE,
+                    REGISTRO = excluded.REGISTRO,
+                    ATUALIZADO_EM = excluded.ATUALIZADO_EM
+            """, linhas)
+            
+            for numero, contratados in contratados_por_relatorio.items():
+                conexao.execute("DELETE FROM contratados WHERE NUMERO_RELATORIO = ?", (numero,))
+                conexao.executemany(
+                    "INSERT INTO contratados (NUMERO_RELATORIO, ORDEM, CPF_CNPJ, REGISTRO, DADOS) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (
+                            numero,
+                            int(contratado.get('ORDEM') or ordem),
+                            None if contratado.get('CPF_CNPJ') is None else str(contratado['CPF_CNPJ']),
+                            None if contratado.get('REGISTRO') is None else str(contratado['REGISTRO']),
+                            json.dumps(contratado, ensure_ascii=False, default=str)
+                        )
+                        for ordem, contratado in enumerate(contratados, start=1)
+                    ]
+                )
+        return len(linhas)
+
+    def salvar(self, registro):
+        return self.salvar_varios([registro])
+
+    def obter(self, numero_relatorio):
+        linha = self._conexao().execute(
+            "SELECT REGISTRO FROM relatorios WHERE NUMERO_RELATORIO = ?",
+            (_chave_relatorio(numero_relatorio),)
+        ).fetchone()
+        return json.loads(linha[0]) if linha else None
+
+    def _filtros(self, matricula=None, municipio=None, cpf_cnpj=None, data_inicio=None, data_fim=None, mes=None):
+        """
+        Cláusula WHERE (sobre a tabela relatorios, alias r) e parâmetros.
+        Datas em date/datetime; `mes` no formato aaaa-mm (ou PARTICAO_SEM_DATA).
+        """
+        condicoes, parametros = [], []
+        if mes == PARTICAO_SEM_DATA:
+            condicoes.append("r.DATA_RELATORIO_ISO IS NULL")
+        elif mes:
+            condicoes.append("r.DATA_RELATORIO_ISO >= ? AND r.DATA_RELATORIO_ISO < ?")
+            parametros.extend([f"{mes}-01", f"{mes}-32"])
+        if matricula:
+            condicoes.append("r.AGENTE_MATRICULA = ?")
+            parametros.append(str(matricula))
+        if municipio:
+            condicoes.append("r.MUNICIPIO = ?")
+            parametros.append(municipio)
+        if cpf_cnpj:
+            condicoes.append("r.CPF_CNPJ_CONTRATANTE = ?")
+            parametros.append(str(cpf_cnpj))
+        if data_inicio:
+            condicoes.append("r.DATA_RELATORIO_ISO >= ?")
+            parametros.append(data_inicio.strftime('%Y-%m-%d'))
+        if data_fim:
+            condicoes.append("r.DATA_RELATORIO_ISO <= ?")
+            parametros.append(data_fim.strftime('%Y-%m-%d'))
+        return (" WHERE " + " AND ".join(condicoes)) if condicoes else "", parametros
+
+    def _percorrer(self, sql, parametros):
+        """Linhas da consulta lidas do cursor em lotes de PLANILHA_EXPORTACAO_LOTE"""
+        cursor = self._conexao().execute(sql, parametros)
+        try:
+            while True:
+                linhas = cursor.fetchmany(PLANILHA_EXPORTACAO_LOTE)
+                if not linhas:
+                    return
+                yield from linhas
+        finally:
+            cursor.close()
+
+    def listar(self, limite=None, **filtros):
+        """
+        Registros (na ordem de inclusão) que atendem aos filtros, lidos sob demanda.
+        Com `limite`, só os `limite` mais recentes.
+        """
+        where, parametros = self._filtros(**filtros)
+        sql = f"SELECT r.rowid AS ordem, r.REGISTRO FROM relatorios r{where} ORDER BY ordem"
+        if limite is not None:
+            sql = f"SELECT * FROM ({sql} DESC LIMIT ?) ORDER BY ordem"
+            parametros = parametros + [int(limite)]
+        for _, registro in self._percorrer(sql, parametros):
+            yield json.loads(registro)
+
+    def listar_contratados(self, **filtros):
+        """Contratados dos relatórios que atendem aos filtros, um por linha, lidos sob demanda"""
+        where, parametros = self._filtros(**filtros)
+        sql = (
+            "SELECT c.NUMERO_RELATORIO, c.DADOS FROM contratados c "
+            f"JOIN relatorios r ON r.NUMERO_RELATORIO = c.NUMERO_RELATORIO{where} "
+            "ORDER BY r.rowid, c.ORDEM"
+        )
+        for numero, dados in self._percorrer(sql, parametros):
+            yield {'NUMERO_RELATORIO': numero, **json.loads(dados)}
+
+    def contratados_por_relatorio(self, numeros):
+        """Contratados dos relatórios indicados: {numero: {ordem: contratado}}"""
+        contratados = {}
+        numeros = list(numeros)
+        for inicio in range(0, len(numeros), 500):
+            parte = numeros[inicio:inicio + 500]
+            sql = (
+                "SELECT NUMERO_RELATORIO, ORDEM, DADOS FROM contratados "
+                f"WHERE NUMERO_RELATORIO IN ({', '.join('?' * len(parte))})"
+            )
+            for numero, ordem, dados in self._conexao().execute(sql, parte):
+                contratados.setdefault(numero, {})[ordem] = json.loads(dados)
+        return contratados
+
+    def colunas_relatorios(self, **filtros):
+        """Colunas da aba de relatórios: as da Planilha Master e as extras, na ordem em que aparecem"""
+        colunas = dict.fromkeys(inicializar_planilha_master().columns)
+        for registro in self.listar(**filtros):
+            colunas.update(dict.fromkeys(registro))
+        return list(colunas)
+
+    def maximo_contratados(self, **filtros):
+        """Maior quantidade de contratados de um relatório que atende aos filtros"""
+        where, parametros = self._filtros(**filtros)
+        sql = (
+            "SELECT MAX(c.ORDEM) FROM contratados c "
+            f"JOIN relatorios r ON r.NUMERO_RELATORIO = c.NUMERO_RELATORIO{where}"
+        )
+        return int(self._conexao().execute(sql, parametros).fetchone()[0] or 0)
+
+    def resumo(self, **filtros):
+        """Total de registros, última DATA_GERACAO e agentes distintos (uma passada pelo cursor)"""
+        total, ultima_geracao, agentes = 0, None, set()
+        for registro in self.listar(**filtros):
+            total += 1
+            geracao = registro.get('DATA_GERACAO')
+            if geracao is not None and (ultima_geracao is None or str(geracao) > ultima_geracao):
+                ultima_geracao = str(geracao)
+            if registro.get('AGENTE_NOME') is not None:
+                agentes.add(registro['AGENTE_NOME'])
+        return {'total': total, 'ultima_geracao': ultima_geracao, 'agentes': len(agentes)}
+
+    def para_dataframe(self, limite=None, **filtros):
+        """Aba de relatórios da Planilha Master gerada a partir do banco"""
+        colunas = list(inicializar_planilha_master().columns)
+        registros = list(self.listar(limite=limite, **filtros))
+        if not registros:
+            return pd.DataFrame(columns=colunas)
+        df = pd.DataFrame(registros)
+        extras = [coluna for coluna in df.columns if coluna not in colunas]
+        return df.reindex(columns=colunas + extras)
+
+    def contratados_dataframe(self, **filtros):
+        """Aba de contratados da Planilha Master gerada a partir do banco"""
+        colunas = ['NUMERO_RELATORIO', 'ORDEM'] + CAMPOS_CONTRATADO
+        return pd.DataFrame(self.listar_contratados(**filtros), columns=colunas)
+
+    def contar(self, **filtros):
+        where, parametros = self._filtros(**filtros)
+        return self._conexao().execute(f"SELECT COUNT(*) FROM relatorios r{where}", parametros).fetchone()[0]
+
+    def obter_metadado(self, chave):
+        linha = self._conexao().execute("SELECT VALOR FROM metadados WHERE CHAVE = ?", (chave,)).fetchone()
+        return linha[0] if linha else None
+
+    def definir_metadado(self, chave, valor):
+        conexao = self._conexao()
+        with conexao:
+            conexao.execute(
+                "INSERT INTO metadados (CHAVE, VALOR) VALUES (?, ?) "
+                "ON CONFLICT (CHAVE) DO UPDATE SET VALOR = excluded.VALOR",
+                (chave, valor)
+            )
+
+@st.cache_resource
+def obter_banco_relatorios():
+    """Banco de relatórios único por processo"""
+    return BancoRelatorios(os.path.join(get_pasta_dados_app(), BANCO_RELATORIOS_ARQUIVO))
+
+def sincronizar_banco_relatorios(service, folder_id, incluir_journal=True, data_inicio=None, data_fim=None):
+    """
+    Traz para o banco local o que existe no Drive: importa a Planilha Master e as
+    partições do período que mudaram desde a última importação (na primeira vez,
+    importa tudo) e aplica os registros do journal ainda não compactados.
+    """
+    banco = obter_banco_relatorios()
+
+    def _importar_se_mudou(nome_arquivo, chave_versao, carregar):
+        arquivo = resolver_arquivo_drive(service, nome_arquivo, folder_id)
+        if not arquivo:
+            return
+        versao = obter_versao_arquivo_drive(service, arquivo['id'])
+        if versao != banco.obter_metadado(chave_versao):
+            banco.salvar_varios(registros_da_planilha_master(*carregar()))
+            banco.definir_metadado(chave_versao, versao)
+
+    # O xlsx pode ter sido alterado por outras versões do app; as partições prevalecem
+    _importar_se_mudou(EXCEL_DATABASE_NAME, 'versao_planilha_master',
+                       lambda: _carregar_planilha_master_xlsx(service, folder_id, falhar_em_erro=True))
+    
+    manifesto = carregar_manifesto_planilha_master(service, folder_id)
+    for mes, info in sorted(manifesto['particoes'].items()):
+        if not particao_no_periodo(mes, data_inicio, data_fim):
+            continue
+        chave_versao = f'versao_particao_{mes}'
+        if info.get('versao') != banco.obter_metadado(chave_versao):
+            banco.salvar_varios(registros_da_planilha_master(
+                *_carregar_particao_planilha_master(service, folder_id, info)
+            ))
+            banco.definir_metadado(chave_versao, info.get('versao'))
+
+    if incluir_journal:
+        banco.salvar_varios([registro for _, registro in carregar_registros_journal_drive(service, folder_id)])
+
+    return banco
+
+# ========== JOURNAL DA PLANILHA MASTER (APPEND-ONLY) ==========
+def _nome_arquivo_journal(numero_relatorio):
+    return f"{JOURNAL_PREFIXO}{numero_relatorio}.json"
+
+def gravar_journal_local(novos_dados):
+    """
+    Grava o registro do relatório na pasta local do journal (escrita atômica).
+    O arquivo permanece pendente até ser enviado ao Drive.
+    """
+    pasta_journal = get_pasta_dados_app("journal")
+    nome_arquivo = _nome_arquivo_journal(novos_dados['NUMERO_RELATORIO'])
+    caminho_final = os.path.join(pasta_journal, nome_arquivo)
+    caminho_tmp = caminho_final + ".tmp"
+
+    registro = {
+        'NUMERO_RELATORIO': novos_dados['NUMERO_RELATORIO'],
+        'GRAVADO_EM': datetime.now().isoformat(),
+        'REGISTRO': novos_dados
+    }
+
+    with open(caminho_tmp, 'w', encoding='utf-8') as f:
+        json.dump(registro, f, ensure_ascii=False, default=str)
+    os.replace(caminho_tmp, caminho_final)
+
+    return caminho_final
+
+def enviar_journal_pendente(service, folder_id):
+    """Envia ao Drive os registros do journal local que ainda não foram sincronizados"""
+    pasta_journal = get_pasta_dados_app("journal")
+    enviados = 0
+
+    for nome_arquivo in sorted(os.listdir(pasta_journal)):
+        if not (nome_arquivo.startswith(JOURNAL_PREFIXO) and nome_arquivo.endswith('.json')):
+            continue
+
+        caminho = os.path.join(pasta_journal, nome_arquivo)
+        drive_info = upload_para_google_drive(
+            caminho_arquivo=caminho,
+            nome_arquivo=nome_arquivo,
+            service=service,
+            folder_id=folder_id
+        )
+
+        if drive_info:
+            try:
+                os.unlink(caminho)
+            except OSError:
+                pass
+            enviados += 1
+
+    return enviados
+
+def listar_journal_drive(service, folder_id):
+    """Lista os arquivos de journal existentes no Drive (ordenados por criação)"""
+    query = f"name contains '{JOURNAL_PREFIXO}' and trashed = false"
+    if folder_id:
+        query = f"name contains '{JOURNAL_PREFIXO}' and '{folder_id}' in parents and trashed = false"
+
+    list_params = {
+        'q': query,
+        'spaces': 'drive',
+        'fields': 'nextPageToken, files(id, name, createdTime)',
+        'orderBy': 'createdTime',
+        'pageSize': 1000,
+        'supportsAllDrives': True,
+        'includeItemsFromAllDrives': True
+    }
+
+    if is_streamlit_cloud():
+        list_params['corpora'] = 'drive'
+        list_params['driveId'] = SHARED_DRIVE_ID
+
+    arquivos = []
+    page_token = None
+    while True:
+        if page_token:
+            list_params['pageToken'] = page_token
+        results = executar_drive(service.files().list(**list_params), 'files.list')
+        arquivos.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    return [a for a in arquivos if a.get('name', '').startswith(JOURNAL_PREFIXO)]
+
+def carregar_registros_journal_drive(service, folder_id):
+    """Baixa os registros do journal do Drive. Retorna lista de (arquivo, registro)"""
+    registros = []
+    for arquivo in listar_journal_drive(service, folder_id):
+        try:
+            with baixar_buffer_por_id(service, arquivo['id']) as buffer:
+                conteudo = json.load(buffer)
+            registros.append((arquivo, conteudo['REGISTRO']))
+        except Exception:
+            continue
+    return registros
+
+class LeaseCompactacao(EstadoCompartilhadoDrive):
+    """
+    Exclusão mútua da compactação entre processos que compartilham a pasta do Drive.
+    
+    O lease é gravado por compare-and-swap e vale COMPACTACAO_LEASE_DURACAO
+    segundos. O dono mede a validade pelo relógio monotônico local, contado de
+    antes da gravação; os demais só o consideram vencido depois de `expira_em`
+    mais COMPACTACAO_LEASE_TOLERANCIA_RELOGIO.
+    """
+    def __init__(self, service, folder_id, nome_arquivo=COMPACTACAO_LEASE_FILENAME):
+        super().__init__(service, folder_id, nome_arquivo)
+        self.dono = uuid.uuid4().hex
+        self.valido_ate = None
+    
+    def adquirir(self):
+        """Tenta obter o lease. Retorna True se este processo é o dono"""
+        arquivo_id, lease, revisao_base = self.carregar()
+        expira_em = float(lease.get('expira_em') or 0)
+        if lease.get('dono') not in (None, self.dono) and \
+                time.time() < expira_em + COMPACTACAO_LEASE_TOLERANCIA_RELOGIO:
+            return False
+        
+        inicio = time.monotonic()
+        _, venceu = self.gravar_se_inalterado(arquivo_id, {
+            'dono': self.dono,
+            'expira_em': time.time() + COMPACTACAO_LEASE_DURACAO
+        }, revisao_base)
+        if venceu:
+            self.valido_ate = inicio + COMPACTACAO_LEASE_DURACAO
+        return venceu
     
-    with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as temp_file:
-        caminho_temp = temp_file.name
-        df.to_excel(caminho_temp, index=False)
+    def valido(self, margem=COMPACTACAO_LEASE_MARGEM):
+        """True se o lease ainda vale por pelo menos `margem` segundos"""
+        return self.valido_ate is not None and time.monotonic() + margem < self.valido_ate
     
-    return caminho_temp
+    def exigir(self):
+        """Levanta RuntimeError se o lease não vale mais por COMPACTACAO_LEASE_MARGEM"""
+        if not self.valido():
+            raise RuntimeError("lease da compactação expirado")
+    
+    def liberar(self):
+        """Devolve o lease, se ainda for deste processo (melhor esforço)"""
+        if self.valido_ate is None:
+            return
+        self.valido_ate = None
+        try:
+            arquivo_id, lease, revisao_base = self.carregar()
+            if lease.get('dono') == self.dono:
+                self.gravar_se_inalterado(arquivo_id, {'dono': None, 'expira_em': 0}, revisao_base)
+        except Exception:
+            pass
+
+@st.cache_resource
+def _obter_lock_compactacao():
+    """Lock de processo que serializa a compactação da Planilha Master"""
+    return threading.Lock()
+
+def compactar_journal_planilha_master(service, folder_id):
+    """
+    Materializa a Planilha Master: aplica os registros do journal, regrava as
+    partições mensais afetadas e o manifesto (e o xlsx único, se configurado)
+    e remove do Drive os registros já incorporados.
+    Só compacta quem detém o LeaseCompactacao: com dois processos compactando, o
+    que partiu de partições defasadas sobrescreveria as do outro e apagaria
+    registros do journal que não publicou. Sem folga de lease nada mais é
+    publicado nem apagado; os registros ficam no journal para a próxima vez.
+    Retorna o número de registros compactados, 0 se não havia o que compactar
+    (ou outro processo compacta) ou None em caso de erro. Erros ficam no span
+    'compactacao' da telemetria e nas métricas do Drive (operação 'compactacao').
+    """
+    lock = _obter_lock_compactacao()
+    if not lock.acquire(blocking=False):
+        return 0
+
+    caminho_temp = None
+    lease = LeaseCompactacao(service, folder_id)
+    try:
+        with medir_etapa('compactacao') as span:
+            if not lease.adquirir():
+                return 0
+
+            enviar_journal_pendente(service, folder_id)
+
+            registros = carregar_registros_journal_drive(service, folder_id)
+            span['registros'] = len(registros)
+            if not registros:
+                return 0
+
+            # Falha ao ler a planilha aborta a compactação (não sobrescreve com planilha incompleta)
+            with medir_etapa('compactacao.sincronizar', registros=len(registros)):
+                banco = sincronizar_banco_relatorios(service, folder_id, incluir_journal=False)
+
+            # Só as partições dos registros novos (e a anterior, se a data mudou) são regravadas
+            meses = set()
+            for _, registro in registros:
+                meses.add(particao_do_registro(registro))
+                anterior = banco.obter(registro['NUMERO_RELATORIO'])
+                if anterior:
+                    meses.add(particao_do_registro(anterior))
+            banco.salvar_varios([registro for _, registro in registros])
+
+            with medir_etapa('compactacao.particoes', particoes=len(meses)):
+                manifesto = carregar_manifesto_planilha_master(service, folder_id)
+                for mes in sorted(meses):
+                    lease.exigir()
+                    info = publicar_particao_planilha_master(service, folder_id, banco, mes)
+                    if not info:
+                        raise RuntimeError(f"falha ao publicar a partição {mes}")
+                    manifesto['particoes'][mes] = info
+                    banco.definir_metadado(f'versao_particao_{mes}', info['versao'])
+                lease.exigir()
+                if not publicar_manifesto_planilha_master(service, folder_id, manifesto):
+                    raise RuntimeError("falha ao publicar o manifesto")
+
+            if PLANILHA_MASTER_PUBLICAR_XLSX:
+                # O xlsx do Drive é uma exportação do banco
+                with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as temp_file:
+                    caminho_temp = temp_file.name
+                with medir_etapa('compactacao.gerar_xlsx'):
+                    gravar_planilha_master_xlsx_do_banco(caminho_temp, banco)
+
+                lease.exigir()
+                drive_info = upload_para_google_drive(
+                    caminho_arquivo=caminho_temp,
+                    nome_arquivo=EXCEL_DATABASE_NAME,
+                    service=service,
+                    folder_id=folder_id
+                )
 
-def carregar_planilha_master_drive(service, folder_id):
-    try:
-        query = f"name = '{EXCEL_DATABASE_NAME}' and trashed = false"
-        if folder_id:
-            query = f"name = '{EXCEL_DATABASE_NAME}' and '{folder_id}' in parents and trashed = false"
-        
-        list_params = {
-            'q': query,
-            'spaces': 'drive',
-            'fields': 'files(id, name)',
-            'supportsAllDrives': True,
-            'includeItemsFromAllDrives': True
-        }
-        
-        if is_streamlit_cloud():
-            list_params['corpora'] = 'drive'
-            list_params['driveId'] = SHARED_DRIVE_ID
-        
-        results = service.files().list(**list_params).execute()
-        arquivos = results.get('files', [])
-        
-        if arquivos:
-            arquivo_id = arquivos[0]['id']
-            request = service.files().get_media(fileId=arquivo_id, supportsAllDrives=True)
-            
-            with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as temp_file:
-                caminho_temp = temp_file.name
-                fh = BytesIO()
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while done is False:
-                    status, done = downloader.next_chunk()
-                
-                with open(caminho_temp, 'wb') as f:
-                    f.write(fh.getvalue())
-            
+                if not drive_info:
+                    raise RuntimeError("falha ao enviar o xlsx da Planilha Master")
+
+                # A planilha enviada já está no banco: evita reimportá-la na próxima sincronização
+                banco.definir_metadado('versao_planilha_master', calcular_hashes_arquivo(caminho_temp)[0])
+
+            lease.exigir()
+            for arquivo, _ in registros:
+                try:
+                    executar_drive(service.files().delete(fileId=arquivo['id'], supportsAllDrives=True), 'files.delete')
+                except HttpError:
+                    pass
+                obter_cache_ids_drive().invalidar(folder_id, arquivo['name'])
+
+            obter_metricas_drive().registrar('compactacao', 'sucesso')
+            return len(registros)
+
+    except Exception as erro:
+        # O span 'compactacao' já guardou o erro; a métrica o deixa visível no painel
+        obter_metricas_drive().registrar('compactacao', 'falha', erro)
+        return None
+    finally:
+        lease.liberar()
+        lock.release()
+        if caminho_temp and os.path.exists(caminho_temp):
             try:
-                df = pd.read_excel(caminho_temp)
-            except Exception as e:
-                caminho_temp = inicializar_planilha_master()
-                df = pd.read_excel(caminho_temp)
-            
-            return df, caminho_temp
-        else:
-            caminho_temp = inicializar_planilha_master()
-            df = pd.read_excel(caminho_temp)
-            return df, caminho_temp
-            
-    except Exception as e:
-        st.error(f"❌ Erro ao carregar Planilha Master do Drive: {str(e)}")
-        caminho_temp = inicializar_planilha_master()
-        df = pd.read_excel(caminho_temp)
-        return df, caminho_temp
+                os.unlink(caminho_temp)
+            except:
+                pass
+
+@st.cache_resource
+def iniciar_compactacao_periodica(_service, folder_id=GOOGLE_DRIVE_FOLDER_ID,
+                                  intervalo=JOURNAL_COMPACTACAO_INTERVALO):
+    """
+    Inicia (uma vez por processo) a thread que compacta o journal na Planilha Master
+    a cada `intervalo` segundos.
+    """
+    def _executar():
+        while True:
+            time.sleep(intervalo)
+            try:
+                compactar_journal_planilha_master(_service, folder_id)
+            except Exception:
+                pass
+
+    thread = threading.Thread(target=_executar, name="compactacao-planilha-master", daemon=True)
+    thread.start()
+    return thread
 
 def adicionar_relatorio_a_planilha_master(dados_relatorio, agente_info, fotos_info, service, folder_id,
                                          tipo_visita_outros="",
@@ -834,9 +2550,12 @@ def adicionar_relatorio_a_planilha_master(dados_relatorio, agente_info, fotos_in
                                          prestadores_quantidade="", outros_texto_recebido="",
                                          qualificacao_outros="",
                                          situacao_contratante="", tipo_infracao="", infracao_selecionada=""):
+    """
+    Registra o relatório no journal (um arquivo pequeno por relatório).
+    O custo não depende do tamanho da Planilha Master, que é materializada
+    pela compactação periódica.
+    """
     try:
-        df_existente, caminho_temp = carregar_planilha_master_drive(service, folder_id)
-        
         novos_dados = preparar_dados_para_planilha_master(
             dados_relatorio, agente_info, fotos_info,
             tipo_visita_outros, caracteristica_outros, fase_atividade_outros,
@@ -847,45 +2566,285 @@ def adicionar_relatorio_a_planilha_master(dados_relatorio, agente_info, fotos_in
             qualificacao_outros,
             situacao_contratante, tipo_infracao, infracao_selecionada
         )
-        
-        numero_relatorio = novos_dados['NUMERO_RELATORIO']
-        
-        relatorio_existente = pd.DataFrame()
-        if not df_existente.empty and 'NUMERO_RELATORIO' in df_existente.columns:
-            relatorio_existente = df_existente[df_existente['NUMERO_RELATORIO'] == numero_relatorio]
-        
-        if not relatorio_existente.empty:
-            idx = df_existente[df_existente['NUMERO_RELATORIO'] == numero_relatorio].index[0]
-            for col, valor in novos_dados.items():
-                if col in df_existente.columns:
-                    df_existente.at[idx, col] = valor
-        else:
-            novo_df = pd.DataFrame([novos_dados])
-            df_existente = pd.concat([df_existente, novo_df], ignore_index=True)
-        
-        df_existente.to_excel(caminho_temp, index=False)
-        
+
+        obter_banco_relatorios().salvar(novos_dados)
+        caminho_journal = gravar_journal_local(novos_dados)
+
+        if not service:
+            return False
+
         drive_info = upload_para_google_drive(
-            caminho_arquivo=caminho_temp,
-            nome_arquivo=EXCEL_DATABASE_NAME,
+            caminho_arquivo=caminho_journal,
+            nome_arquivo=os.path.basename(caminho_journal),
             service=service,
             folder_id=folder_id
         )
-        
+
         if drive_info:
+            try:
+                os.unlink(caminho_journal)
+            except OSError:
+                pass
             return True
         else:
             return False
-            
+
     except Exception as e:
         st.error(f"❌ Erro ao adicionar dados à Planilha Master: {str(e)}")
         return False
+
+# ========== FILA DE ENVIO AO DRIVE (OUTBOX) ==========
+OUTBOX_STATUS = {
+    'pendente': "⏳ Aguardando envio",
+    'erro': "⚠️ Falha no envio (nova tentativa automática)",
+    'sincronizado': "✅ Sincronizado",
+}
+
+def _caminho_item_outbox(numero_relatorio):
+    return os.path.join(get_pasta_dados_app("outbox"), str(numero_relatorio), "item.json")
+
+def _gravar_item_outbox(item):
+    caminho = _caminho_item_outbox(item['numero_relatorio'])
+    caminho_tmp = caminho + ".tmp"
+    with open(caminho_tmp, 'w', encoding='utf-8') as f:
+        json.dump(item, f, ensure_ascii=False, default=str)
+    os.replace(caminho_tmp, caminho)
+
+def _ler_item_outbox(caminho):
+    try:
+        with open(caminho, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def fila_local_persistente():
+    """
+    Indica se a outbox e o journal sobrevivem a reinícios do app. No Streamlit
+    Cloud a pasta padrão é temporária; só RF_DADOS_DIR (volume persistente) serve.
+    """
+    return bool(os.getenv('RF_DADOS_DIR')) or not is_streamlit_cloud()
+
+def enfileirar_relatorio_outbox(caminho_pdf, novos_dados, matricula="", acordar_worker=True):
+    """
+    Grava em disco o PDF e o registro da Planilha Master para envio posterior.
+    Retorna o item criado; o envio ao Drive é feito pela thread da outbox.
+    """
+    numero_relatorio = novos_dados['NUMERO_RELATORIO']
+    pasta_item = os.path.dirname(_caminho_item_outbox(numero_relatorio))
+    os.makedirs(pasta_item, exist_ok=True)
+
+    nome_pdf = os.path.basename(caminho_pdf)
+    shutil.copy2(caminho_pdf, os.path.join(pasta_item, nome_pdf))
+
+    # O registro da planilha segue pelo journal, que já é durável
+    gravar_journal_local(novos_dados)
+
+    item = {
+        'numero_relatorio': numero_relatorio,
+        'matricula': matricula,
+        'arquivo_pdf': nome_pdf,
+        'status': 'pendente',
+        'pdf_enviado': False,
+        'planilha_enviada': False,
+        'tentativas': 0,
+        'ultimo_erro': "",
+        'criado_em': datetime.now().isoformat(),
+        'atualizado_em': datetime.now().isoformat(),
+        'proxima_tentativa': 0,
+    }
+    _gravar_item_outbox(item)
+    if acordar_worker:
+        obter_evento_outbox().set()
+    return item
+
+def enviar_relatorio(service, folder_id, caminho_pdf, novos_dados, matricula=""):
+    """
+    Registra o relatório na outbox. Com a fila persistente, o envio fica com a
+    thread da outbox e a sessão não espera pelo Drive. Com a fila temporária
+    (Streamlit Cloud sem RF_DADOS_DIR), tenta enviar na hora, uma única vez e sem
+    esperas; se falhar, a thread da outbox tenta de novo.
+    Retorna True se o PDF e o registro já estão no Drive.
+    """
+    if fila_local_persistente():
+        enfileirar_relatorio_outbox(caminho_pdf, novos_dados, matricula)
+        return False
+
+    numero_relatorio = novos_dados['NUMERO_RELATORIO']
+    em_andamento, lock = _obter_envios_em_andamento()
+    with lock:
+        em_andamento.add(numero_relatorio)
+    try:
+        item = enfileirar_relatorio_outbox(caminho_pdf, novos_dados, matricula, acordar_worker=False)
+        with sem_retentativas_drive():
+            enviado = bool(service) and processar_item_outbox(service, folder_id, item)
+    finally:
+        with lock:
+            em_andamento.discard(numero_relatorio)
+
+    if not enviado:
+        obter_evento_outbox().set()
+    return enviado
+
+def listar_itens_outbox(matricula=None):
+    """Itens da outbox (mais recentes primeiro), opcionalmente de um agente"""
+    pasta_outbox = get_pasta_dados_app("outbox")
+    itens = []
+    for nome in os.listdir(pasta_outbox):
+        item = _ler_item_outbox(os.path.join(pasta_outbox, nome, "item.json"))
+        if item and (matricula is None or item.get('matricula') == matricula):
+            itens.append(item)
+    return sorted(itens, key=lambda i: i.get('criado_em', ''), reverse=True)
+
+def processar_item_outbox(service, folder_id, item):
+    """Envia as partes pendentes de um item. Retorna True quando o item está sincronizado"""
+    pasta_item = os.path.dirname(_caminho_item_outbox(item['numero_relatorio']))
+
+    try:
+        with medir_etapa('outbox.envio', relatorio=item['numero_relatorio'], tentativa=item['tentativas'] + 1):
+            if not item['pdf_enviado']:
+                caminho_pdf = os.path.join(pasta_item, item['arquivo_pdf'])
+                drive_info = upload_para_google_drive(
+                    caminho_arquivo=caminho_pdf,
+                    nome_arquivo=item['arquivo_pdf'],
+                    service=service,
+                    folder_id=folder_id
+                )
+                if not drive_info:
+                    raise RuntimeError("falha no envio do PDF")
+                item['pdf_enviado'] = True
+                try:
+                    os.unlink(caminho_pdf)
+                except OSError:
+                    pass
+                _gravar_item_outbox(item)
+
+            if not item['planilha_enviada']:
+                caminho_journal = os.path.join(get_pasta_dados_app("journal"),
+                                               _nome_arquivo_journal(item['numero_relatorio']))
+                # Se o arquivo não existe mais, a compactação já enviou o registro
+                if os.path.exists(caminho_journal):
+                    drive_info = upload_para_google_drive(
+                        caminho_arquivo=caminho_journal,
+                        nome_arquivo=os.path.basename(caminho_journal),
+                        service=service,
+                        folder_id=folder_id
+                    )
+                    if not drive_info:
+                        raise RuntimeError("falha no envio do registro da Planilha Master")
+                    try:
+                        os.unlink(caminho_journal)
+                    except OSError:
+                        pass
+                item['planilha_enviada'] = True
+
+        item['status'] = 'sincronizado'
+        item['ultimo_erro'] = ""
+        return True
+
+    except Exception as e:
+        item['status'] = 'erro'
+        item['tentativas'] += 1
+        item['ultimo_erro'] = str(e)
+        espera = min(OUTBOX_INTERVALO * 2 ** (item['tentativas'] - 1), OUTBOX_ESPERA_MAXIMA)
+        item['proxima_tentativa'] = time.time() + espera
+        return False
+
+    finally:
+        item['atualizado_em'] = datetime.now().isoformat()
+        _gravar_item_outbox(item)
+
+def drenar_outbox(service, folder_id):
+    """Processa os itens pendentes da outbox. Retorna o número de itens sincronizados"""
+    lock = _obter_lock_outbox()
+    if not lock.acquire(blocking=False):
+        return 0
+
+    em_andamento, lock_envios = _obter_envios_em_andamento()
+    try:
+        sincronizados = 0
+        agora = time.time()
+        for item in reversed(listar_itens_outbox()):
+            if item['status'] == 'sincronizado':
+                # Mantém o status visível por um tempo e depois remove o item
+                criado_em = datetime.fromisoformat(item['criado_em']).timestamp()
+                if agora - criado_em > OUTBOX_RETENCAO_SINCRONIZADOS:
+                    shutil.rmtree(os.path.dirname(_caminho_item_outbox(item['numero_relatorio'])),
+                                  ignore_errors=True)
+                continue
+            if item.get('proxima_tentativa', 0) > agora:
+                continue
+            with lock_envios:
+                if item['numero_relatorio'] in em_andamento:
+                    continue
+            if processar_item_outbox(service, folder_id, item):
+                sincronizados += 1
+        return sincronizados
     finally:
-        if 'caminho_temp' in locals() and os.path.exists(caminho_temp):
+        lock.release()
+
+@st.cache_resource
+def _obter_lock_outbox():
+    """Lock de processo que evita dois envios simultâneos da outbox"""
+    return threading.Lock()
+
+@st.cache_resource
+def _obter_envios_em_andamento():
+    """Relatórios sendo enviados na hora pela sessão (a thread da outbox não os processa)"""
+    return set(), threading.Lock()
+
+@st.cache_resource
+def obter_evento_outbox():
+    """Evento usado para acordar a thread da outbox quando um item é enfileirado"""
+    return threading.Event()
+
+@st.cache_resource
+def iniciar_worker_outbox(_service, folder_id=GOOGLE_DRIVE_FOLDER_ID, intervalo=OUTBOX_INTERVALO):
+    """
+    Inicia (uma vez por processo) a thread que envia a outbox ao Drive.
+    Roda a cada `intervalo` segundos ou assim que um item é enfileirado.
+    """
+    evento = obter_evento_outbox()
+
+    def _executar():
+        while True:
             try:
-                os.unlink(caminho_temp)
-            except:
+                drenar_outbox(_service, folder_id)
+            except Exception:
                 pass
+            evento.wait(intervalo)
+            evento.clear()
+
+    thread = threading.Thread(target=_executar, name="outbox-drive", daemon=True)
+    thread.start()
+    return thread
+
+def exibir_status_outbox(matricula):
+    """Mostra na barra lateral a situação de envio dos relatórios do agente"""
+    itens = listar_itens_outbox(matricula)
+    if not itens:
+        return
+
+    pendentes = sum(1 for item in itens if item['status'] != 'sincronizado')
+    st.markdown("**☁️ Envio para a nuvem:**")
+    if pendentes:
+        st.caption(f"{pendentes} relatório(s) ainda não enviado(s) ao Google Drive")
+        if not fila_local_persistente():
+            st.warning("A fila de envio está em armazenamento temporário do servidor: "
+                       "guarde o PDF desses relatórios até a sincronização.")
+
+    for item in itens[:10]:
+        texto = f"`{item['numero_relatorio']}` — {OUTBOX_STATUS.get(item['status'], item['status'])}"
+        if item['status'] == 'erro' and item.get('ultimo_erro'):
+            texto += f" ({item['tentativas']} tentativa(s): {item['ultimo_erro']})"
+        st.caption(texto)
+
+    if pendentes and st.button("🔄 Sincronizar agora", use_container_width=True, key="outbox_sincronizar"):
+        for item in itens:
+            if item['status'] == 'erro':
+                item['proxima_tentativa'] = 0
+                _gravar_item_outbox(item)
+        obter_evento_outbox().set()
+        st.rerun()
 
 def preparar_dados_para_planilha_master(dados, agente_info, fotos_info, 
                                         tipo_visita_outros="",
@@ -967,85 +2926,153 @@ def preparar_dados_para_planilha_master(dados, agente_info, fotos_info,
         'TOTAL_CONTRATADOS_REGISTROS': total_contratados
     }
     
-    contratados_data = dados.get('contratados_data', [])
-    
-    for i in range(1, 6):
-        prefix = f'CONTRATADO_{i:02d}'
-        
-        if i <= len(contratados_data):
-            contrato = contratados_data[i-1]
-            
-            servico_outros = ""
-            if contrato.get('servico_executado') == "Outras":
-                servico_outros = contrato.get('servico_executado_outras', '')
-            
-            qualificacao_outros_contratado = ""
-            if contrato.get('qualificacao_fonte_secao04') == "OUTRAS":
-                qualificacao_outros_contratado = contrato.get('qualificacao_outras_secao04', '')
-            
-            # Converte a lista de infrações para string JSON para salvar na planilha
-            infracoes_contratado = contrato.get('infracoes_contratado', [])
-            # Sanitiza cada infração antes de salvar no JSON
-            infracoes_sanitizadas = [remover_acentos(infracao) for infracao in infracoes_contratado]
-            infracoes_json = json.dumps(infracoes_sanitizadas) if infracoes_sanitizadas else ""
-            
-            dados_excel.update({
-                f'{prefix}_MESMO_CONTRATANTE': contrato.get('mesmo_contratante', ''),
-                f'{prefix}_NOME_CONTRATANTE': contrato.get('nome_contratante_secao04', ''),
-                f'{prefix}_REGISTRO_CONTRATANTE': contrato.get('registro_contratante_secao04', ''),
-                f'{prefix}_CPF_CNPJ_CONTRATANTE': contrato.get('cpf_cnpj_secao04', ''),
-                f'{prefix}_CONTRATADO_PF_PJ': contrato.get('contratado_pf_pj', ''),
-                f'{prefix}_REGISTRO': contrato.get('registro', ''),
-                f'{prefix}_CPF_CNPJ': contrato.get('cpf_cnpj_contratado', ''),
-                f'{prefix}_PROFISSIONAL': contrato.get('contrato', ''),
-                f'{prefix}_IDENTIFICACAO_FISCALIZADO': contrato.get('identificacao_fiscalizado', ''),
-                f'{prefix}_NUMERO_ART': contrato.get('numero_art', ''),
-                f'{prefix}_NUMERO_RRT': contrato.get('numero_rrt', ''),
-                f'{prefix}_NUMERO_TRT': contrato.get('numero_trt', ''),
-                f'{prefix}_RAMO_ATIVIDADE': contrato.get('ramo_atividade', ''),
-                f'{prefix}_SERVICO_EXECUTADO': contrato.get('servico_executado', ''),
-                f'{prefix}_SERVICO_OUTROS': servico_outros,
-                f'{prefix}_FONTE_INFORMACAO': contrato.get('fonte_informacao_secao04', ''),
-                f'{prefix}_QUALIFICACAO_FONTE': contrato.get('qualificacao_fonte_secao04', ''),
-                f'{prefix}_QUALIFICACAO_OUTROS': qualificacao_outros_contratado,
-                f'{prefix}_SITUACAO_CONTRATADO': contrato.get('situacao_contratado', ''),
-                f'{prefix}_TIPO_INFRACAO_CONTRATADO': contrato.get('tipo_infracao_contratado', ''),
-                f'{prefix}_INFRACOES_CONTRATADO': infracoes_json
-            })
-        else:
-            dados_excel.update({
-                f'{prefix}_MESMO_CONTRATANTE': '',
-                f'{prefix}_NOME_CONTRATANTE': '',
-                f'{prefix}_REGISTRO_CONTRATANTE': '',
-                f'{prefix}_CPF_CNPJ_CONTRATANTE': '',
-                f'{prefix}_CONTRATADO_PF_PJ': '',
-                f'{prefix}_REGISTRO': '',
-                f'{prefix}_CPF_CNPJ': '',
-                f'{prefix}_PROFISSIONAL': '',
-                f'{prefix}_IDENTIFICACAO_FISCALIZADO': '',
-                f'{prefix}_NUMERO_ART': '',
-                f'{prefix}_NUMERO_RRT': '',
-                f'{prefix}_NUMERO_TRT': '',
-                f'{prefix}_RAMO_ATIVIDADE': '',
-                f'{prefix}_SERVICO_EXECUTADO': '',
-                f'{prefix}_SERVICO_OUTROS': '',
-                f'{prefix}_FONTE_INFORMACAO': '',
-                f'{prefix}_QUALIFICACAO_FONTE': '',
-                f'{prefix}_QUALIFICACAO_OUTROS': '',
-                f'{prefix}_SITUACAO_CONTRATADO': '',
-                f'{prefix}_TIPO_INFRACAO_CONTRATADO': '',
-                f'{prefix}_INFRACOES_CONTRATADO': ''
-            })
+    dados_excel['CONTRATADOS'] = preparar_contratados_para_planilha_master(dados.get('contratados_data', []))
     
     return dados_excel
 
-def exportar_planilha_para_download(df):
+def preparar_contratados_para_planilha_master(contratados_data):
+    """Uma entrada por contratado (sem limite de quantidade), na ordem do formulário"""
+    contratados = []
+    for ordem, contrato in enumerate(contratados_data, start=1):
+        servico_outros = ""
+        if contrato.get('servico_executado') == "Outras":
+            servico_outros = contrato.get('servico_executado_outras', '')
+        
+        qualificacao_outros_contratado = ""
+        if contrato.get('qualificacao_fonte_secao04') == "OUTRAS":
+            qualificacao_outros_contratado = contrato.get('qualificacao_outras_secao04', '')
+        
+        # Converte a lista de infrações para string JSON para salvar na planilha
+        infracoes_contratado = contrato.get('infracoes_contratado', [])
+        # Sanitiza cada infração antes de salvar no JSON
+        infracoes_sanitizadas = [remover_acentos(infracao) for infracao in infracoes_contratado]
+        infracoes_json = json.dumps(infracoes_sanitizadas) if infracoes_sanitizadas else ""
+        
+        contratados.append({
+            'ORDEM': ordem,
+            'MESMO_CONTRATANTE': contrato.get('mesmo_contratante', ''),
+            'NOME_CONTRATANTE': contrato.get('nome_contratante_secao04', ''),
+            'REGISTRO_CONTRATANTE': contrato.get('registro_contratante_secao04', ''),
+            'CPF_CNPJ_CONTRATANTE': contrato.get('cpf_cnpj_secao04', ''),
+            'CONTRATADO_PF_PJ': contrato.get('contratado_pf_pj', ''),
+            'REGISTRO': contrato.get('registro', ''),
+            'CPF_CNPJ': contrato.get('cpf_cnpj_contratado', ''),
+            'PROFISSIONAL': contrato.get('contrato', ''),
+            'IDENTIFICACAO_FISCALIZADO': contrato.get('identificacao_fiscalizado', ''),
+            'NUMERO_ART': contrato.get('numero_art', ''),
+            'NUMERO_RRT': contrato.get('numero_rrt', ''),
+            'NUMERO_TRT': contrato.get('numero_trt', ''),
+            'RAMO_ATIVIDADE': contrato.get('ramo_atividade', ''),
+            'SERVICO_EXECUTADO': contrato.get('servico_executado', ''),
+            'SERVICO_OUTROS': servico_outros,
+            'FONTE_INFORMACAO': contrato.get('fonte_informacao_secao04', ''),
+            'QUALIFICACAO_FONTE': contrato.get('qualificacao_fonte_secao04', ''),
+            'QUALIFICACAO_OUTROS': qualificacao_outros_contratado,
+            'SITUACAO_CONTRATADO': contrato.get('situacao_contratado', ''),
+            'TIPO_INFRACAO_CONTRATADO': contrato.get('tipo_infracao_contratado', ''),
+            'INFRACOES_CONTRATADO': infracoes_json
+        })
+    return contratados
+
+def extrair_contratados_formato_largo(registro):
+    """
+    Converte as colunas CONTRATADO_NN_* de linhas no formato antigo em entradas
+    de contratado, removendo-as do registro. Retorna None se não houver essas colunas.
+    """
+    blocos = {}
+    for coluna in [c for c in registro if re.match(r'^CONTRATADO_\d+_', str(c))]:
+        _, numero, campo = coluna.split('_', 2)
+        valor = registro.pop(coluna)
+        blocos.setdefault(int(numero), {})[campo] = valor
+    
+    if not blocos:
+        return None
+    
+    contratados = []
+    for numero in sorted(blocos):
+        campos = blocos[numero]
+        if any(valor not in (None, '') for valor in campos.values()):
+            contratados.append({'ORDEM': len(contratados) + 1, **campos})
+    return contratados
+
+def _gravar_aba_xlsx(workbook, nome_aba, colunas, linhas):
+    """Acrescenta a aba em modo write-only, uma linha por vez"""
+    aba = workbook.create_sheet(nome_aba)
+    aba.append([str(coluna) for coluna in colunas])
+    for linha in linhas:
+        aba.append(linha)
+
+def _linhas_dataframe(df):
+    """Linhas do DataFrame convertidas por lote (NaN vira célula vazia)"""
+    for inicio in range(0, len(df), PLANILHA_EXPORTACAO_LOTE):
+        lote = df.iloc[inicio:inicio + PLANILHA_EXPORTACAO_LOTE].astype(object)
+        lote = lote.where(lote.notna(), None)
+        yield from lote.itertuples(index=False, name=None)
+
+def _linhas_relatorios_largas(banco, colunas, maximo, **filtros):
+    """
+    Layout antigo: cada relatório seguido de um bloco de colunas CONTRATADO_NN_*
+    por contratado. Os contratados são buscados por lote de relatórios.
+    """
+    registros = banco.listar(**filtros)
+    while True:
+        lote = list(islice(registros, PLANILHA_EXPORTACAO_LOTE))
+        if not lote:
+            return
+        contratados = banco.contratados_por_relatorio(registro['NUMERO_RELATORIO'] for registro in lote)
+        for registro in lote:
+            do_relatorio = contratados.get(registro['NUMERO_RELATORIO'], {})
+            linha = [registro.get(coluna) for coluna in colunas]
+            for ordem in range(1, maximo + 1):
+                contratado = do_relatorio.get(ordem)
+                linha.extend(
+                    [contratado.get(campo, '') for campo in CAMPOS_CONTRATADO] if contratado
+                    else [None] * len(CAMPOS_CONTRATADO)
+                )
+            yield linha
+
+def gravar_planilha_master_xlsx(destino, df_relatorios, df_contratados=None):
+    """
+    Grava a Planilha Master (aba de relatórios e, se houver, a de contratados).
+    `destino` pode ser um caminho ou um arquivo binário aberto.
+    """
+    workbook = Workbook(write_only=True)
+    _gravar_aba_xlsx(workbook, ABA_RELATORIOS, df_relatorios.columns, _linhas_dataframe(df_relatorios))
+    if df_contratados is not None:
+        _gravar_aba_xlsx(workbook, ABA_CONTRATADOS, df_contratados.columns, _linhas_dataframe(df_contratados))
+    workbook.save(destino)
+
+def gravar_planilha_master_xlsx_do_banco(destino, banco, contratados_em_colunas=False, **filtros):
+    """
+    Grava a Planilha Master direto do banco, lendo os registros do cursor por lote:
+    a memória usada não cresce com o número de relatórios.
+    Com `contratados_em_colunas`, usa o layout antigo (uma aba, contratados em colunas).
+    """
+    colunas = banco.colunas_relatorios(**filtros)
+    workbook = Workbook(write_only=True)
+    if contratados_em_colunas:
+        maximo = banco.maximo_contratados(**filtros)
+        colunas_contratados = [
+            f"CONTRATADO_{n:02d}_{campo}" for n in range(1, maximo + 1) for campo in CAMPOS_CONTRATADO
+        ]
+        _gravar_aba_xlsx(workbook, ABA_RELATORIOS, colunas + colunas_contratados,
+                         _linhas_relatorios_largas(banco, colunas, maximo, **filtros))
+    else:
+        _gravar_aba_xlsx(workbook, ABA_RELATORIOS, colunas,
+                         ([registro.get(coluna) for coluna in colunas] for registro in banco.listar(**filtros)))
+        colunas_contratados = ['NUMERO_RELATORIO', 'ORDEM'] + CAMPOS_CONTRATADO
+        _gravar_aba_xlsx(workbook, ABA_CONTRATADOS, colunas_contratados,
+                         ([contratado.get(coluna) for coluna in colunas_contratados]
+                          for contratado in banco.listar_contratados(**filtros)))
+    workbook.save(destino)
+
+def exportar_planilha_para_download(banco, contratados_em_colunas=False, **filtros):
+    """Conteúdo do xlsx para o st.download_button"""
     try:
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='RELATORIOS')
-        excel_data = output.getvalue()
-        return excel_data
+        with tempfile.SpooledTemporaryFile(max_size=PLANILHA_EXPORTACAO_LIMITE_MEMORIA) as output:
+            gravar_planilha_master_xlsx_do_banco(output, banco, contratados_em_colunas, **filtros)
+            output.seek(0)
+            return output.read()
     except Exception as e:
         st.error(f"Erro ao exportar Excel: {e}")
         return None
@@ -1101,39 +3128,367 @@ def carregar_municipios_cache():
 MUNICIPIOS_RJ = carregar_municipios_cache()
 
 # ========== CLASSE FOTOINFO ==========
+def calcular_digest_foto(image_bytes):
+    """Digest do conteúdo da foto, usado para detectar duplicatas"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def foto_heif(image_bytes):
+    """True se o conteúdo é HEIC/HEIF (formato padrão das câmeras do iPhone)"""
+    return image_bytes[4:8] == b'ftyp' and image_bytes[8:12] in (b'heic', b'heix', b'heif', b'mif1', b'msf1', b'hevc')
+
+def foto_embutivel_no_pdf(image_bytes):
+    """True se o fpdf embute o conteúdo como está (JPEG ou PNG)"""
+    return image_bytes[:2] == b'\xff\xd8' or image_bytes[:8] == b'\x89PNG\r\n\x1a\n'
+
+def normalizar_foto(image_bytes):
+    """
+    Normaliza a foto na entrada: decodifica uma única vez, aplica a orientação
+    EXIF, reduz à resolução máxima de impressão do PDF e recodifica em JPEG.
+    Retorna (jpeg_bytes, thumbnail_jpeg_bytes).
+    """
+    img = Image.open(BytesIO(image_bytes))
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    
+    if max(img.size) > FOTO_MAX_PIXELS:
+        img.thumbnail((FOTO_MAX_PIXELS, FOTO_MAX_PIXELS), Image.Resampling.LANCZOS)
+    
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', quality=FOTO_JPEG_QUALIDADE, optimize=True)
+    
+    thumbnail = img.copy()
+    thumbnail.thumbnail(FOTO_THUMBNAIL_TAMANHO, Image.Resampling.LANCZOS)
+    buffer_thumbnail = BytesIO()
+    thumbnail.save(buffer_thumbnail, 'JPEG', quality=80)
+    
+    return buffer.getvalue(), buffer_thumbnail.getvalue()
+
+# ========== ARMAZENAMENTO DAS FOTOS EM DISCO ==========
+class ArmazemFotos:
+    """
+    Guarda o conteúdo das fotos em disco, numa pasta por sessão, e mantém em
+    memória (LRU compartilhado pelo processo) apenas os bytes e imagens
+    decodificadas mais usados, dentro de um orçamento de memória.
+    """
+    def __init__(self, pasta_base, orcamento_bytes):
+        self.pasta_base = pasta_base
+        self.orcamento_bytes = orcamento_bytes
+        self._lru = OrderedDict()
+        self._uso_bytes = 0
+        self._lock = threading.Lock()
+        self._ultima_limpeza = 0.0
+        # Fotos de fiscalização: pastas 0700 e arquivos 0600, só para o usuário do app
+        os.makedirs(pasta_base, mode=0o700, exist_ok=True)
+        restringir_pasta(pasta_base)
+    
+    def pasta_sessao(self, sessao_id):
+        caminho = os.path.join(self.pasta_base, sessao_id)
+        os.makedirs(caminho, mode=0o700, exist_ok=True)
+        return caminho
+    
+    def gravar(self, sessao_id, nome_arquivo, conteudo):
+        """Grava o conteúdo e retorna o caminho (handle) do arquivo"""
+        caminho = os.path.join(self.pasta_sessao(sessao_id), nome_arquivo)
+        caminho_tmp = caminho + ".tmp"
+        descritor = os.open(caminho_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o600)
+        with os.fdopen(descritor, 'wb') as f:
+            f.write(conteudo)
+        os.replace(caminho_tmp, caminho)
+        return caminho
+    
+    def _obter_cache(self, chave):
+        with self._lock:
+            item = self._lru.get(chave)
+            if item is not None:
+                self._lru.move_to_end(chave)
+                return item[0]
+        return None
+    
+    def _guardar_cache(self, chave, valor, tamanho):
+        if tamanho > self.orcamento_bytes:
+            return
+        with self._lock:
+            anterior = self._lru.pop(chave, None)
+            if anterior is not None:
+                self._uso_bytes -= anterior[1]
+            self._lru[chave] = (valor, tamanho)
+            self._uso_bytes += tamanho
+            while self._uso_bytes > self.orcamento_bytes and self._lru:
+                _, (_, tamanho_removido) = self._lru.popitem(last=False)
+                self._uso_bytes -= tamanho_removido
+    
+    def ler(self, caminho):
+        """Conteúdo do arquivo (bytes)"""
+        chave = ('bytes', caminho)
+        conteudo = self._obter_cache(chave)
+        if conteudo is None:
+            with open(caminho, 'rb') as f:
+                conteudo = f.read()
+            self._guardar_cache(chave, conteudo, len(conteudo))
+        return conteudo
+    
+    def imagem(self, caminho, tamanho_miniatura=None):
+        """Imagem decodificada (opcionalmente reduzida), mantida no LRU"""
+        chave = ('imagem', caminho, tamanho_miniatura)
+        img = self._obter_cache(chave)
+        if img is None:
+            img = Image.open(BytesIO(self.ler(caminho)))
+            img.load()
+            if tamanho_miniatura:
+                img = img.copy()
+                img.thumbnail(tamanho_miniatura, Image.Resampling.LANCZOS)
+            self._guardar_cache(chave, img, img.width * img.height * len(img.getbands()))
+        return img
+    
+    def _esquecer(self, caminho):
+        with self._lock:
+            for chave in [c for c in self._lru if c[1] == caminho]:
+                _, tamanho = self._lru.pop(chave)
+                self._uso_bytes -= tamanho
+    
+    def remover(self, *caminhos):
+        for caminho in caminhos:
+            if not caminho:
+                continue
+            self._esquecer(caminho)
+            try:
+                os.unlink(caminho)
+            except OSError:
+                pass
+    
+    def marcar_uso(self, sessao_id):
+        """Atualiza o mtime da pasta da sessão: pastas em uso não são tratadas como abandonadas"""
+        try:
+            os.utime(os.path.join(self.pasta_base, sessao_id))
+        except OSError:
+            pass
+    
+    def limpar_sessoes_antigas(self, max_idade_segundos, intervalo=0):
+        """
+        Remove as pastas de sessões abandonadas (sem alteração há `max_idade_segundos`)
+        e tira as fotos delas do LRU. Não refaz a varredura antes de `intervalo` segundos.
+        """
+        agora = time.time()
+        with self._lock:
+            if agora - self._ultima_limpeza < intervalo:
+                return
+            self._ultima_limpeza = agora
+        
+        limite = agora - max_idade_segundos
+        for nome in os.listdir(self.pasta_base):
+            pasta = os.path.join(self.pasta_base, nome)
+            try:
+                if not os.path.isdir(pasta) or os.path.getmtime(pasta) >= limite:
+                    continue
+            except OSError:
+                continue
+            prefixo = pasta + os.sep
+            with self._lock:
+                for chave in [c for c in self._lru if c[1].startswith(prefixo)]:
+                    _, tamanho = self._lru.pop(chave)
+                    self._uso_bytes -= tamanho
+            shutil.rmtree(pasta, ignore_errors=True)
+
+@st.cache_resource
+def obter_armazem_fotos():
+    """Armazém de fotos único por processo"""
+    armazem = ArmazemFotos(get_pasta_dados_app("fotos"), FOTOS_MEMORIA_MAX_MB * 1024 * 1024)
+    # Pasta compartilhada usada por versões anteriores, legível por outros usuários
+    shutil.rmtree(os.path.join(tempfile.gettempdir(), "RF-CREA-RJ-fotos"), ignore_errors=True)
+    armazem.limpar_sessoes_antigas(FOTOS_SESSAO_MAX_HORAS * 3600)
+    return armazem
+
+def obter_id_sessao_fotos():
+    """
+    Identificador da pasta de fotos da sessão atual. Marca a pasta como em uso e
+    aproveita a chamada para remover as pastas de sessões abandonadas (no máximo
+    uma vez por FOTOS_LIMPEZA_INTERVALO).
+    """
+    if 'sessao_fotos_id' not in st.session_state:
+        st.session_state.sessao_fotos_id = uuid.uuid4().hex
+    armazem = obter_armazem_fotos()
+    armazem.marcar_uso(st.session_state.sessao_fotos_id)
+    armazem.limpar_sessoes_antigas(FOTOS_SESSAO_MAX_HORAS * 3600, FOTOS_LIMPEZA_INTERVALO)
+    return st.session_state.sessao_fotos_id
+
 class FotoInfo:
-    def __init__(self, image_bytes, comentario="", foto_id=None):
+    """
+    Foto do relatório. Guarda apenas referências (caminhos) para o conteúdo,
+    que fica no ArmazemFotos; o session_state não carrega os bytes das fotos.
+    """
+    def __init__(self, image_bytes, comentario="", foto_id=None, digest=None, normalizar=True,
+                 sessao_id="sem-sessao"):
         self.foto_id = foto_id or str(uuid.uuid4())
-        self.image_bytes = image_bytes
+        # O digest é sempre do arquivo original, para reconhecer reenvios da mesma foto
+        self.digest = digest or calcular_digest_foto(image_bytes)
+        thumbnail_bytes = None
+        if normalizar:
+            try:
+                image_bytes, thumbnail_bytes = normalizar_foto(image_bytes)
+            except Exception:
+                # Sem normalização, o original só serve se o PDF conseguir embuti-lo
+                if foto_heif(image_bytes):
+                    raise ValueError("fotos HEIC (iPhone) não são suportadas neste servidor; "
+                                     "envie a foto em JPEG ou use a câmera do aplicativo")
+                if not foto_embutivel_no_pdf(image_bytes):
+                    raise ValueError("formato de imagem não suportado; envie a foto em JPEG ou PNG")
+        armazem = obter_armazem_fotos()
+        self.caminho_foto = armazem.gravar(sessao_id, f"{self.foto_id}.jpg", image_bytes)
+        self.caminho_thumbnail = None
+        if thumbnail_bytes:
+            self.caminho_thumbnail = armazem.gravar(sessao_id, f"{self.foto_id}_thumb.jpg", thumbnail_bytes)
         self.comentario = comentario
         self.timestamp = time.time()
-        self._image_obj = None
-        self._thumbnail = None
+    
+    @property
+    def image_bytes(self):
+        return obter_armazem_fotos().ler(self.caminho_foto)
     
     def get_image(self):
-        if self._image_obj is None:
-            self._image_obj = Image.open(BytesIO(self.image_bytes))
-        return self._image_obj
+        return obter_armazem_fotos().imagem(self.caminho_foto)
     
     def get_thumbnail(self, size=(200, 200)):
-        if self._thumbnail is None:
-            img = self.get_image()
-            self._thumbnail = img.copy()
-            self._thumbnail.thumbnail(size, Image.Resampling.LANCZOS)
-        return self._thumbnail
-    
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        if '_image_obj' in state:
-            del state['_image_obj']
-        if '_thumbnail' in state:
-            del state['_thumbnail']
-        return state
-    
-    def __setstate__(self, state):
-        self.__dict__.update(state)
-        self._image_obj = None
-        self._thumbnail = None
+        size = tuple(size)
+        # A miniatura armazenada atende a tamanhos até FOTO_THUMBNAIL_TAMANHO
+        if self.caminho_thumbnail and size[0] <= FOTO_THUMBNAIL_TAMANHO[0] and size[1] <= FOTO_THUMBNAIL_TAMANHO[1]:
+            return obter_armazem_fotos().imagem(self.caminho_thumbnail, size)
+        return obter_armazem_fotos().imagem(self.caminho_foto, size)
+    
+    def descartar(self):
+        """Apaga o conteúdo da foto do armazém"""
+        obter_armazem_fotos().remover(self.caminho_foto, self.caminho_thumbnail)
+
+# ========== ÍNDICE DE FOTOS DO RELATÓRIO (DEDUPLICAÇÃO) ==========
+def obter_indice_fotos():
+    """
+    Índice digest -> foto_id das fotos do relatório atual.
+    É reconstruído se estiver dessincronizado com st.session_state.fotos_info.
+    """
+    fotos_info = st.session_state.get('fotos_info', [])
+    indice = st.session_state.get('fotos_por_digest')
+    if indice is None or len(indice) != len(fotos_info):
+        indice = {foto.digest: foto.foto_id for foto in fotos_info}
+        st.session_state.fotos_por_digest = indice
+    return indice
+
+def adicionar_foto_ao_relatorio(image_bytes, comentario=""):
+    """
+    Adiciona a foto ao relatório se ainda não estiver nele (busca O(1) pelo digest).
+    Retorna a FotoInfo criada ou None se a foto já existir.
+    """
+    digest = calcular_digest_foto(image_bytes)
+    indice = obter_indice_fotos()
+    if digest in indice:
+        return None
+    
+    nova_foto = FotoInfo(image_bytes=image_bytes, comentario=comentario, digest=digest,
+                         sessao_id=obter_id_sessao_fotos())
+    st.session_state.fotos_info.append(nova_foto)
+    indice[digest] = nova_foto.foto_id
+    return nova_foto
+
+def remover_foto_do_relatorio(posicao):
+    """Remove a foto na posição indicada e atualiza o índice"""
+    foto = st.session_state.fotos_info.pop(posicao)
+    obter_indice_fotos().pop(foto.digest, None)
+    foto.descartar()
+    return foto
+
+def descartar_fotos_indisponiveis():
+    """
+    Mantém a pasta de fotos da sessão marcada como em uso e retira do relatório as
+    fotos cujos arquivos não existem mais (sessão parada por mais de
+    FOTOS_SESSAO_MAX_HORAS e removida pela limpeza). Retorna quantas foram retiradas.
+    """
+    obter_id_sessao_fotos()
+    fotos_info = st.session_state.get('fotos_info', [])
+    indisponiveis = [foto for foto in fotos_info if not os.path.exists(foto.caminho_foto)]
+    if not indisponiveis:
+        return 0
+    
+    st.session_state.fotos_info = [foto for foto in fotos_info if foto not in indisponiveis]
+    st.session_state.fotos_por_digest = None
+    for foto in indisponiveis:
+        foto.descartar()
+    return len(indisponiveis)
+
+def limpar_fotos_do_relatorio():
+    for foto in st.session_state.get('fotos_info', []):
+        foto.descartar()
+    st.session_state.fotos_info = []
+    st.session_state.fotos_por_digest = {}
+
+# ========== IMAGEM EM MEMÓRIA PARA O PDF ==========
+def imagem_jpeg_em_memoria(foto_info, img, img_resized):
+    """
+    Retorna um buffer JPEG pronto para o fpdf, sem arquivo temporário.
+    Se a foto original já é JPEG e não foi redimensionada, reaproveita os bytes
+    originais: o fpdf embute o fluxo JPEG diretamente, sem nova decodificação.
+    """
+    if img_resized is img and img.format == 'JPEG' and img.mode in ('RGB', 'L', 'CMYK'):
+        return BytesIO(foto_info.image_bytes)
+    
+    if img_resized.mode not in ('RGB', 'L'):
+        img_resized = img_resized.convert('RGB')
+    
+    buffer = BytesIO()
+    img_resized.save(buffer, 'JPEG', quality=85)
+    buffer.seek(0)
+    return buffer
+
+# ========== PRÉ-PROCESSAMENTO PARALELO DAS FOTOS ==========
+def preparar_foto_para_pdf(foto_info, max_width=PDF_FOTO_MAX_MM, max_height=PDF_FOTO_MAX_MM):
+    """
+    Decodifica, redimensiona e codifica uma foto para o PDF.
+    Retorna dict com 'imagem' (buffer JPEG), 'largura_mm' e 'altura_mm'.
+    """
+    img = foto_info.get_image()
+    img_width, img_height = img.size
+    
+    width_mm = img_width * MM_POR_PIXEL
+    height_mm = img_height * MM_POR_PIXEL
+    
+    if width_mm > max_width or height_mm > max_height:
+        ratio = min(max_width / width_mm, max_height / height_mm)
+        new_width_mm = width_mm * ratio
+        new_height_mm = height_mm * ratio
+        new_width_px = int(new_width_mm / MM_POR_PIXEL)
+        new_height_px = int(new_height_mm / MM_POR_PIXEL)
+        img_resized = img.resize((new_width_px, new_height_px), Image.Resampling.LANCZOS)
+    else:
+        img_resized = img
+        new_width_mm = width_mm
+        new_height_mm = height_mm
+    
+    return {
+        'imagem': imagem_jpeg_em_memoria(foto_info, img, img_resized),
+        'largura_mm': new_width_mm,
+        'altura_mm': new_height_mm
+    }
+
+def _preparar_foto_segura(foto_info):
+    try:
+        return preparar_foto_para_pdf(foto_info)
+    except Exception:
+        return None
+
+def preprocessar_fotos_para_pdf(fotos_info, max_workers=None):
+    """
+    Prepara todas as fotos em paralelo (o Pillow libera o GIL ao decodificar,
+    redimensionar e codificar). A ordem do resultado é a mesma de `fotos_info`;
+    fotos com erro aparecem como None.
+    """
+    if not fotos_info:
+        return []
+    
+    max_workers = max_workers or PDF_FOTO_WORKERS
+    if max_workers <= 1 or len(fotos_info) == 1:
+        return [_preparar_foto_segura(foto_info) for foto_info in fotos_info]
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(fotos_info)),
+                            thread_name_prefix="preparar-foto") as executor:
+        return list(executor.map(_preparar_foto_segura, fotos_info))
 
 # ========== CLASSE PDF ADAPTADA DO EXEC12.PY ==========
 class RelatorioPDF(FPDF):
@@ -1215,18 +3570,22 @@ class RelatorioPDF(FPDF):
         self.multi_cell(190, 8, self._safe(texto), 0, 'L', fill=True)
         self.ln(2)
 
-    def add_images_to_pdf(self, fotos_info):
-        """Adiciona imagens ao PDF"""
+    def add_images_to_pdf(self, fotos_info, fotos_preparadas=None):
+        """
+        Adiciona imagens ao PDF.
+        `fotos_preparadas` é o resultado de preprocessar_fotos_para_pdf; se não
+        for informado, o pré-processamento é feito aqui.
+        """
         if not fotos_info:
             return
         
+        if fotos_preparadas is None:
+            fotos_preparadas = preprocessar_fotos_para_pdf(fotos_info)
+        
         self.add_page()
         self.titulo_secao("FOTOS REGISTRADAS")
         
-        max_width = 170
-        max_height = 170
-        
-        for i, foto_info in enumerate(fotos_info, 1):
+        for i, (foto_info, foto_preparada) in enumerate(zip(fotos_info, fotos_preparadas), 1):
             try:
                 if i > 1:
                     self.add_page()
@@ -1234,41 +3593,17 @@ class RelatorioPDF(FPDF):
                 self.set_font('helvetica', 'B', 10)
                 self.cell(190, 6, self._safe(f"Foto {i}:"), 0, 1, 'L')
                 
-                # Processa a imagem
-                img = foto_info.get_image()
-                img_width, img_height = img.size
+                if foto_preparada is None:
+                    raise ValueError("foto não processada")
                 
-                width_mm = img_width * 0.264583
-                height_mm = img_height * 0.264583
-                
-                if width_mm > max_width or height_mm > max_height:
-                    ratio = min(max_width / width_mm, max_height / height_mm)
-                    new_width_mm = width_mm * ratio
-                    new_height_mm = height_mm * ratio
-                    new_width_px = int(new_width_mm / 0.264583)
-                    new_height_px = int(new_height_mm / 0.264583)
-                    img_resized = img.resize((new_width_px, new_height_px), Image.Resampling.LANCZOS)
-                else:
-                    img_resized = img
-                    new_width_mm = width_mm
-                    new_height_mm = height_mm
-                
-                # Salva temporariamente
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_img:
-                    img_resized.save(temp_img.name, 'JPEG', quality=85)
-                    temp_img_path = temp_img.name
+                new_width_mm = foto_preparada['largura_mm']
+                new_height_mm = foto_preparada['altura_mm']
                 
                 # Centraliza a imagem
                 x_position = (210 - new_width_mm) / 2
-                self.image(temp_img_path, x=x_position, y=self.get_y(), w=new_width_mm)
+                self.image(foto_preparada['imagem'], x=x_position, y=self.get_y(), w=new_width_mm)
                 self.set_y(self.get_y() + new_height_mm + 4)
                 
-                # Remove arquivo temporário
-                try:
-                    os.unlink(temp_img_path)
-                except:
-                    pass
-                
                 # Adiciona comentário se houver
                 if foto_info.comentario and foto_info.comentario.strip():
                     self.ln(2)
@@ -1316,10 +3651,13 @@ def formatar_matricula(matricula):
     return matricula_limpa.zfill(4)
 
 # ========== FUNÇÃO CRIAR PDF USANDO A ABORDAGEM DO EXEC12.PY ==========
-def criar_pdf(dados, logo_path, fotos_info=None, agente_info=None):
+def criar_pdf(dados, logo_path, fotos_info=None, agente_info=None, max_workers=None):
     """
-    Versão do criar_pdf baseada no exec12.py que funciona corretamente
+    Versão do criar_pdf baseada no exec12.py que funciona corretamente.
+    As fotos são pré-processadas em paralelo (`max_workers` threads) antes da montagem.
     """
+    fotos_preparadas = preprocessar_fotos_para_pdf(fotos_info, max_workers) if fotos_info else []
+    
     pdf = RelatorioPDF(logo_path=logo_path, agente_info=agente_info)
     pdf.add_page()
 
@@ -1581,7 +3919,7 @@ def criar_pdf(dados, logo_path, fotos_info=None, agente_info=None):
 
     # Adiciona as fotos
     if fotos_info:
-        pdf.add_images_to_pdf(fotos_info)
+        pdf.add_images_to_pdf(fotos_info, fotos_preparadas)
 
     # Assinatura
     if agente_info:
@@ -1592,7 +3930,7 @@ def criar_pdf(dados, logo_path, fotos_info=None, agente_info=None):
 # ========== FUNÇÕES PARA LIMPAR FORMULÁRIO ==========
 def limpar_formulario():
     if 'fotos_info' in st.session_state:
-        st.session_state.fotos_info = []
+        limpar_fotos_do_relatorio()
     if 'contratados_data' in st.session_state:
         st.session_state.contratados_data = []
     if 'current_foto_index' not in st.session_state:
@@ -1687,6 +4025,8 @@ def main():
         st.session_state.formulario_inicializado = False
     if 'fotos_info' not in st.session_state:
         st.session_state.fotos_info = []
+    if 'fotos_por_digest' not in st.session_state:
+        st.session_state.fotos_por_digest = {}
     if 'contratados_data' not in st.session_state:
         st.session_state.contratados_data = []
     if 'current_registro' not in st.session_state:
@@ -1713,10 +4053,8 @@ def main():
         st.session_state.contador_manager = None
     if 'temp_infracao' not in st.session_state:
         st.session_state.temp_infracao = ""
-    if 'senhas_dict' not in st.session_state:
-        st.session_state.senhas_dict = None
-    
-    dados_fiscais = carregar_dados_fiscais()
+    if 'diretorio_agentes' not in st.session_state:
+        st.session_state.diretorio_agentes = None
     
     # Página de login
     if not st.session_state.logged_in:
@@ -1751,26 +4089,29 @@ def main():
                         matricula_formatada = formatar_matricula(matricula_input)
                         
                         # Inicializa o serviço do Drive para verificar senhas
-                        drive_service = autenticar_google_drive()
+                        with medir_etapa('login.drive'):
+                            drive_service = autenticar_google_drive()
                         
                         if drive_service:
-                            # Carrega as senhas do Drive
-                            senhas_dict = carregar_senhas_do_drive(drive_service)
+                            # Garante a compactação periódica do journal da Planilha Master
+                            iniciar_compactacao_periodica(drive_service)
+                            iniciar_worker_outbox(drive_service)
+                            
+                            # Carrega senhas e dados dos fiscais (diretório de agentes)
+                            with medir_etapa('login.diretorio'):
+                                diretorio_agentes = carregar_diretorio_agentes(drive_service)
                             
-                            if senhas_dict:
+                            if diretorio_agentes:
                                 # Verifica as credenciais
                                 senha_valida, mensagem = verificar_credenciais(
-                                    matricula_limpa, senha_input, senhas_dict
+                                    matricula_limpa, senha_input, diretorio_agentes
                                 )
                                 
                                 if senha_valida:
-                                    # Busca informações do agente no arquivo Fiscais.xlsx
-                                    agente_info = None
-                                    if dados_fiscais:
-                                        if matricula_formatada in dados_fiscais:
-                                            agente_info = dados_fiscais[matricula_formatada]
-                                        elif matricula_limpa in dados_fiscais:
-                                            agente_info = dados_fiscais[matricula_limpa]
+                                    # Informações do agente vindas do Fiscais.xlsx
+                                    agente_info = agente_do_diretorio(
+                                        diretorio_agentes.get(normalizar_matricula(matricula_limpa))
+                                    )
                                     
                                     if agente_info:
                                         # Define a pasta local baseada na matrícula
@@ -1787,7 +4128,7 @@ def main():
                                         st.session_state.logged_in = True
                                         st.session_state.matricula = matricula_formatada
                                         st.session_state.agente_info = agente_info
-                                        st.session_state.senhas_dict = senhas_dict
+                                        st.session_state.diretorio_agentes = diretorio_agentes
                                         
                                         st.success(f"Login realizado! Agente: {agente_info['NOME']}")
                                         st.rerun()
@@ -1843,42 +4184,41 @@ def main():
         
         if st.session_state.logged_in:
             st.markdown("---")
+            exibir_status_outbox(st.session_state.matricula)
+            if usuario_administrador(st.session_state.matricula):
+                exibir_painel_telemetria()
+            periodo_master = st.date_input(
+                "Período da Planilha Master (opcional)", value=(), format="DD/MM/YYYY",
+                key="master_periodo"
+            )
+            contratados_em_colunas = st.checkbox(
+                "Contratados em colunas (formato antigo)", key="master_formato_largo",
+                help="Uma linha por relatório, com um bloco de colunas por contratado"
+            )
             if st.button("📊 Baixar Planilha Master", use_container_width=True, key="download_excel_button"):
                 try:
                     drive_service = autenticar_google_drive()
                     if drive_service:
                         with st.spinner("Carregando Planilha Master..."):
-                            df_dados, caminho_temp = carregar_planilha_master_drive(drive_service, GOOGLE_DRIVE_FOLDER_ID)
-                            if not df_dados.empty:
-                                excel_data = exportar_planilha_para_download(df_dados)
+                            data_inicio = periodo_master[0] if len(periodo_master) > 0 else None
+                            data_fim = periodo_master[1] if len(periodo_master) > 1 else data_inicio
+                            banco = sincronizar_planilha_master_drive(
+                                drive_service, GOOGLE_DRIVE_FOLDER_ID, data_inicio=data_inicio, data_fim=data_fim
+                            )
+                            filtros = {'data_inicio': data_inicio, 'data_fim': data_fim}
+                            total_registros_master = banco.contar(**filtros)
+                            if total_registros_master:
+                                excel_data = exportar_planilha_para_download(banco, contratados_em_colunas, **filtros)
                                 if excel_data:
-                                    b64 = base64.b64encode(excel_data).decode()
-                                    href = f'''
-                                    <a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" 
-                                       download="{EXCEL_DATABASE_NAME}" 
-                                       style="background-color: #2196F3; 
-                                              color: white; 
-                                              padding: 10px 20px; 
-                                              text-align: center; 
-                                              text-decoration: none; 
-                                              display: inline-block;
-                                              border-radius: 5px;
-                                              font-size: 14px;
-                                              font-weight: bold;
-                                              width: 100%;
-                                              display: block;
-                                      margin-top: 10px;">
-                                       📥 BAIXAR PLANILHA MASTER
-                                    </a>
-                                    '''
-                                    st.markdown(href, unsafe_allow_html=True)
-                                    st.success(f"✅ Planilha Master com {len(df_dados)} registros pronto para download!")
-                        
-                        if 'caminho_temp' in locals() and os.path.exists(caminho_temp):
-                            try:
-                                os.unlink(caminho_temp)
-                            except:
-                                pass
+                                    st.download_button(
+                                        label="📥 BAIXAR PLANILHA MASTER",
+                                        data=excel_data,
+                                        file_name=EXCEL_DATABASE_NAME,
+                                        mime=MIME_XLSX,
+                                        key="download_excel_arquivo",
+                                        use_container_width=True
+                                    )
+                                    st.success(f"✅ Planilha Master com {total_registros_master} registros pronto para download!")
                     else:
                         st.warning("⚠️ Não foi possível conectar ao Google Drive")
                 except Exception as e:
@@ -1897,7 +4237,7 @@ def main():
             st.session_state.form_widget_counter = 0
             st.session_state.pasta_local = None
             st.session_state.contador_manager = None
-            st.session_state.senhas_dict = None
+            st.session_state.diretorio_agentes = None
             limpar_formulario()
             st.rerun()
 
@@ -1929,7 +4269,7 @@ def main():
     st.markdown("Preencha os dados abaixo para gerar o relatório de fiscalização.")
     
     if not st.session_state.formulario_inicializado:
-        st.session_state.fotos_info = []
+        limpar_fotos_do_relatorio()
         st.session_state.contratados_data = []
         st.session_state.current_registro = limpar_campos_registro()
         st.session_state.registro_counter = 1
@@ -2577,6 +4917,12 @@ def main():
     # ===== SEÇÃO 08 =====
     st.markdown("### 08 - FOTOS - REGISTRO FOTOGRÁFICO")
     
+    fotos_indisponiveis = descartar_fotos_indisponiveis()
+    if fotos_indisponiveis:
+        st.warning(f"⚠️ {fotos_indisponiveis} foto(s) deste relatório não estão mais disponíveis no servidor "
+                   f"(formulário parado por mais de {FOTOS_SESSAO_MAX_HORAS} horas) e foram retiradas. "
+                   "Adicione-as novamente antes de enviar o relatório.")
+    
     if 'temp_photo_bytes' not in st.session_state:
         st.session_state.temp_photo_bytes = None
     
@@ -2628,17 +4974,11 @@ def main():
                 if st.button("💾 Salvar Foto", use_container_width=True,
                            disabled=st.session_state.temp_photo_bytes is None,
                            key=f"salvar_foto_button_{widget_counter}"):
-                    foto_existe = False
-                    for foto in st.session_state.fotos_info:
-                        if foto.image_bytes == st.session_state.temp_photo_bytes:
-                            foto_existe = True
-                            break
-                    if not foto_existe:
-                        nova_foto = FotoInfo(
-                            image_bytes=st.session_state.temp_photo_bytes,
-                            comentario=novo_comentario
-                        )
-                        st.session_state.fotos_info.append(nova_foto)
+                    nova_foto = adicionar_foto_ao_relatorio(
+                        st.session_state.temp_photo_bytes,
+                        comentario=novo_comentario
+                    )
+                    if nova_foto is not None:
                         st.session_state.temp_photo_bytes = None
                         st.session_state.camera_counter = st.session_state.get('camera_counter', 0) + 1
                         st.success(f"✅ Foto {len(st.session_state.fotos_info)} salva com sucesso!")
@@ -2691,28 +5031,26 @@ def main():
                 if st.button("📤 Adicionar Todas as Fotos", type="primary", use_container_width=True,
                            key=f"adicionar_todas_fotos_{widget_counter}"):
                     fotos_adicionadas = 0
+                    fotos_recusadas = 0
                     for uploaded_file in uploaded_files:
                         try:
                             img_bytes = uploaded_file.getvalue()
-                            foto_existe = False
-                            for foto in st.session_state.fotos_info:
-                                if foto.image_bytes == img_bytes:
-                                    foto_existe = True
-                                    break
-                            if not foto_existe:
-                                nova_foto = FotoInfo(
-                                    image_bytes=img_bytes,
-                                    comentario=upload_comentario
-                                )
-                                st.session_state.fotos_info.append(nova_foto)
+                            nova_foto = adicionar_foto_ao_relatorio(
+                                img_bytes,
+                                comentario=upload_comentario
+                            )
+                            if nova_foto is not None:
                                 fotos_adicionadas += 1
                         except Exception as e:
-                            st.error(f"Erro ao processar arquivo: {e}")
-                    if fotos_adicionadas > 0:
+                            fotos_recusadas += 1
+                            st.error(f"❌ {uploaded_file.name}: {e}")
+                    if fotos_adicionadas > 0 and not fotos_recusadas:
                         st.success(f"✅ {fotos_adicionadas} foto(s) adicionada(s) com sucesso!")
                         time.sleep(0.5)
                         st.rerun()
-                    else:
+                    elif fotos_adicionadas > 0:
+                        st.success(f"✅ {fotos_adicionadas} foto(s) adicionada(s); as fotos acima não foram incluídas.")
+                    elif not fotos_recusadas:
                         st.warning("Todas as fotos selecionadas já estão no relatório.")
             with col_process2:
                 if st.button("🗑️ Limpar Seleção", type="secondary", use_container_width=True,
@@ -2759,7 +5097,7 @@ def main():
                 if st.button("🗑️ Remover", type="secondary", use_container_width=True,
                            key=f"remover_foto_atual_gestao_{widget_counter}"):
                     if 0 <= current_foto_idx < total_fotos:
-                        st.session_state.fotos_info.pop(current_foto_idx)
+                        remover_foto_do_relatorio(current_foto_idx)
                         st.session_state.current_foto_index = max(0, min(current_foto_idx, total_fotos - 2))
                         st.success("Foto removida com sucesso!")
                         time.sleep(0.3)
@@ -2816,7 +5154,7 @@ def main():
                     if st.button("🗑️ Remover Todas", type="secondary", use_container_width=True,
                                key=f"remover_todas_fotos_{widget_counter}"):
                         if st.checkbox("Confirmar remoção de TODAS as fotos", key=f"confirmar_remocao_{widget_counter}"):
-                            st.session_state.fotos_info = []
+                            limpar_fotos_do_relatorio()
                             st.session_state.current_foto_index = 0
                             st.success("Todas as fotos foram removidas!")
                             time.sleep(0.5)
@@ -2879,9 +5217,16 @@ def main():
             
             # GERA O NÚMERO DO RELATÓRIO APENAS AGORA!
             if st.session_state.contador_manager:
-                numero_completo, numero_seq = st.session_state.contador_manager.gerar_novo_numero(
-                    st.session_state.matricula
-                )
+                try:
+                    with medir_etapa('envio.numero', matricula=st.session_state.matricula) as span:
+                        numero_completo, numero_seq = st.session_state.contador_manager.gerar_novo_numero(
+                            st.session_state.matricula
+                        )
+                        span['relatorio'] = numero_completo
+                except Exception as e:
+                    st.error(f"❌ Não foi possível gerar o número do relatório: {str(e)}. "
+                             "Nada foi enviado; tente novamente em instantes.")
+                    st.stop()
                 st.session_state.numero_relatorio_gerado = numero_completo
                 st.session_state.numero_sequencial = numero_seq
             
@@ -3002,57 +5347,71 @@ def main():
                 progress_bar.progress(10)
                 
                 status_text.text("📄 Criando PDF...")
-                pdf = criar_pdf(dados, "10.png" if os.path.exists("10.png") else None, 
-                              st.session_state.fotos_info, st.session_state.agente_info)
+                numero_relatorio = st.session_state.numero_relatorio_gerado
+                with medir_etapa('envio.pdf', relatorio=numero_relatorio, fotos=len(st.session_state.fotos_info)):
+                    pdf = criar_pdf(dados, "10.png" if os.path.exists("10.png") else None, 
+                                  st.session_state.fotos_info, st.session_state.agente_info)
                 progress_bar.progress(40)
                 
                 status_text.text("💾 Salvando PDF...")
-                caminho_pdf = salvar_pdf_adaptado(
-                    pdf, 
-                    st.session_state.matricula, 
-                    st.session_state.numero_relatorio_gerado
-                )
+                with medir_etapa('envio.salvar_pdf', relatorio=numero_relatorio):
+                    caminho_pdf = salvar_pdf_adaptado(
+                        pdf, 
+                        st.session_state.matricula, 
+                        numero_relatorio
+                    )
                 
                 if caminho_pdf:
                     progress_bar.progress(70)
                     
-                    status_text.text("📊 Atualizando Planilha Master na nuvem...")
+                    status_text.text("📤 Enviando relatório ao Google Drive...")
                     
+                    # O envio depende apenas do serviço já autenticado no login
                     drive_service = autenticar_google_drive()
-                    
                     excel_sucesso = False
-                    if drive_service:
-                        excel_sucesso = adicionar_relatorio_a_planilha_master(
-                            dados_relatorio=dados,
-                            agente_info=st.session_state.agente_info,
-                            fotos_info=st.session_state.fotos_info,
-                            service=drive_service,
-                            folder_id=GOOGLE_DRIVE_FOLDER_ID,
-                            tipo_visita_outros=tipo_visita_outros,
-                            caracteristica_outros=caracteristica_outros,
-                            fase_atividade_outros=fase_atividade_outros,
-                            unidade_medida_outros=unidade_medida_outros,
-                            natureza_outros=natureza_outros,
-                            tipo_construcao_outros=tipo_construcao_outros,
-                            circular_numero=circular_numero,
-                            outros_texto_solicitado=outros_texto_solicitado,
-                            circular_numero_recebido=circular_numero_recebido,
-                            quadro_tecnico_quantidade=quadro_tecnico_quantidade,
-                            prestadores_quantidade=prestadores_quantidade,
-                            outros_texto_recebido=outros_texto_recebido,
-                            qualificacao_outros=qualificacao_outros,
-                            situacao_contratante=situacao_contratante,
-                            tipo_infracao=tipo_infracao,
-                            infracao_selecionada=infracao_selecionada
-                        )
-                        
-                        if excel_sucesso:
-                            progress_bar.progress(90)
-                            st.success("✅ Dados do relatório adicionados à Planilha Master na nuvem!")
+                    enviado_drive = False
+                    try:
+                        with medir_etapa('envio.preparar_registro', relatorio=numero_relatorio):
+                            novos_dados = preparar_dados_para_planilha_master(
+                                dados, st.session_state.agente_info, st.session_state.fotos_info,
+                                tipo_visita_outros, caracteristica_outros, fase_atividade_outros,
+                                unidade_medida_outros, natureza_outros, tipo_construcao_outros,
+                                circular_numero, outros_texto_solicitado,
+                                circular_numero_recebido, quadro_tecnico_quantidade,
+                                prestadores_quantidade, outros_texto_recebido,
+                                qualificacao_outros,
+                                situacao_contratante, tipo_infracao, infracao_selecionada
+                            )
+                        with medir_etapa('envio.banco_local', relatorio=numero_relatorio):
+                            obter_banco_relatorios().salvar(novos_dados)
+                        with medir_etapa('envio.drive', relatorio=numero_relatorio):
+                            enviado_drive = enviar_relatorio(
+                                drive_service, GOOGLE_DRIVE_FOLDER_ID,
+                                caminho_pdf, novos_dados, st.session_state.matricula
+                            )
+                        excel_sucesso = True
+                    except Exception as e:
+                        st.error(f"❌ Erro ao registrar o relatório para envio: {str(e)}")
+                    
+                    if excel_sucesso:
+                        progress_bar.progress(90)
+                        if enviado_drive:
+                            st.success("✅ Relatório enviado ao Google Drive!")
+                        elif fila_local_persistente():
+                            st.info("📥 Relatório salvo na fila de envio. Ele AINDA NÃO está no Google Drive: "
+                                    "o envio é feito em segundo plano; acompanhe na barra lateral.")
                         else:
-                            st.warning("⚠️ Dados do PDF gerados, mas não foi possível atualizar a Planilha Master na nuvem.")
+                            st.warning("⚠️ O relatório AINDA NÃO foi enviado ao Google Drive. Ele ficou na fila "
+                                       "de envio e será reenviado automaticamente; acompanhe na barra lateral.")
+                            st.error("❗ Neste servidor a fila é temporária: se o aplicativo reiniciar antes "
+                                     "do envio, o relatório se perde. Baixe o PDF (botão acima) e guarde-o até a "
+                                     "barra lateral mostrar \"✅ Sincronizado\".")
+                        
+                        if drive_service:
+                            iniciar_compactacao_periodica(drive_service)
+                            iniciar_worker_outbox(drive_service)
                     else:
-                        st.warning("⚠️ Não foi possível conectar ao Google Drive para atualizar a Planilha Master.")
+                        st.warning("⚠️ PDF gerado, mas não foi possível registrá-lo para envio à Planilha Master.")
                     
                     progress_bar.progress(100)
                     status_text.text("✅ Relatório pronto!")
@@ -3074,62 +5433,45 @@ def main():
                     else:
                         resumo_texto += f"\n- **📁 PDF salvo em:** {caminho_pdf}"
                     
-                    if excel_sucesso:
-                        resumo_texto += "\n- **📊 Planilha Master:** Dados atualizados com sucesso na nuvem!"
+                    if enviado_drive:
+                        resumo_texto += "\n- **☁️ Google Drive:** PDF e registro da Planilha Master enviados"
+                    elif excel_sucesso:
+                        resumo_texto += "\n- **☁️ Google Drive:** Ainda não enviado (na fila de envio)"
                     
                     st.info(resumo_texto)
                     
                     st.markdown("---")
                     st.subheader("📊 Planilha Master na Nuvem")
-                    st.info(f"Os dados deste relatório foram adicionados à Planilha Master no Google Drive.")
+                    st.info(f"Os dados deste relatório serão incluídos na Planilha Master assim que o envio for concluído.")
                     
                     if st.button("📥 Baixar Planilha Master da Nuvem", key=f"download_master_excel_{widget_counter}",
                                use_container_width=True):
                         drive_service = autenticar_google_drive()
                         if drive_service:
                             with st.spinner("Carregando Planilha Master..."):
-                                df_dados, caminho_temp = carregar_planilha_master_drive(drive_service, GOOGLE_DRIVE_FOLDER_ID)
-                                if not df_dados.empty:
-                                    excel_data = exportar_planilha_para_download(df_dados)
+                                banco = sincronizar_planilha_master_drive(drive_service, GOOGLE_DRIVE_FOLDER_ID)
+                                resumo_master = banco.resumo()
+                                if resumo_master['total']:
+                                    excel_data = exportar_planilha_para_download(banco)
                                     if excel_data:
-                                        b64_excel = base64.b64encode(excel_data).decode()
-                                        href_excel = f'''
-                                        <a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64_excel}" 
-                                           download="{EXCEL_DATABASE_NAME}" 
-                                           style="background-color: #2196F3; 
-                                                  color: white; 
-                                                  padding: 14px 25px; 
-                                                  text-align: center; 
-                                                  text-decoration: none; 
-                                                  display: inline-block;
-                                                  border-radius: 8px;
-                                                  font-size: 16px;
-                                                  font-weight: bold;
-                                                  width: 100%;
-                                                  display: block;
-                                                  margin-top: 10px;">
-                                           📥 BAIXAR PLANILHA MASTER ({len(df_dados)} registros)
-                                        </a>
-                                        '''
-                                        st.markdown(href_excel, unsafe_allow_html=True)
+                                        st.download_button(
+                                            label=f"📥 BAIXAR PLANILHA MASTER ({resumo_master['total']} registros)",
+                                            data=excel_data,
+                                            file_name=EXCEL_DATABASE_NAME,
+                                            mime=MIME_XLSX,
+                                            key=f"download_master_excel_arquivo_{widget_counter}",
+                                            use_container_width=True
+                                        )
                                         
                                         with st.expander("📊 Estatísticas da Planilha Master"):
-                                            st.write(f"**Total de registros:** {len(df_dados)}")
-                                            if 'DATA_GERACAO' in df_dados.columns:
-                                                ultima_data = df_dados['DATA_GERACAO'].max() if not df_dados['DATA_GERACAO'].empty else 'N/A'
-                                                st.write(f"**Última atualização:** {ultima_data}")
-                                            if 'AGENTE_NOME' in df_dados.columns:
-                                                agentes_unicos = df_dados['AGENTE_NOME'].nunique()
-                                                st.write(f"**Agentes distintos:** {agentes_unicos}")
+                                            st.write(f"**Total de registros:** {resumo_master['total']}")
+                                            st.write(f"**Última atualização:** {resumo_master['ultima_geracao'] or 'N/A'}")
+                                            st.write(f"**Agentes distintos:** {resumo_master['agentes']}")
                                         
                                         with st.expander("📋 Visualizar Dados da Planilha Master"):
-                                            st.dataframe(df_dados)
-                                    
-                                    if 'caminho_temp' in locals() and os.path.exists(caminho_temp):
-                                        try:
-                                            os.unlink(caminho_temp)
-                                        except:
-                                            pass
+                                            if resumo_master['total'] > PLANILHA_VISUALIZACAO_LINHAS:
+                                                st.caption(f"Exibindo os {PLANILHA_VISUALIZACAO_LINHAS} registros mais recentes")
+                                            st.dataframe(banco.para_dataframe(limite=PLANILHA_VISUALIZACAO_LINHAS))
                                 else:
                                     st.warning("Planilha Master vazia ou não encontrada")
                         else:
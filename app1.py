@@ -13,6 +13,8 @@ import time
 import uuid
 import pickle
 import shutil
+import unicodedata
+from functools import lru_cache
 from pathlib import Path
 
 # ========== IMPORTAÇÕES DO GOOGLE DRIVE ==========
@@ -40,6 +42,32 @@ CONTADOR_FILENAME = "contador_relatorios.json"
 SENHAS_FILENAME = "Senhas.xlsx"
 
 # ========== FUNÇÃO PARA SUBSTITUIR CARACTERES ESPECIAIS ==========
+# Mapeamento de caracteres especiais para equivalentes suportados
+SUBSTITUICOES_ACENTOS = str.maketrans({
+    'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a', 'ä': 'a',
+    'é': 'e', 'è': 'e', 'ê': 'e', 'ë': 'e',
+    'í': 'i', 'ì': 'i', 'î': 'i', 'ï': 'i',
+    'ó': 'o', 'ò': 'o', 'ô': 'o', 'õ': 'o', 'ö': 'o',
+    'ú': 'u', 'ù': 'u', 'û': 'u', 'ü': 'u',
+    'ç': 'c', 'ñ': 'n',
+    'Á': 'A', 'À': 'A', 'Â': 'A', 'Ã': 'A', 'Ä': 'A',
+    'É': 'E', 'È': 'E', 'Ê': 'E', 'Ë': 'E',
+    'Í': 'I', 'Ì': 'I', 'Î': 'I', 'Ï': 'I',
+    'Ó': 'O', 'Ò': 'O', 'Ô': 'O', 'Õ': 'O', 'Ö': 'O',
+    'Ú': 'U', 'Ù': 'U', 'Û': 'U', 'Ü': 'U',
+    'Ç': 'C', 'Ñ': 'N',
+    'º': 'o', 'ª': 'a',
+    '—': '-', '–': '-',
+    '“': '"', '”': '"', '‘': "'", '’': "'",
+    '\u2013': '-',  # meia risca (en dash) para hífen
+    '\u2014': '-',  # travessão (em dash) para hífen
+    '\u2018': "'",  # aspas simples esquerda para aspas simples
+    '\u2019': "'",  # aspas simples direita para aspas simples
+    '\u201C': '"',  # aspas duplas esquerda para aspas duplas
+    '\u201D': '"',  # aspas duplas direita para aspas duplas
+    '\u2026': '...',  # reticências para três pontos
+})
+
 def remover_acentos(texto):
     """
     Substitui caracteres especiais não suportados pela fonte Helvetica do FPDF
@@ -47,40 +75,21 @@ def remover_acentos(texto):
     """
     if not isinstance(texto, str):
         return str(texto) if texto is not None else ""
+    return _remover_acentos_str(texto)
+
+@lru_cache(maxsize=4096)
+def _remover_acentos_str(texto):
+    # Textos repetidos (títulos, infrações) são resolvidos uma única vez
+    texto = texto.translate(SUBSTITUICOES_ACENTOS)
+    if texto.isascii():
+        return texto
     
-    # Mapeamento de caracteres especiais para equivalentes suportados
-    substituicoes = {
-        'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a', 'ä': 'a',
-        'é': 'e', 'è': 'e', 'ê': 'e', 'ë': 'e',
-        'í': 'i', 'ì': 'i', 'î': 'i', 'ï': 'i',
-        'ó': 'o', 'ò': 'o', 'ô': 'o', 'õ': 'o', 'ö': 'o',
-        'ú': 'u', 'ù': 'u', 'û': 'u', 'ü': 'u',
-        'ç': 'c', 'ñ': 'n',
-        'Á': 'A', 'À': 'A', 'Â': 'A', 'Ã': 'A', 'Ä': 'A',
-        'É': 'E', 'È': 'E', 'Ê': 'E', 'Ë': 'E',
-        'Í': 'I', 'Ì': 'I', 'Î': 'I', 'Ï': 'I',
-        'Ó': 'O', 'Ò': 'O', 'Ô': 'O', 'Õ': 'O', 'Ö': 'O',
-        'Ú': 'U', 'Ù': 'U', 'Û': 'U', 'Ü': 'U',
-        'Ç': 'C', 'Ñ': 'N',
-        'º': 'o', 'ª': 'a',
-        '—': '-', '–': '-',
-        '“': '"', '”': '"', '‘': "'", '’': "'",
-        '\u2013': '-',  # meia risca (en dash) para hífen
-        '\u2014': '-',  # travessão (em dash) para hífen
-        '\u2018': "'",  # aspas simples esquerda para aspas simples
-        '\u2019': "'",  # aspas simples direita para aspas simples
-        '\u201C': '"',  # aspas duplas esquerda para aspas duplas
-        '\u201D': '"',  # aspas duplas direita para aspas duplas
-        '\u2026': '...',  # reticências para três pontos
-    }
-    
-    for char_especial, char_normal in substituicoes.items():
-        texto = texto.replace(char_especial, char_normal)
+    # Caracteres fora da tabela: decompõe e descarta os acentos combinantes
+    texto = unicodedata.normalize('NFKD', texto)
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
     
     # Remove qualquer caractere que ainda não seja ASCII
-    texto = texto.encode('ascii', 'replace').decode('ascii')
-    
-    return texto
+    return texto.encode('ascii', 'replace').decode('ascii')
 
 # ========== DADOS DAS MULTAS (SANITIZADOS) ==========
 INFRACOES_PF = [
@@ -513,12 +522,34 @@ def baixar_arquivo_do_drive(service, nome_arquivo, folder_id):
         st.error(f"❌ Erro ao baixar arquivo do Drive: {str(e)}")
         return None
 
+# ========== ÍNDICE DE SENHAS ==========
+def normalizar_matricula(matricula):
+    """Chave de comparação da matrícula: sem espaços e sem zeros à esquerda"""
+    return str(matricula).strip().lstrip('0')
+
+def indexar_senhas(df):
+    """
+    Índice matrícula normalizada -> {'MATRICULA', 'SENHA'} montado com operações
+    vetorizadas, uma vez por carga do arquivo. Se duas matrículas coincidem após
+    a normalização, vale a primeira.
+    """
+    df = df[df['MATRICULA'].notna() & df['SENHA'].notna()]
+    df = pd.DataFrame({
+        'MATRICULA': df['MATRICULA'].astype(str).str.strip(),
+        'SENHA': df['SENHA'].astype(str).str.strip()
+    })
+    df = df[(df['MATRICULA'] != '') & (df['SENHA'] != '')]
+    df = df.drop_duplicates('MATRICULA', keep='last')
+    chaves = df['MATRICULA'].str.lstrip('0')
+    df = df[~chaves.duplicated(keep='first')]
+    return dict(zip(chaves[df.index], df.to_dict('records')))
+
 # ========== FUNÇÃO PARA CARREGAR SENHAS DO GOOGLE DRIVE (CORRIGIDA) ==========
 @st.cache_data(ttl=300)  # Cache de 5 minutos
 def carregar_senhas_do_drive(_service):
     """
-    Carrega o arquivo de senhas do Google Drive e retorna um dicionário
-    com matrícula como chave e senha como valor
+    Carrega o arquivo de senhas do Google Drive e retorna o índice de senhas
+    (matrícula normalizada -> registro), ver indexar_senhas
     O parâmetro _service tem underscore para não ser hasheado pelo cache
     """
     try:
@@ -546,21 +577,8 @@ def carregar_senhas_do_drive(_service):
                 st.error(f"Coluna '{coluna}' não encontrada no arquivo Senhas.xlsx")
                 return None
         
-        # Converte matrícula para string e remove espaços
-        df['MATRICULA'] = df['MATRICULA'].astype(str).str.strip()
-        df['SENHA'] = df['SENHA'].astype(str).str.strip()
-        
-        # Filtra linhas com dados válidos
-        df = df[df['MATRICULA'].notna() & (df['MATRICULA'] != '') & 
-                df['SENHA'].notna() & (df['SENHA'] != '')]
-        
-        # Cria dicionário de senhas
-        senhas_dict = {}
-        for _, row in df.iterrows():
-            matricula = str(row['MATRICULA']).strip()
-            senhas_dict[matricula] = str(row['SENHA']).strip()
-        
-        return senhas_dict
+        # Índice já normalizado: o login é uma única consulta ao dicionário
+        return indexar_senhas(df)
         
     except Exception as e:
         st.error(f"❌ Erro ao carregar senhas do Drive: {str(e)}")
@@ -574,20 +592,15 @@ def verificar_credenciais(matricula, senha, senhas_dict):
     if not senhas_dict:
         return False, "Erro ao carregar dados de senha"
     
-    # Formata a matrícula para busca (remover zeros à esquerda para comparar)
-    matricula_busca = matricula.lstrip('0')
+    # O índice é chaveado pela matrícula sem zeros à esquerda
+    registro = senhas_dict.get(normalizar_matricula(matricula))
     
-    # Tenta encontrar a matrícula no dicionário
-    for matricula_registro, senha_registro in senhas_dict.items():
-        matricula_registro_limpa = matricula_registro.lstrip('0')
-        
-        if matricula_busca == matricula_registro_limpa:
-            if senha == senha_registro:
-                return True, "Credenciais válidas"
-            else:
-                return False, "Senha incorreta"
+    if registro is None:
+        return False, "Matrícula não encontrada"
     
-    return False, "Matrícula não encontrada"
+    if senha == registro['SENHA']:
+        return True, "Credenciais válidas"
+    return False, "Senha incorreta"
 
 # ========== FUNÇÃO PARA CARREGAR DADOS DOS FISCAIS ==========
 @st.cache_data(ttl=3600)
@@ -1140,6 +1153,24 @@ class FotoInfo:
         self._image_obj = None
         self._thumbnail = None
 
+# ========== IMAGEM EM MEMÓRIA PARA O PDF ==========
+def imagem_jpeg_em_memoria(foto_info, img, img_resized):
+    """
+    Retorna um buffer JPEG pronto para o fpdf, sem arquivo temporário.
+    Se a foto original já é JPEG e não foi redimensionada, reaproveita os bytes
+    originais: o fpdf embute o fluxo JPEG diretamente, sem nova decodificação.
+    """
+    if img_resized is img and img.format == 'JPEG' and img.mode in ('RGB', 'L', 'CMYK'):
+        return BytesIO(foto_info.image_bytes)
+    
+    if img_resized.mode not in ('RGB', 'L'):
+        img_resized = img_resized.convert('RGB')
+    
+    buffer = BytesIO()
+    img_resized.save(buffer, 'JPEG', quality=85)
+    buffer.seek(0)
+    return buffer
+
 # ========== CLASSE PDF ADAPTADA DO EXEC12.PY ==========
 class RelatorioPDF(FPDF):
     def __init__(self, logo_path=None, agente_info=None):
@@ -1258,22 +1289,14 @@ class RelatorioPDF(FPDF):
                     new_width_mm = width_mm
                     new_height_mm = height_mm
                 
-                # Salva temporariamente
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_img:
-                    img_resized.save(temp_img.name, 'JPEG', quality=85)
-                    temp_img_path = temp_img.name
+                # Codifica em memória (sem arquivo temporário)
+                imagem_jpeg = imagem_jpeg_em_memoria(foto_info, img, img_resized)
                 
                 # Centraliza a imagem
                 x_position = (210 - new_width_mm) / 2
-                self.image(temp_img_path, x=x_position, y=self.get_y(), w=new_width_mm)
+                self.image(imagem_jpeg, x=x_position, y=self.get_y(), w=new_width_mm)
                 self.set_y(self.get_y() + new_height_mm + 4)
                 
-                # Remove arquivo temporário
-                try:
-                    os.unlink(temp_img_path)
-                except:
-                    pass
-                
                 # Adiciona comentário se houver
                 if foto_info.comentario and foto_info.comentario.strip():
                     self.ln(2)
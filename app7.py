@@ -15,6 +15,7 @@ import time
 import uuid
 import pickle
 import shutil
+from functools import lru_cache
 from pathlib import Path
 
 # ========== IMPORTAÇÕES DO GOOGLE DRIVE ==========
@@ -137,6 +138,32 @@ def atualizar_cep():
     st.session_state.cep_input = formatar_cep_str(raw)
 
 # ========== FUNÇÃO PARA SUBSTITUIR CARACTERES ESPECIAIS ==========
+# Mapeamento de caracteres especiais para equivalentes suportados
+SUBSTITUICOES_ACENTOS = str.maketrans({
+    'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a', 'ä': 'a',
+    'é': 'e', 'è': 'e', 'ê': 'e', 'ë': 'e',
+    'í': 'i', 'ì': 'i', 'î': 'i', 'ï': 'i',
+    'ó': 'o', 'ò': 'o', 'ô': 'o', 'õ': 'o', 'ö': 'o',
+    'ú': 'u', 'ù': 'u', 'û': 'u', 'ü': 'u',
+    'ç': 'c', 'ñ': 'n',
+    'Á': 'A', 'À': 'A', 'Â': 'A', 'Ã': 'A', 'Ä': 'A',
+    'É': 'E', 'È': 'E', 'Ê': 'E', 'Ë': 'E',
+    'Í': 'I', 'Ì': 'I', 'Î': 'I', 'Ï': 'I',
+    'Ó': 'O', 'Ò': 'O', 'Ô': 'O', 'Õ': 'O', 'Ö': 'O',
+    'Ú': 'U', 'Ù': 'U', 'Û': 'U', 'Ü': 'U',
+    'Ç': 'C', 'Ñ': 'N',
+    'º': 'o', 'ª': 'a',
+    '—': '-', '–': '-',
+    '“': '"', '”': '"', '‘': "'", '’': "'",
+    '\u2013': '-',  # meia risca (en dash) para hífen
+    '\u2014': '-',  # travessão (em dash) para hífen
+    '\u2018': "'",  # aspas simples esquerda para aspas simples
+    '\u2019': "'",  # aspas simples direita para aspas simples
+    '\u201C': '"',  # aspas duplas esquerda para aspas duplas
+    '\u201D': '"',  # aspas duplas direita para aspas duplas
+    '\u2026': '...',  # reticências para três pontos
+})
+
 def remover_acentos(texto):
     """
     Substitui caracteres especiais não suportados pela fonte Helvetica do FPDF
@@ -144,37 +171,12 @@ def remover_acentos(texto):
     """
     if not isinstance(texto, str):
         return str(texto) if texto is not None else ""
-    
-    # Mapeamento de caracteres especiais para equivalentes suportados
-    substituicoes = {
-        'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a', 'ä': 'a',
-        'é': 'e', 'è': 'e', 'ê': 'e', 'ë': 'e',
-        'í': 'i', 'ì': 'i', 'î': 'i', 'ï': 'i',
-        'ó': 'o', 'ò': 'o', 'ô': 'o', 'õ': 'o', 'ö': 'o',
-        'ú': 'u', 'ù': 'u', 'û': 'u', 'ü': 'u',
-        'ç': 'c', 'ñ': 'n',
-        'Á': 'A', 'À': 'A', 'Â': 'A', 'Ã': 'A', 'Ä': 'A',
-        'É': 'E', 'È': 'E', 'Ê': 'E', 'Ë': 'E',
-        'Í': 'I', 'Ì': 'I', 'Î': 'I', 'Ï': 'I',
-        'Ó': 'O', 'Ò': 'O', 'Ô': 'O', 'Õ': 'O', 'Ö': 'O',
-        'Ú': 'U', 'Ù': 'U', 'Û': 'U', 'Ü': 'U',
-        'Ç': 'C', 'Ñ': 'N',
-        'º': 'o', 'ª': 'a',
-        '—': '-', '–': '-',
-        '“': '"', '”': '"', '‘': "'", '’': "'",
-        '\u2013': '-',  # meia risca (en dash) para hífen
-        '\u2014': '-',  # travessão (em dash) para hífen
-        '\u2018': "'",  # aspas simples esquerda para aspas simples
-        '\u2019': "'",  # aspas simples direita para aspas simples
-        '\u201C': '"',  # aspas duplas esquerda para aspas duplas
-        '\u201D': '"',  # aspas duplas direita para aspas duplas
-        '\u2026': '...',  # reticências para três pontos
-    }
-    
-    for char_especial, char_normal in substituicoes.items():
-        texto = texto.replace(char_especial, char_normal)
-    
-    return texto
+    return _remover_acentos_str(texto)
+
+@lru_cache(maxsize=4096)
+def _remover_acentos_str(texto):
+    # Textos repetidos (títulos, rótulos) são resolvidos uma única vez
+    return texto.translate(SUBSTITUICOES_ACENTOS)
 
 # ========== FUNÇÃO PARA ADICIONAR FONTE UNICODE AO PDF ==========
 def adicionar_fonte_unicode(pdf):
@@ -629,12 +631,34 @@ def baixar_arquivo_do_drive(service, nome_arquivo, folder_id):
         st.error(f"❌ Erro ao baixar arquivo do Drive: {str(e)}")
         return None
 
+# ========== ÍNDICE DE SENHAS ==========
+def normalizar_matricula(matricula):
+    """Chave de comparação da matrícula: sem espaços e sem zeros à esquerda"""
+    return str(matricula).strip().lstrip('0')
+
+def indexar_senhas(df):
+    """
+    Índice matrícula normalizada -> {'MATRICULA', 'SENHA'} montado com operações
+    vetorizadas, uma vez por carga do arquivo. Se duas matrículas coincidem após
+    a normalização, vale a primeira.
+    """
+    df = df[df['MATRICULA'].notna() & df['SENHA'].notna()]
+    df = pd.DataFrame({
+        'MATRICULA': df['MATRICULA'].astype(str).str.strip(),
+        'SENHA': df['SENHA'].astype(str).str.strip()
+    })
+    df = df[(df['MATRICULA'] != '') & (df['SENHA'] != '')]
+    df = df.drop_duplicates('MATRICULA', keep='last')
+    chaves = df['MATRICULA'].str.lstrip('0')
+    df = df[~chaves.duplicated(keep='first')]
+    return dict(zip(chaves[df.index], df.to_dict('records')))
+
 # ========== FUNÇÃO PARA CARREGAR SENHAS DO GOOGLE DRIVE ==========
 @st.cache_data(ttl=300)
 def carregar_senhas_do_drive(_service):
     """
-    Carrega o arquivo de senhas do Google Drive e retorna um dicionário
-    com matrícula como chave e senha como valor
+    Carrega o arquivo de senhas do Google Drive e retorna o índice de senhas
+    (matrícula normalizada -> registro), ver indexar_senhas
     O parâmetro _service tem underscore para não ser hasheado pelo cache
     """
     try:
@@ -662,21 +686,8 @@ def carregar_senhas_do_drive(_service):
                 st.error(f"Coluna '{coluna}' não encontrada no arquivo Senhas.xlsx")
                 return None
         
-        # Converte matrícula para string e remove espaços
-        df['MATRICULA'] = df['MATRICULA'].astype(str).str.strip()
-        df['SENHA'] = df['SENHA'].astype(str).str.strip()
-        
-        # Filtra linhas com dados válidos
-        df = df[df['MATRICULA'].notna() & (df['MATRICULA'] != '') & 
-                df['SENHA'].notna() & (df['SENHA'] != '')]
-        
-        # Cria dicionário de senhas
-        senhas_dict = {}
-        for _, row in df.iterrows():
-            matricula = str(row['MATRICULA']).strip()
-            senhas_dict[matricula] = str(row['SENHA']).strip()
-        
-        return senhas_dict
+        # Índice já normalizado: o login é uma única consulta ao dicionário
+        return indexar_senhas(df)
         
     except Exception as e:
         st.error(f"❌ Erro ao carregar senhas do Drive: {str(e)}")
@@ -690,20 +701,15 @@ def verificar_credenciais(matricula, senha, senhas_dict):
     if not senhas_dict:
         return False, "Erro ao carregar dados de senha"
     
-    # Formata a matrícula para busca (remover zeros à esquerda para comparar)
-    matricula_busca = matricula.lstrip('0')
+    # O índice é chaveado pela matrícula sem zeros à esquerda
+    registro = senhas_dict.get(normalizar_matricula(matricula))
     
-    # Tenta encontrar a matrícula no dicionário
-    for matricula_registro, senha_registro in senhas_dict.items():
-        matricula_registro_limpa = matricula_registro.lstrip('0')
-        
-        if matricula_busca == matricula_registro_limpa:
-            if senha == senha_registro:
-                return True, "Credenciais válidas"
-            else:
-                return False, "Senha incorreta"
+    if registro is None:
+        return False, "Matrícula não encontrada"
     
-    return False, "Matrícula não encontrada"
+    if senha == registro['SENHA']:
+        return True, "Credenciais válidas"
+    return False, "Senha incorreta"
 
 # ========== FUNÇÃO PARA CARREGAR DADOS DOS FISCAIS ==========
 @st.cache_data(ttl=3600)
@@ -1070,6 +1076,24 @@ class FotoInfo:
         self._image_obj = None
         self._thumbnail = None
 
+# ========== IMAGEM EM MEMÓRIA PARA O PDF ==========
+def imagem_jpeg_em_memoria(foto_info, img, img_resized):
+    """
+    Retorna um buffer JPEG pronto para o fpdf, sem arquivo temporário.
+    Se a foto original já é JPEG e não foi redimensionada, reaproveita os bytes
+    originais: o fpdf embute o fluxo JPEG diretamente, sem nova decodificação.
+    """
+    if img_resized is img and img.format == 'JPEG' and img.mode in ('RGB', 'L', 'CMYK'):
+        return BytesIO(foto_info.image_bytes)
+    
+    if img_resized.mode not in ('RGB', 'L'):
+        img_resized = img_resized.convert('RGB')
+    
+    buffer = BytesIO()
+    img_resized.save(buffer, 'JPEG', quality=85)
+    buffer.seek(0)
+    return buffer
+
 # ========== CLASSE PDF COM CABEÇALHO COM LOGO E SUPORTE A ACENTOS ==========
 class RelatorioPDF(FPDF):
     def __init__(self, logo_path=None, agente_info=None):
@@ -1238,30 +1262,25 @@ class RelatorioPDF(FPDF):
             new_width_px = int(new_width_mm / 0.264583)
             new_height_px = int(new_height_mm / 0.264583)
             
-            # Redimensiona a imagem
-            img_resized = img.resize((new_width_px, new_height_px), Image.Resampling.LANCZOS)
+            # Redimensiona a imagem (somente se o tamanho mudar)
+            if (new_width_px, new_height_px) != img.size:
+                img_resized = img.resize((new_width_px, new_height_px), Image.Resampling.LANCZOS)
+            else:
+                img_resized = img
             
-            # Salva temporariamente
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_img:
-                img_resized.save(temp_img.name, 'JPEG', quality=85)
-                temp_img_path = temp_img.name
+            # Codifica em memória (sem arquivo temporário)
+            imagem_jpeg = imagem_jpeg_em_memoria(foto_info, img, img_resized)
             
             # Centraliza a imagem horizontalmente
             x_position = (210 - new_width_mm) / 2
             y_position = self.get_y()
             
             # Adiciona a imagem
-            self.image(temp_img_path, x=x_position, y=y_position, w=new_width_mm)
+            self.image(imagem_jpeg, x=x_position, y=y_position, w=new_width_mm)
             
             # Move o cursor para depois da imagem
             self.set_y(y_position + new_height_mm + 10)
             
-            # Remove arquivo temporário
-            try:
-                os.unlink(temp_img_path)
-            except:
-                pass
-            
             # Área para o comentário (40% restantes)
             # Calcula quanto espaço ainda resta até o final da página
             espaco_restante = altura_total_pagina - self.get_y() - margem_inferior
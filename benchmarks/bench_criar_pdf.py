@@ -0,0 +1,348 @@
+"""
+Benchmark do criar_pdf (app.py, app1.py, app7.py e RF4.py).
+
+Gera dados e fotos sintéticos e mede, para cada cenário, o tempo de geração do
+PDF, o pico de memória (RSS) e o tamanho do arquivo. Cada cenário roda em um
+subprocesso próprio, para que o pico de RSS de um não contamine o outro.
+
+Uso:
+    python benchmarks/bench_criar_pdf.py
+    python benchmarks/bench_criar_pdf.py --modulos app RF4 --repeticoes 5
+    python benchmarks/bench_criar_pdf.py --rapido --saida resultados.json
+    python benchmarks/bench_criar_pdf.py --comparar base.json --tolerancia 0.25
+
+Com --comparar, o script sai com código 1 se algum cenário ficar mais lento
+ou gerar um PDF maior que a referência além da tolerância.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from io import BytesIO
+
+RAIZ_REPOSITORIO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULOS = ['app', 'app1', 'app7', 'RF4']
+LOGOS = {'app': '10.png', 'app1': '10.png', 'app7': '2026.png', 'RF4': '10.png'}
+
+RESOLUCOES = {
+    'vga': (640, 480),
+    'fullhd': (1920, 1080),
+    'celular_12mp': (4032, 3024),
+}
+QUANTIDADES_FOTOS = [0, 5, 20, 50]
+
+
+# ========== CENÁRIOS ==========
+def montar_cenarios(rapido=False):
+    """Lista de cenários: fotos x resolução, número de contratados e textos longos"""
+    resolucoes = ['vga', 'fullhd'] if rapido else list(RESOLUCOES)
+    quantidades = [0, 5, 20] if rapido else QUANTIDADES_FOTOS
+
+    cenarios = []
+    for quantidade in quantidades:
+        for resolucao in (resolucoes[:1] if quantidade == 0 else resolucoes):
+            cenarios.append({
+                'nome': f"fotos_{quantidade}_{resolucao}",
+                'fotos': quantidade,
+                'resolucao': resolucao,
+                'contratados': 1,
+                'texto_longo': False,
+            })
+
+    for contratados in range(1, 6):
+        cenarios.append({
+            'nome': f"contratados_{contratados}",
+            'fotos': 0,
+            'resolucao': 'vga',
+            'contratados': contratados,
+            'texto_longo': False,
+        })
+
+    cenarios.append({
+        'nome': "texto_longo",
+        'fotos': 5,
+        'resolucao': 'fullhd',
+        'contratados': 3,
+        'texto_longo': True,
+    })
+    return cenarios
+
+
+# ========== DADOS SINTÉTICOS ==========
+def texto_sintetico(rng, palavras):
+    vocabulario = [
+        "fiscalização", "obra", "execução", "responsável", "técnico", "constatação",
+        "edificação", "pavimento", "instalação", "elétrica", "estrutura", "concreto",
+        "ausência", "registro", "profissional", "ART", "irregularidade", "serviço",
+    ]
+    return " ".join(rng.choice(vocabulario) for _ in range(palavras)).capitalize() + "."
+
+def gerar_contratado(rng, indice, texto_longo):
+    return {
+        'mesmo_contratante': "SIM" if indice % 2 else "NÃO",
+        'nome_contratante_secao04': f"Contratante {indice} Ltda.",
+        'registro_contratante_secao04': f"RJ{2020000000 + indice}",
+        'cpf_cnpj_secao04': f"12.345.678/0001-{indice:02d}",
+        'contratado_pf_pj': "PESSOA JURÍDICA",
+        'registro': f"RJ{2019000000 + indice}",
+        'cpf_cnpj_contratado': f"98.765.432/0001-{indice:02d}",
+        'contrato': f"Engenheiro Civil {indice}",
+        'identificacao_fiscalizado': "Responsável técnico pela execução",
+        'numero_art': f"ART-{indice:06d}",
+        'numero_rrt': "",
+        'numero_trt': "",
+        'ramo_atividade': "Engenharia Civil",
+        'servico_executado': texto_sintetico(rng, 12),
+        'fonte_informacao_secao04': "Placa da obra",
+        'qualificacao_fonte_secao04': "Responsável pela obra",
+        'situacao_contratado': "Autuar",
+        'tipo_infracao_contratado': "Exercício ilegal",
+        'infracoes_contratado': [texto_sintetico(rng, 300 if texto_longo else 40) for _ in range(2)],
+    }
+
+def gerar_dados(cenario, semente=42):
+    """Dicionário `dados` com as chaves lidas pelos criar_pdf das quatro versões"""
+    rng = random.Random(semente)
+    palavras = 3000 if cenario['texto_longo'] else 60
+    texto = texto_sintetico(rng, palavras)
+    return {
+        'numero_relatorio': "202600001",
+        'situacao': "Em andamento",
+        'data_relatorio': "17/10/2026",
+        'data_relatorio_anterior': "NAO INFORMADO",
+        'fato_gerador': "Rotina",
+        'protocolo': "2026/000123",
+        'tipo_visita': "Diligência",
+        'latitude': "-22.9068",
+        'longitude': "-43.1729",
+        'endereco': "Avenida Rio Branco",
+        'numero': "100",
+        'complemento': "Bloco A",
+        'bairro': "Centro",
+        'municipio': "Rio de Janeiro",
+        'uf': "RJ",
+        'cep': "20040-002",
+        'descritivo_endereco': texto_sintetico(rng, 20),
+        'nome_contratante': "Construtora Exemplo S.A.",
+        'registro_contratante': "RJ2018000001",
+        'cpf_cnpj': "11.222.333/0001-44",
+        'situacao_contratante': "Regular",
+        'nome_interessado': "Construtora Exemplo S.A.",
+        'registro_interessado': "RJ2018000001",
+        'motivo_acao': "Denúncia",
+        'caracteristica': "Construção",
+        'fase_atividade': "Estrutura",
+        'num_pavimentos': "8",
+        'quantificacao': "2500",
+        'unidade_medida': "m²",
+        'natureza': "Residencial",
+        'tipo_construcao': "Alvenaria",
+        'contratados_data': [
+            gerar_contratado(rng, indice, cenario['texto_longo'])
+            for indice in range(1, cenario['contratados'] + 1)
+        ],
+        'documentos_solicitados': "ART de execução; Projeto estrutural",
+        'documentos_recebidos': "Alvará de obra",
+        'quadro_tecnico_solicitado': "", 'prestadores_servicos_solicitado': "", 'outros_solicitado': "",
+        'quadro_tecnico_recebido': "", 'prestadores_servicos_recebido': "", 'outros_recebido': "",
+        'infracao_selecionada': "", 'tipo_infracao': "",
+        'fonte_informacao': "Responsável no local",
+        'qualificacao_fonte': "Mestre de obras",
+        'constatacao_fiscal': texto,
+        'apurado_introducao': texto_sintetico(rng, palavras // 4),
+        'apurado_apurado': texto,
+        'apurado_conclusao': texto_sintetico(rng, palavras // 4),
+        'informacoes_complementares': texto_sintetico(rng, palavras // 2),
+    }
+
+def gerar_fotos_bytes(quantidade, resolucao, semente=42):
+    """JPEGs sintéticos com textura (ruído), distintos entre si"""
+    from PIL import Image, ImageDraw
+
+    largura, altura = RESOLUCOES[resolucao]
+    rng = random.Random(semente)
+    ruido = Image.effect_noise((largura, altura), 48)
+    base = Image.merge('RGB', (ruido, ruido.rotate(90, expand=False), ruido.transpose(Image.FLIP_LEFT_RIGHT)))
+
+    fotos = []
+    for indice in range(quantidade):
+        imagem = base.copy()
+        desenho = ImageDraw.Draw(imagem)
+        for _ in range(8):
+            x, y = rng.randrange(largura), rng.randrange(altura)
+            cor = tuple(rng.randrange(256) for _ in range(3))
+            desenho.rectangle([x, y, x + largura // 6, y + altura // 6], fill=cor)
+        buffer = BytesIO()
+        imagem.save(buffer, format='JPEG', quality=90)
+        fotos.append(buffer.getvalue())
+    return fotos
+
+
+# ========== EXECUÇÃO DE UM CENÁRIO (SUBPROCESSO) ==========
+def rss_pico_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa em KB; macOS em bytes
+    return round(pico / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def executar_cenario(nome_modulo, cenario, repeticoes):
+    """Importa o módulo, gera o PDF `repeticoes` vezes e retorna as medições"""
+    import importlib
+    import logging
+
+    logging.disable(logging.WARNING)
+    os.chdir(RAIZ_REPOSITORIO)
+    sys.path.insert(0, RAIZ_REPOSITORIO)
+    os.environ.setdefault('RF_DADOS_DIR', tempfile.mkdtemp(prefix='bench-rf-'))
+
+    modulo = importlib.import_module(nome_modulo)
+    rss_apos_import = rss_pico_mb()
+
+    dados = gerar_dados(cenario)
+    fotos_bytes = gerar_fotos_bytes(cenario['fotos'], cenario['resolucao'])
+    agente_info = {'NOME': "Agente de Teste", 'MATRICULA': "0001", 'UNIDADE': "Sede"}
+    logo = LOGOS[nome_modulo] if os.path.exists(LOGOS[nome_modulo]) else None
+
+    tempos = []
+    tamanho_pdf = paginas = None
+    for _ in range(repeticoes):
+        fotos_info = [
+            modulo.FotoInfo(conteudo, comentario=f"Foto {indice}: " + dados['descritivo_endereco'])
+            for indice, conteudo in enumerate(fotos_bytes, 1)
+        ]
+        inicio = time.perf_counter()
+        pdf = modulo.criar_pdf(dados, logo, fotos_info, agente_info)
+        conteudo_pdf = pdf.output()
+        tempos.append(time.perf_counter() - inicio)
+        tamanho_pdf, paginas = len(conteudo_pdf), pdf.page_no()
+        del pdf, conteudo_pdf, fotos_info
+
+    return {
+        'tempo_s': {
+            'min': round(min(tempos), 4),
+            'mediana': round(statistics.median(tempos), 4),
+            'max': round(max(tempos), 4),
+        },
+        'rss_pico_mb': rss_pico_mb(),
+        'rss_apos_import_mb': rss_apos_import,
+        'tamanho_pdf_bytes': tamanho_pdf,
+        'paginas': paginas,
+    }
+
+def medir_em_subprocesso(nome_modulo, cenario, repeticoes, timeout):
+    comando = [
+        sys.executable, os.path.abspath(__file__), '--executar-cenario',
+        nome_modulo, json.dumps(cenario), '--repeticoes', str(repeticoes)
+    ]
+    try:
+        processo = subprocess.run(comando, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'erro': f"tempo limite de {timeout}s excedido"}
+
+    linhas = [linha for linha in processo.stdout.splitlines() if linha.startswith('{')]
+    if processo.returncode != 0 or not linhas:
+        detalhe = (processo.stderr.strip().splitlines() or ["sem saída"])[-1]
+        return {'erro': detalhe}
+    return json.loads(linhas[-1])
+
+
+# ========== COMPARAÇÃO COM REFERÊNCIA ==========
+def comparar_com_referencia(resultados, caminho_referencia, tolerancia):
+    """Lista as regressões de tempo (mediana) e de tamanho do PDF em relação à referência"""
+    with open(caminho_referencia, 'r', encoding='utf-8') as arquivo:
+        referencia = {
+            (item['modulo'], item['cenario']): item
+            for item in json.load(arquivo)['resultados'] if 'erro' not in item
+        }
+
+    regressoes = []
+    for item in resultados:
+        anterior = referencia.get((item['modulo'], item['cenario']))
+        if not anterior:
+            continue
+        if 'erro' in item:
+            regressoes.append(f"{item['modulo']}/{item['cenario']}: erro ({item['erro']})")
+            continue
+        metricas = (
+            ('tempo mediano', item['tempo_s']['mediana'], anterior['tempo_s']['mediana']),
+            ('tamanho do PDF', item['tamanho_pdf_bytes'], anterior['tamanho_pdf_bytes']),
+        )
+        for nome, atual, base in metricas:
+            if base and atual > base * (1 + tolerancia):
+                regressoes.append(
+                    f"{item['modulo']}/{item['cenario']}: {nome} {atual} vs {base} (+{(atual / base - 1):.0%})"
+                )
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do criar_pdf")
+    parser.add_argument('--modulos', nargs='+', choices=MODULOS, default=MODULOS)
+    parser.add_argument('--cenarios', nargs='+', help="Nomes dos cenários (padrão: todos)")
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--rapido', action='store_true', help="Menos resoluções e até 20 fotos")
+    parser.add_argument('--timeout', type=int, default=900, help="Segundos por cenário")
+    parser.add_argument('--saida', default=os.path.join(RAIZ_REPOSITORIO, 'benchmarks', 'resultados_criar_pdf.json'))
+    parser.add_argument('--comparar', help="JSON de uma execução anterior usado como referência")
+    parser.add_argument('--tolerancia', type=float, default=0.25)
+    parser.add_argument('--executar-cenario', nargs=2, metavar=('MODULO', 'CENARIO_JSON'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.executar_cenario:
+        nome_modulo, cenario = args.executar_cenario[0], json.loads(args.executar_cenario[1])
+        print(json.dumps(executar_cenario(nome_modulo, cenario, args.repeticoes)))
+        return 0
+
+    cenarios = montar_cenarios(args.rapido)
+    if args.cenarios:
+        cenarios = [cenario for cenario in cenarios if cenario['nome'] in args.cenarios]
+
+    resultados = []
+    for nome_modulo in args.modulos:
+        for cenario in cenarios:
+            medicao = medir_em_subprocesso(nome_modulo, cenario, args.repeticoes, args.timeout)
+            resultado = {'modulo': nome_modulo, 'cenario': cenario['nome'], **cenario, **medicao}
+            del resultado['nome']
+            resultados.append(resultado)
+
+            if 'erro' in medicao:
+                print(f"{nome_modulo:5} {cenario['nome']:28} ERRO: {medicao['erro']}")
+            else:
+                print(f"{nome_modulo:5} {cenario['nome']:28} "
+                      f"{medicao['tempo_s']['mediana']:8.3f}s "
+                      f"{medicao['rss_pico_mb'] or 0:8.1f} MB "
+                      f"{medicao['tamanho_pdf_bytes'] / 1024:10.1f} KB "
+                      f"{medicao['paginas']:4} pág.")
+
+    relatorio = {
+        'gerado_em': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'repeticoes': args.repeticoes,
+        'resultados': resultados,
+    }
+    with open(args.saida, 'w', encoding='utf-8') as arquivo:
+        json.dump(relatorio, arquivo, ensure_ascii=False, indent=2)
+    print(f"\nResultados gravados em {args.saida}")
+
+    if args.comparar:
+        regressoes = comparar_com_referencia(resultados, args.comparar, args.tolerancia)
+        for regressao in regressoes:
+            print(f"REGRESSÃO: {regressao}")
+        return 1 if regressoes else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+"""
+Teste de carga do envio de relatórios (app.py) com sessões concorrentes.
+
+Simula N fiscais enviando relatórios ao mesmo tempo (início de turno) contra o
+Drive local (RF_DRIVE_BACKEND=local), sem rede. Cada sessão é uma thread, como
+as sessões do Streamlit, e percorre o mesmo caminho do main():
+
+    login (carregar_diretorio_agentes + verificar_credenciais)
+    -> número do relatório (ContadorRelatorios)
+    -> fotos (FotoInfo) -> criar_pdf -> PDF em disco
+    -> registro na Planilha Master (outbox, como no app, ou envio direto)
+
+Ao final a outbox é drenada, o journal é compactado e a Planilha Master do Drive
+é conferida. São reportados a vazão, as latências p50/p95/p99 por etapa, as
+linhas perdidas na Planilha Master e os números de relatório duplicados.
+
+Uso:
+    python benchmarks/carga_envio.py --sessoes 50 --relatorios 2
+    python benchmarks/carga_envio.py --sessoes 20 --latencia-ms 150 --taxa-erro 0.05
+    python benchmarks/carga_envio.py --modo direto --saida carga.json
+
+Sai com código 1 se houver linhas perdidas ou números duplicados.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+RAIZ_REPOSITORIO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ETAPAS = ['login', 'numero', 'fotos', 'pdf', 'registro', 'total']
+
+
+def percentil(valores, p):
+    """Percentil com interpolação linear (valores já ordenados)"""
+    if not valores:
+        return None
+    posicao = (len(valores) - 1) * p / 100
+    inferior = int(posicao)
+    superior = min(inferior + 1, len(valores) - 1)
+    return valores[inferior] + (valores[superior] - valores[inferior]) * (posicao - inferior)
+
+def resumir_latencias(valores):
+    valores = sorted(valores)
+    if not valores:
+        return {}
+    return {
+        'n': len(valores),
+        'p50': round(percentil(valores, 50), 4),
+        'p95': round(percentil(valores, 95), 4),
+        'p99': round(percentil(valores, 99), 4),
+        'max': round(valores[-1], 4),
+    }
+
+
+def configurar_ambiente(args):
+    """Variáveis lidas pelo app na importação: Drive local e pasta de dados isolada"""
+    pasta_base = args.pasta or tempfile.mkdtemp(prefix='carga-rf-')
+    os.environ['RF_DRIVE_BACKEND'] = 'local'
+    os.environ['RF_DADOS_DIR'] = os.path.join(pasta_base, 'dados')
+    os.environ['RF_DRIVE_LOCAL_DIR'] = os.path.join(pasta_base, 'drive')
+    os.environ['RF_DRIVE_LOCAL_LATENCIA_MS'] = str(args.latencia_ms)
+    os.environ['RF_DRIVE_LOCAL_VARIACAO_LATENCIA_MS'] = str(args.variacao_latencia_ms)
+    os.environ['RF_DRIVE_LOCAL_TAXA_ERRO'] = str(args.taxa_erro)
+    os.environ['RF_OUTBOX_INTERVALO'] = '1'
+    return pasta_base
+
+def preparar_agentes(app, drive, pasta_base, quantidade):
+    """Publica no Drive local um Senhas.xlsx com os agentes sintéticos"""
+    import pandas as pd
+
+    agentes = [
+        {'NOME': f"Agente Carga {indice:03d}", 'MATRICULA': f"{9000 + indice:04d}", 'UNIDADE': "Carga",
+         'SENHA': f"senha{indice}"}
+        for indice in range(1, quantidade + 1)
+    ]
+    caminho = os.path.join(pasta_base, app.SENHAS_FILENAME)
+    pd.DataFrame(agentes)[['MATRICULA', 'SENHA']].to_excel(caminho, index=False, sheet_name='DADOS FISCAIS')
+    drive.importar_arquivo(caminho, app.SENHAS_FILENAME, app.GOOGLE_DRIVE_FOLDER_ID)
+
+    # Em produção o arquivo de contadores já existe; sem ele, cada sessão criaria o seu
+    caminho = os.path.join(pasta_base, app.CONTADOR_FILENAME)
+    with open(caminho, 'w', encoding='utf-8') as arquivo:
+        json.dump({}, arquivo)
+    drive.importar_arquivo(caminho, app.CONTADOR_FILENAME, app.GOOGLE_DRIVE_FOLDER_ID)
+    return agentes
+
+
+class Sessao(threading.Thread):
+    """Uma sessão de fiscal: login seguido de `relatorios` envios"""
+    def __init__(self, app, service, agente, relatorios, fotos_bytes, modo, largada, pasta_pdfs):
+        super().__init__(name=f"sessao-{agente['MATRICULA']}", daemon=True)
+        self.app = app
+        self.service = service
+        self.agente = agente
+        self.relatorios = relatorios
+        self.fotos_bytes = fotos_bytes
+        self.modo = modo
+        self.largada = largada
+        self.pasta_pdfs = pasta_pdfs
+        self.envios = []
+        self.erros = []
+
+    def run(self):
+        from bench_criar_pdf import gerar_dados
+
+        app = self.app
+        self.largada.wait()
+        try:
+            inicio = time.perf_counter()
+            diretorio = app.carregar_diretorio_agentes(self.service)
+            valido, mensagem = app.verificar_credenciais(self.agente['MATRICULA'], self.agente['SENHA'], diretorio)
+            if not valido:
+                raise RuntimeError(f"login: {mensagem}")
+            contador = app.ContadorRelatorios(service=self.service, folder_id=app.GOOGLE_DRIVE_FOLDER_ID)
+            agente_info = {chave: self.agente[chave] for chave in ('NOME', 'MATRICULA', 'UNIDADE')}
+            tempo_login = time.perf_counter() - inicio
+        except Exception as e:
+            self.erros.append(f"{self.name}: {e}")
+            return
+
+        for indice in range(self.relatorios):
+            tempos = {'login': tempo_login} if indice == 0 else {}
+            try:
+                inicio = marca = time.perf_counter()
+                numero, _ = contador.gerar_novo_numero(self.agente['MATRICULA'])
+                tempos['numero'] = time.perf_counter() - marca
+
+                marca = time.perf_counter()
+                sessao_fotos = f"{self.name}-{indice}"
+                fotos_info = [
+                    app.FotoInfo(conteudo, comentario=f"Foto {posicao}", sessao_id=sessao_fotos)
+                    for posicao, conteudo in enumerate(self.fotos_bytes, 1)
+                ]
+                tempos['fotos'] = time.perf_counter() - marca
+
+                dados = gerar_dados({'contratados': 2, 'texto_longo': False}, semente=indice)
+                dados['numero_relatorio'] = numero
+                dados['data_relatorio'] = datetime.now().strftime("%d/%m/%Y")
+
+                marca = time.perf_counter()
+                pdf = app.criar_pdf(dados, None, fotos_info, agente_info)
+                caminho_pdf = os.path.join(self.pasta_pdfs, f"relatorio_{numero}_{self.name}_{indice}.pdf")
+                pdf.output(caminho_pdf)
+                tempos['pdf'] = time.perf_counter() - marca
+
+                marca = time.perf_counter()
+                if self.modo == 'direto':
+                    registrado = app.adicionar_relatorio_a_planilha_master(
+                        dados, agente_info, fotos_info, self.service, app.GOOGLE_DRIVE_FOLDER_ID
+                    )
+                else:
+                    novos_dados = app.preparar_dados_para_planilha_master(dados, agente_info, fotos_info)
+                    app.obter_banco_relatorios().salvar(novos_dados)
+                    app.enviar_relatorio(self.service, app.GOOGLE_DRIVE_FOLDER_ID, caminho_pdf, novos_dados,
+                                         self.agente['MATRICULA'])
+                    registrado = True
+                tempos['registro'] = time.perf_counter() - marca
+                tempos['total'] = time.perf_counter() - inicio
+
+                for foto in fotos_info:
+                    foto.descartar()
+                self.envios.append({'numero': numero, 'registrado': bool(registrado), 'tempos': tempos})
+            except Exception as e:
+                self.erros.append(f"{self.name}/{indice}: {type(e).__name__}: {e}")
+
+
+def aguardar_outbox(app, service, limite_segundos):
+    """Drena a outbox até todos os itens estarem sincronizados (ou esgotar o tempo)"""
+    fim = time.time() + limite_segundos
+    while time.time() < fim:
+        app.drenar_outbox(service, app.GOOGLE_DRIVE_FOLDER_ID)
+        pendentes = [item for item in app.listar_itens_outbox() if item['status'] != 'sincronizado']
+        if not pendentes:
+            return 0
+        time.sleep(0.5)
+    return len(pendentes)
+
+def numeros_na_planilha_master(app, service):
+    """Números de relatório presentes nas partições publicadas no Drive"""
+    folder_id = app.GOOGLE_DRIVE_FOLDER_ID
+    numeros = Counter()
+    manifesto = app.carregar_manifesto_planilha_master(service, folder_id)
+    for info in manifesto['particoes'].values():
+        df, _ = app._carregar_particao_planilha_master(service, folder_id, info)
+        numeros.update(df['NUMERO_RELATORIO'].astype(str))
+    return numeros
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do envio de relatórios")
+    parser.add_argument('--sessoes', type=int, default=50, help="Sessões (fiscais) simultâneas")
+    parser.add_argument('--relatorios', type=int, default=1, help="Relatórios por sessão")
+    parser.add_argument('--fotos', type=int, default=5, help="Fotos por relatório")
+    parser.add_argument('--resolucao', default='fullhd', help="vga, fullhd ou celular_12mp")
+    parser.add_argument('--modo', choices=['outbox', 'direto'], default='outbox',
+                        help="outbox: como o main(); direto: adicionar_relatorio_a_planilha_master")
+    parser.add_argument('--latencia-ms', type=float, default=100)
+    parser.add_argument('--variacao-latencia-ms', type=float, default=100)
+    parser.add_argument('--taxa-erro', type=float, default=0.02)
+    parser.add_argument('--limite-drenagem', type=int, default=600, help="Segundos para esvaziar a outbox")
+    parser.add_argument('--pasta', help="Pasta de trabalho (padrão: temporária)")
+    parser.add_argument('--saida', default=os.path.join(RAIZ_REPOSITORIO, 'benchmarks', 'resultados_carga_envio.json'))
+    args = parser.parse_args()
+
+    pasta_base = configurar_ambiente(args)
+    os.chdir(RAIZ_REPOSITORIO)
+    sys.path.insert(0, RAIZ_REPOSITORIO)
+
+    import logging
+    logging.disable(logging.WARNING)
+    import app
+    from bench_criar_pdf import gerar_fotos_bytes
+
+    service = app.autenticar_google_drive()
+    agentes = preparar_agentes(app, service, pasta_base, args.sessoes)
+    fotos_bytes = gerar_fotos_bytes(args.fotos, args.resolucao)
+    pasta_pdfs = os.path.join(pasta_base, 'pdfs')
+    os.makedirs(pasta_pdfs, exist_ok=True)
+
+    if args.modo == 'outbox':
+        app.iniciar_worker_outbox(service, app.GOOGLE_DRIVE_FOLDER_ID, 1)
+
+    largada = threading.Barrier(args.sessoes + 1)
+    sessoes = [
+        Sessao(app, service, agente, args.relatorios, fotos_bytes, args.modo, largada, pasta_pdfs)
+        for agente in agentes
+    ]
+    for sessao in sessoes:
+        sessao.start()
+
+    print(f"{args.sessoes} sessões x {args.relatorios} relatório(s), modo {args.modo}, pasta {pasta_base}")
+    largada.wait()
+    inicio = time.perf_counter()
+    for sessao in sessoes:
+        sessao.join()
+    duracao_envio = time.perf_counter() - inicio
+
+    envios = [envio for sessao in sessoes for envio in sessao.envios]
+    erros = [erro for sessao in sessoes for erro in sessao.erros]
+
+    inicio_drenagem = time.perf_counter()
+    pendentes_outbox = aguardar_outbox(app, service, args.limite_drenagem) if args.modo == 'outbox' else 0
+    compactados = app.compactar_journal_planilha_master(service, app.GOOGLE_DRIVE_FOLDER_ID)
+    duracao_drenagem = time.perf_counter() - inicio_drenagem
+
+    numeros_emitidos = Counter(envio['numero'] for envio in envios)
+    duplicados = {numero: vezes for numero, vezes in numeros_emitidos.items() if vezes > 1}
+    na_planilha = numeros_na_planilha_master(app, service)
+    perdidos = sorted(numero for numero in numeros_emitidos if numero not in na_planilha)
+    # Número repetido: as submissões extras sobrescrevem a linha anterior
+    linhas_perdidas = len(perdidos) + sum(vezes - 1 for vezes in duplicados.values())
+
+    resultado = {
+        'gerado_em': datetime.now().isoformat(),
+        'parametros': vars(args),
+        'envios_concluidos': len(envios),
+        'envios_com_erro': len(erros),
+        'erros': erros[:50],
+        'duracao_envio_s': round(duracao_envio, 3),
+        'vazao_relatorios_por_s': round(len(envios) / duracao_envio, 3) if duracao_envio else None,
+        'latencias_s': {
+            etapa: resumir_latencias([envio['tempos'][etapa] for envio in envios if etapa in envio['tempos']])
+            for etapa in ETAPAS
+        },
+        'duracao_drenagem_s': round(duracao_drenagem, 3),
+        'pendentes_outbox': pendentes_outbox,
+        'registros_compactados': compactados,
+        'linhas_planilha_master': sum(na_planilha.values()),
+        'linhas_perdidas': linhas_perdidas,
+        'numeros_perdidos': perdidos[:50],
+        'numeros_duplicados': duplicados,
+        'chamadas_drive': dict(service.chamadas),
+        'metricas_drive': app.obter_metricas_drive().resumo(),
+        'telemetria_etapas': app.obter_telemetria().resumo(),
+    }
+
+    with open(args.saida, 'w', encoding='utf-8') as arquivo:
+        json.dump(resultado, arquivo, ensure_ascii=False, indent=2, default=str)
+
+    print(f"Envios: {len(envios)} concluídos, {len(erros)} com erro em {duracao_envio:.1f}s "
+          f"({resultado['vazao_relatorios_por_s']} relatórios/s)")
+    for etapa in ETAPAS:
+        latencias = resultado['latencias_s'][etapa]
+        if latencias:
+            print(f"  {etapa:9} p50 {latencias['p50']:7.3f}s  p95 {latencias['p95']:7.3f}s  "
+                  f"p99 {latencias['p99']:7.3f}s  max {latencias['max']:7.3f}s")
+    print(f"Drenagem + compactação: {duracao_drenagem:.1f}s (pendentes na outbox: {pendentes_outbox})")
+    print(f"Planilha Master: {resultado['linhas_planilha_master']} linhas, "
+          f"{linhas_perdidas} perdidas, {len(duplicados)} números duplicados")
+    for erro in erros[:10]:
+        print(f"  ERRO {erro}")
+    print(f"Resultados gravados em {args.saida}")
+
+    return 1 if linhas_perdidas or duplicados or erros else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
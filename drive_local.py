@@ -0,0 +1,321 @@
+"""
+Drive simulado em pasta local, usado pelo app.py com RF_DRIVE_BACKEND=local
+(testes offline e de carga). Não é importado no uso normal do app.
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
+
+
+def _erro_http_local(status, mensagem, razao=None, retry_after=None):
+    """HttpError no mesmo formato das respostas da API do Drive"""
+    info = {'status': str(status)}
+    if retry_after is not None:
+        info['retry-after'] = str(retry_after)
+    erro = {'code': status, 'message': mensagem}
+    if razao:
+        erro['errors'] = [{'reason': razao, 'message': mensagem}]
+    return HttpError(httplib2.Response(info), json.dumps({'error': erro}).encode('utf-8'))
+
+class _RequisicaoDriveLocal:
+    """Equivalente ao HttpRequest: a operação só roda em execute()"""
+    def __init__(self, backend, operacao, nome_operacao):
+        self.backend = backend
+        self.operacao = operacao
+        self.nome_operacao = nome_operacao
+
+    def execute(self, num_retries=0):
+        self.backend.simular_rede(self.nome_operacao)
+        return self.operacao()
+
+class _HttpDriveLocal:
+    """Responde às requisições com Range feitas pelo MediaIoBaseDownload"""
+    def __init__(self, backend, arquivo_id, revisao_id=None):
+        self.backend = backend
+        self.arquivo_id = arquivo_id
+        self.revisao_id = revisao_id
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        try:
+            self.backend.simular_rede('get_media')
+            conteudo = self.backend.ler_conteudo(self.arquivo_id, self.revisao_id)
+        except HttpError as erro:
+            return erro.resp, erro.content
+
+        total = len(conteudo)
+        intervalo = re.match(r'bytes=(\d+)-(\d*)', (headers or {}).get('range', ''))
+        if not intervalo:
+            return httplib2.Response({'status': '200', 'content-length': str(total)}), conteudo
+        inicio = int(intervalo.group(1))
+        fim = min(int(intervalo.group(2)) if intervalo.group(2) else total - 1, total - 1)
+        if inicio >= total:
+            return httplib2.Response({'status': '416', 'content-range': f'bytes */{total}'}), b''
+        return (
+            httplib2.Response({'status': '206', 'content-range': f'bytes {inicio}-{fim}/{total}'}),
+            conteudo[inicio:fim + 1]
+        )
+
+class _RequisicaoMidiaLocal:
+    """Requisição de mídia aceita pelo MediaIoBaseDownload (uri, headers, http)"""
+    def __init__(self, backend, arquivo_id, revisao_id=None):
+        self.uri = f"local://{arquivo_id}/{revisao_id or 'head'}"
+        self.headers = {}
+        self.http = _HttpDriveLocal(backend, arquivo_id, revisao_id)
+
+class _RecursoArquivosLocal:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def list(self, q='', orderBy=None, pageSize=100, pageToken=None, **kwargs):
+        return _RequisicaoDriveLocal(
+            self.backend, lambda: self.backend.listar(q, orderBy, pageSize, pageToken), 'files.list'
+        )
+
+    def get(self, fileId, **kwargs):
+        return _RequisicaoDriveLocal(self.backend, lambda: self.backend.metadados(fileId), 'files.get')
+
+    def get_media(self, fileId, **kwargs):
+        return _RequisicaoMidiaLocal(self.backend, fileId)
+
+    def create(self, body=None, media_body=None, **kwargs):
+        return _RequisicaoDriveLocal(self.backend, lambda: self.backend.criar(body or {}, media_body), 'files.create')
+
+    def update(self, fileId, body=None, media_body=None, addParents=None, removeParents=None, **kwargs):
+        return _RequisicaoDriveLocal(
+            self.backend,
+            lambda: self.backend.atualizar(fileId, body or {}, media_body, addParents, removeParents),
+            'files.update'
+        )
+
+    def delete(self, fileId, **kwargs):
+        return _RequisicaoDriveLocal(self.backend, lambda: self.backend.remover(fileId), 'files.delete')
+
+class _RecursoRevisoesLocal:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def list(self, fileId, pageSize=1000, pageToken=None, **kwargs):
+        return _RequisicaoDriveLocal(
+            self.backend, lambda: self.backend.listar_revisoes(fileId, pageSize, pageToken), 'revisions.list'
+        )
+
+    def get_media(self, fileId, revisionId, **kwargs):
+        return _RequisicaoMidiaLocal(self.backend, fileId, revisionId)
+
+class DriveLocal:
+    """
+    Substituto do serviço do Drive gravado em uma pasta local, com a mesma
+    interface usada pelo app (files().list/get/get_media/create/update/delete e
+    revisions().list/get_media, consultas por nome, pasta e appProperties).
+    Usado com RF_DRIVE_BACKEND=local para medir e testar o envio sem rede.
+    Latência e erros transitórios (429/503) são injetáveis por chamada.
+
+    Os metadados ficam em memória (um processo) e são persistidos em disco.
+    """
+    def __init__(self, pasta, latencia=0.0, variacao_latencia=0.0, taxa_erro=0.0, semente=None):
+        self.pasta = pasta
+        self.latencia = latencia
+        self.variacao_latencia = variacao_latencia
+        self.taxa_erro = taxa_erro
+        self._rng = random.Random(semente)
+        self._lock = threading.RLock()
+        self._arquivos = {}
+        self.chamadas = {}
+        os.makedirs(os.path.join(pasta, 'conteudo'), exist_ok=True)
+        self._carregar()
+
+    # Interface do googleapiclient
+    def files(self):
+        return _RecursoArquivosLocal(self)
+
+    def revisions(self):
+        return _RecursoRevisoesLocal(self)
+
+    # Simulação de rede
+    def simular_rede(self, nome_operacao):
+        with self._lock:
+            self.chamadas[nome_operacao] = self.chamadas.get(nome_operacao, 0) + 1
+            espera = self.latencia + self._rng.uniform(0, self.variacao_latencia)
+            falhar = self._rng.random() < self.taxa_erro
+            limitar = self._rng.random() < 0.5
+        if espera > 0:
+            time.sleep(espera)
+        if falhar:
+            if limitar:
+                raise _erro_http_local(429, "Rate limit exceeded (simulado)", 'rateLimitExceeded', retry_after=0)
+            raise _erro_http_local(503, "Backend error (simulado)", 'backendError')
+
+    # Persistência
+    def _caminho_indice(self):
+        return os.path.join(self.pasta, 'arquivos.json')
+
+    def _caminho_conteudo(self, arquivo_id, revisao_id):
+        return os.path.join(self.pasta, 'conteudo', f"{arquivo_id}__{revisao_id}.bin")
+
+    def _carregar(self):
+        try:
+            with open(self._caminho_indice(), 'r', encoding='utf-8') as f:
+                self._arquivos = json.load(f)
+        except (OSError, ValueError):
+            self._arquivos = {}
+
+    def _persistir(self):
+        caminho_tmp = f"{self._caminho_indice()}.{uuid.uuid4().hex}.tmp"
+        with open(caminho_tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._arquivos, f)
+        os.replace(caminho_tmp, self._caminho_indice())
+
+    def _obter(self, arquivo_id):
+        arquivo = self._arquivos.get(arquivo_id)
+        if arquivo is None or arquivo['meta'].get('trashed'):
+            raise _erro_http_local(404, f"File not found: {arquivo_id}.", 'notFound')
+        return arquivo
+
+    def _nova_revisao(self, arquivo, media_body):
+        conteudo = media_body.getbytes(0, media_body.size()) if media_body is not None else b''
+        revisao_id = f"{len(arquivo['revisoes']) + 1:08d}"
+        with open(self._caminho_conteudo(arquivo['meta']['id'], revisao_id), 'wb') as f:
+            f.write(conteudo)
+
+        agora = datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'
+        arquivo['revisoes'].append({'id': revisao_id, 'modifiedTime': agora, 'size': str(len(conteudo))})
+        arquivo['meta'].update({
+            'headRevisionId': revisao_id,
+            'md5Checksum': hashlib.md5(conteudo).hexdigest(),
+            'size': str(len(conteudo)),
+            'modifiedTime': agora,
+        })
+        if media_body is not None and media_body.mimetype():
+            arquivo['meta']['mimeType'] = media_body.mimetype()
+
+    # Operações
+    def criar(self, corpo, media_body):
+        with self._lock:
+            arquivo_id = uuid.uuid4().hex
+            agora = datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'
+            meta = {
+                'id': arquivo_id,
+                'name': corpo.get('name', 'Sem título'),
+                'parents': list(corpo.get('parents', [])),
+                'appProperties': dict(corpo.get('appProperties', {})),
+                'mimeType': corpo.get('mimeType', 'application/octet-stream'),
+                'createdTime': agora,
+                'trashed': False,
+                'webViewLink': f"local://{arquivo_id}",
+                'webContentLink': f"local://{arquivo_id}?download",
+            }
+            arquivo = {'meta': meta, 'revisoes': []}
+            self._nova_revisao(arquivo, media_body)
+            self._arquivos[arquivo_id] = arquivo
+            self._persistir()
+            return dict(meta)
+
+    def atualizar(self, arquivo_id, corpo, media_body, adicionar_pais=None, remover_pais=None):
+        with self._lock:
+            arquivo = self._obter(arquivo_id)
+            meta = arquivo['meta']
+            if 'name' in corpo:
+                meta['name'] = corpo['name']
+            if corpo.get('appProperties'):
+                meta['appProperties'].update(corpo['appProperties'])
+            if remover_pais:
+                meta['parents'] = [p for p in meta['parents'] if p not in remover_pais.split(',')]
+            if adicionar_pais:
+                meta['parents'].extend(p for p in adicionar_pais.split(',') if p not in meta['parents'])
+            if media_body is not None:
+                self._nova_revisao(arquivo, media_body)
+            self._persistir()
+            return dict(meta)
+
+    def remover(self, arquivo_id):
+        with self._lock:
+            arquivo = self._obter(arquivo_id)
+            del self._arquivos[arquivo_id]
+            self._persistir()
+        for revisao in arquivo['revisoes']:
+            try:
+                os.unlink(self._caminho_conteudo(arquivo_id, revisao['id']))
+            except OSError:
+                pass
+        return ''
+
+    def metadados(self, arquivo_id):
+        with self._lock:
+            return dict(self._obter(arquivo_id)['meta'])
+
+    def ler_conteudo(self, arquivo_id, revisao_id=None):
+        with self._lock:
+            arquivo = self._obter(arquivo_id)
+            revisao_id = revisao_id or arquivo['meta']['headRevisionId']
+            if revisao_id not in {r['id'] for r in arquivo['revisoes']}:
+                raise _erro_http_local(404, f"Revision not found: {revisao_id}.", 'notFound')
+        with open(self._caminho_conteudo(arquivo_id, revisao_id), 'rb') as f:
+            return f.read()
+
+    def listar_revisoes(self, arquivo_id, tamanho_pagina=1000, token_pagina=None):
+        with self._lock:
+            revisoes = [dict(r) for r in self._obter(arquivo_id)['revisoes']]
+        return self._paginar(revisoes, 'revisions', tamanho_pagina, token_pagina)
+
+    def listar(self, consulta='', ordenar_por=None, tamanho_pagina=100, token_pagina=None):
+        filtro = self._interpretar_consulta(consulta or '')
+        with self._lock:
+            arquivos = [dict(a['meta']) for a in self._arquivos.values() if filtro(a['meta'])]
+        campo_ordem = (ordenar_por or 'createdTime').split(',')[0].split()[0]
+        arquivos.sort(key=lambda meta: (meta.get(campo_ordem) or '', meta['createdTime']))
+        return self._paginar(arquivos, 'files', tamanho_pagina, token_pagina)
+
+    @staticmethod
+    def _paginar(itens, chave, tamanho_pagina, token_pagina):
+        inicio = int(token_pagina or 0)
+        tamanho_pagina = int(tamanho_pagina or 100)
+        resultado = {chave: itens[inicio:inicio + tamanho_pagina]}
+        if inicio + tamanho_pagina < len(itens):
+            resultado['nextPageToken'] = str(inicio + tamanho_pagina)
+        return resultado
+
+    @staticmethod
+    def _interpretar_consulta(consulta):
+        """Filtro para o subconjunto da linguagem de consulta do Drive usado pelo app"""
+        def _texto(valor):
+            return valor.replace("\\'", "'").replace('\\\\', '\\')
+
+        literal = r"'((?:[^'\\]|\\.)*)'"
+        condicoes = []
+        for valor in re.findall(r"\bname\s*=\s*" + literal, consulta):
+            condicoes.append(lambda meta, v=_texto(valor): meta['name'] == v)
+        for valor in re.findall(r"\bname\s+contains\s+" + literal, consulta):
+            condicoes.append(lambda meta, v=_texto(valor): v in meta['name'])
+        for valor in re.findall(literal + r"\s+in\s+parents", consulta):
+            condicoes.append(lambda meta, v=_texto(valor): v in meta['parents'])
+        for chave, valor in re.findall(
+            r"appProperties\s+has\s+\{\s*key\s*=\s*" + literal + r"\s+and\s+value\s*=\s*" + literal + r"\s*\}",
+            consulta
+        ):
+            condicoes.append(
+                lambda meta, k=_texto(chave), v=_texto(valor): meta.get('appProperties', {}).get(k) == v
+            )
+        lixeira = re.search(r"\btrashed\s*=\s*(true|false)", consulta)
+        if lixeira:
+            condicoes.append(lambda meta, t=(lixeira.group(1) == 'true'): bool(meta.get('trashed')) == t)
+        return lambda meta: all(condicao(meta) for condicao in condicoes)
+
+    # Utilitários para preparar cenários de teste
+    def importar_arquivo(self, caminho_arquivo, nome_arquivo, folder_id):
+        """Cria (ou atualiza) no Drive local uma cópia do arquivo informado"""
+        media = MediaFileUpload(caminho_arquivo, resumable=False)
+        consulta = f"name = '{nome_arquivo}' and '{folder_id}' in parents and trashed = false"
+        existentes = self.listar(consulta)['files']
+        if existentes:
+            return self.atualizar(existentes[0]['id'], {}, media)
+        return self.criar({'name': nome_arquivo, 'parents': [folder_id]}, media)
@@ -0,0 +1,95 @@
+"""
+Pastas de sessão do ArmazemFotos: permissões e limpeza das sessões abandonadas.
+
+Rodar da raiz do repositório:  python -m pytest -q tests
+"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class _EstadoSessao(dict):
+    """Substituto do st.session_state: dict com acesso por atributo"""
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+def _envelhecer(pasta, segundos):
+    instante = time.time() - segundos
+    os.utime(pasta, (instante, instante))
+
+
+def test_sessoes_abandonadas_saem_do_disco_e_do_lru(tmp_path):
+    armazem = app.ArmazemFotos(str(tmp_path / 'fotos'), 1024 * 1024)
+    abandonada = armazem.gravar('abandonada', 'foto.jpg', b'a' * 100)
+    ativa = armazem.gravar('ativa', 'foto.jpg', b'b' * 100)
+    armazem.ler(abandonada)
+    armazem.ler(ativa)
+    _envelhecer(os.path.dirname(abandonada), 2 * 3600)
+
+    armazem.limpar_sessoes_antigas(3600)
+
+    assert not os.path.exists(os.path.dirname(abandonada))
+    assert os.path.exists(ativa)
+    assert armazem._uso_bytes == 100
+    assert [chave[1] for chave in armazem._lru] == [ativa]
+
+
+def test_varredura_respeita_o_intervalo(tmp_path):
+    armazem = app.ArmazemFotos(str(tmp_path / 'fotos'), 1024 * 1024)
+    armazem.limpar_sessoes_antigas(3600, intervalo=600)
+
+    caminho = armazem.gravar('abandonada', 'foto.jpg', b'a')
+    _envelhecer(os.path.dirname(caminho), 2 * 3600)
+
+    armazem.limpar_sessoes_antigas(3600, intervalo=600)
+    assert os.path.exists(caminho)
+
+    armazem._ultima_limpeza -= 601
+    armazem.limpar_sessoes_antigas(3600, intervalo=600)
+    assert not os.path.exists(caminho)
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="permissões POSIX")
+def test_fotos_so_acessiveis_ao_usuario_do_app(tmp_path):
+    pasta_base = tmp_path / 'fotos'
+    pasta_base.mkdir(mode=0o755)
+    os.chmod(pasta_base, 0o755)
+    armazem = app.ArmazemFotos(str(pasta_base), 1024 * 1024)
+    caminho = armazem.gravar('sessao', 'foto.jpg', b'a')
+
+    assert os.stat(pasta_base).st_mode & 0o777 == 0o700
+    assert os.stat(os.path.dirname(caminho)).st_mode & 0o077 == 0
+    assert os.stat(caminho).st_mode & 0o777 == 0o600
+
+
+def test_sessao_em_uso_nao_e_tratada_como_abandonada(tmp_path):
+    armazem = app.ArmazemFotos(str(tmp_path / 'fotos'), 1024 * 1024)
+    caminho = armazem.gravar('ativa', 'foto.jpg', b'a')
+    _envelhecer(os.path.dirname(caminho), 2 * 3600)
+
+    armazem.marcar_uso('ativa')
+    armazem.limpar_sessoes_antigas(3600)
+
+    assert os.path.exists(caminho)
+
+
+def test_fotos_removidas_pela_limpeza_saem_do_relatorio(tmp_path, monkeypatch):
+    armazem = app.ArmazemFotos(str(tmp_path / 'fotos'), 1024 * 1024)
+    monkeypatch.setattr(app, 'obter_armazem_fotos', lambda: armazem)
+    monkeypatch.setattr(app, 'obter_id_sessao_fotos', lambda: 'atual')
+    perdida = app.FotoInfo(b'a', foto_id='perdida', normalizar=False, sessao_id='parada')
+    mantida = app.FotoInfo(b'b', foto_id='mantida', normalizar=False, sessao_id='atual')
+    monkeypatch.setattr(app.st, 'session_state', _EstadoSessao(fotos_info=[perdida, mantida]))
+    _envelhecer(os.path.dirname(perdida.caminho_foto), 2 * 3600)
+    armazem.limpar_sessoes_antigas(3600)
+
+    assert app.descartar_fotos_indisponiveis() == 1
+    assert app.st.session_state['fotos_info'] == [mantida]
+    assert app.descartar_fotos_indisponiveis() == 0
@@ -0,0 +1,98 @@
+"""
+Concorrência do ContadorRelatorios sobre o Drive local (drive_local.DriveLocal).
+
+Rodar da raiz do repositório:  python -m pytest -q tests
+"""
+import json
+import os
+import sys
+import threading
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from drive_local import DriveLocal  # noqa: E402
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    monkeypatch.setenv('RF_DADOS_DIR', str(tmp_path / 'dados'))
+    app.obter_cache_downloads_drive.clear()
+    yield DriveLocal(str(tmp_path / 'drive'), latencia=0.005, variacao_latencia=0.02, semente=7)
+    app.obter_cache_downloads_drive.clear()
+
+
+@pytest.fixture
+def pasta(drive, tmp_path):
+    """Pasta nova no Drive local com um arquivo de contadores vazio"""
+    folder_id = uuid.uuid4().hex
+    caminho = tmp_path / app.CONTADOR_FILENAME
+    caminho.write_text(json.dumps({}), encoding='utf-8')
+    drive.importar_arquivo(str(caminho), app.CONTADOR_FILENAME, folder_id)
+    return folder_id
+
+
+def _contador(drive, pasta, tamanho_bloco=2):
+    return app.ContadorRelatorios(service=drive, folder_id=pasta, tamanho_bloco=tamanho_bloco)
+
+
+def test_sessoes_concorrentes_nao_repetem_numeros(drive, pasta):
+    # Duas sessões por matrícula e blocos pequenos: várias reservas disputadas
+    matriculas = ['0101', '0101', '0202', '0202', '0303', '0404']
+    numeros, erros = [], []
+    largada = threading.Barrier(len(matriculas))
+
+    def sessao(matricula):
+        contador = _contador(drive, pasta)
+        largada.wait()
+        for _ in range(5):
+            try:
+                numeros.append(contador.gerar_novo_numero(matricula)[0])
+            except Exception as e:
+                erros.append(e)
+
+    threads = [threading.Thread(target=sessao, args=(m,)) for m in matriculas]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not erros
+    assert len(numeros) == 5 * len(matriculas)
+    assert len(set(numeros)) == len(numeros)
+
+
+def test_revisao_que_perdeu_a_disputa_e_ignorada(drive, pasta):
+    contador = _contador(drive, pasta)
+    assert contador.gerar_novo_numero('0101')[1] == 1
+
+    # Gravação concorrente que perdeu o compare-and-swap: base antiga e valor defasado
+    arquivo_id, contadores, _ = contador.carregar_contadores()
+    perdedora = {k: v for k, v in contadores.items() if k != app.DRIVE_CAMPO_CAS}
+    chave = next(iter(perdedora))
+    perdedora[chave] = 0
+    perdedora[app.DRIVE_CAMPO_CAS] = {'base': 'revisao-antiga', 'hash': contador._hash_dados(perdedora)}
+    contador._gravar(arquivo_id, perdedora)
+
+    _, contadores, _ = contador.carregar_contadores()
+    assert contadores[chave] == 2
+
+    outro = _contador(drive, pasta)
+    assert outro.gerar_novo_numero('0101')[1] == 3
+
+
+def test_sem_reserva_nenhum_numero_e_emitido(drive, pasta, monkeypatch):
+    contador = _contador(drive, pasta)
+
+    def falhar(chave):
+        raise RuntimeError("conflitos sucessivos")
+
+    monkeypatch.setattr(contador, '_reservar_bloco', falhar)
+    with pytest.raises(RuntimeError):
+        contador.gerar_novo_numero('0101')
+
+    with pytest.raises(RuntimeError):
+        app.ContadorRelatorios(service=None, folder_id=pasta).gerar_novo_numero('0101')
@@ -0,0 +1,57 @@
+"""
+Envio do relatório na hora do submit (enviar_relatorio) sobre o Drive local.
+
+Rodar da raiz do repositório:  python -m pytest -q tests
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from drive_local import DriveLocal  # noqa: E402
+
+
+@pytest.fixture
+def relatorio(tmp_path, monkeypatch):
+    monkeypatch.setenv('RF_DADOS_DIR', str(tmp_path / 'dados'))
+    monkeypatch.setattr(app, 'obter_evento_outbox', lambda: app.threading.Event())
+    numero = uuid.uuid4().hex[:12]
+    caminho_pdf = tmp_path / f"Relatorio_{numero}.pdf"
+    caminho_pdf.write_bytes(b'%PDF-1.4 teste')
+    return str(caminho_pdf), {'NUMERO_RELATORIO': numero, 'MUNICIPIO': 'Niterói'}
+
+
+def _item(numero):
+    return next(item for item in app.listar_itens_outbox() if item['numero_relatorio'] == numero)
+
+
+def test_fila_persistente_nao_espera_pelo_drive(tmp_path, relatorio):
+    drive = DriveLocal(str(tmp_path / 'drive'))
+    caminho_pdf, dados = relatorio
+
+    assert app.enviar_relatorio(drive, 'pasta', caminho_pdf, dados, '0101') is False
+    assert drive.chamadas == {}
+    assert _item(dados['NUMERO_RELATORIO'])['status'] == 'pendente'
+
+
+def test_fila_temporaria_tenta_uma_vez_sem_esperas(tmp_path, relatorio, monkeypatch):
+    monkeypatch.setattr(app, 'fila_local_persistente', lambda: False)
+    drive = DriveLocal(str(tmp_path / 'drive'), taxa_erro=1.0)
+    caminho_pdf, dados = relatorio
+
+    assert app.enviar_relatorio(drive, 'pasta', caminho_pdf, dados, '0101') is False
+    assert sum(drive.chamadas.values()) == 1
+    assert _item(dados['NUMERO_RELATORIO'])['status'] == 'erro'
+
+
+def test_fila_temporaria_envia_na_hora(tmp_path, relatorio, monkeypatch):
+    monkeypatch.setattr(app, 'fila_local_persistente', lambda: False)
+    drive = DriveLocal(str(tmp_path / 'drive'))
+    caminho_pdf, dados = relatorio
+
+    assert app.enviar_relatorio(drive, 'pasta', caminho_pdf, dados, '0101') is True
+    assert _item(dados['NUMERO_RELATORIO'])['status'] == 'sincronizado'
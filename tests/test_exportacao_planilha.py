@@ -0,0 +1,78 @@
+"""
+Exportação da Planilha Master direto do BancoRelatorios (leitura do cursor por lote).
+
+Rodar da raiz do repositório:  python -m pytest -q tests
+"""
+import os
+import sys
+import types
+
+import pytest
+from openpyxl import load_workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def banco(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'PLANILHA_EXPORTACAO_LOTE', 3)
+    banco = app.BancoRelatorios(str(tmp_path / 'relatorios.db'))
+    banco.salvar_varios([
+        {
+            'NUMERO_RELATORIO': f"2026010{n}", 'DATA_RELATORIO': f"0{n}/02/2026",
+            'AGENTE_NOME': 'Agente A' if n % 2 else 'Agente B', 'DATA_GERACAO': f"2026-02-0{n} 10:00",
+            'CONTRATADOS': [{'NOME_CONTRATANTE': f"Contratante {n}.{ordem}", 'ORDEM': ordem}
+                            for ordem in range(1, n % 3 + 1)],
+            **({'CAMPO_EXTRA': 'x'} if n == 7 else {})
+        }
+        for n in range(1, 8)
+    ])
+    return banco
+
+
+def _abas(caminho):
+    workbook = load_workbook(caminho)
+    return {aba.title: [list(linha) for linha in aba.iter_rows(values_only=True)] for aba in workbook.worksheets}
+
+
+def test_listar_le_o_cursor_sob_demanda(banco):
+    registros = banco.listar()
+    assert isinstance(registros, types.GeneratorType)
+    assert [r['NUMERO_RELATORIO'] for r in registros] == [f"2026010{n}" for n in range(1, 8)]
+    assert [r['NUMERO_RELATORIO'] for r in banco.listar(limite=2)] == ['20260106', '20260107']
+    assert banco.contar() == 7
+
+
+def test_exportacao_do_banco_igual_a_dos_dataframes(banco, tmp_path):
+    banco_xlsx = tmp_path / 'banco.xlsx'
+    dataframes_xlsx = tmp_path / 'dataframes.xlsx'
+    app.gravar_planilha_master_xlsx_do_banco(str(banco_xlsx), banco)
+    app.gravar_planilha_master_xlsx(str(dataframes_xlsx), banco.para_dataframe(), banco.contratados_dataframe())
+
+    abas = _abas(banco_xlsx)
+    assert abas == _abas(dataframes_xlsx)
+    assert abas[app.ABA_RELATORIOS][0][-1] == 'CAMPO_EXTRA'
+    assert len(abas[app.ABA_RELATORIOS]) == 1 + 7
+
+
+def test_exportacao_com_contratados_em_colunas(banco, tmp_path):
+    caminho = tmp_path / 'largo.xlsx'
+    app.gravar_planilha_master_xlsx_do_banco(str(caminho), banco, contratados_em_colunas=True)
+
+    abas = _abas(caminho)
+    assert list(abas) == [app.ABA_RELATORIOS]
+    cabecalho, *linhas = abas[app.ABA_RELATORIOS]
+    nome_1 = cabecalho.index('CONTRATADO_01_NOME_CONTRATANTE')
+    nome_2 = cabecalho.index('CONTRATADO_02_NOME_CONTRATANTE')
+    assert 'CONTRATADO_03_NOME_CONTRATANTE' not in cabecalho
+    por_numero = {linha[cabecalho.index('NUMERO_RELATORIO')]: linha for linha in linhas}
+    assert por_numero['20260105'][nome_1] == 'Contratante 5.1'
+    assert por_numero['20260105'][nome_2] == 'Contratante 5.2'
+    assert por_numero['20260104'][nome_2] is None
+    assert por_numero['20260103'][nome_1] is None
+
+
+def test_resumo(banco):
+    assert banco.resumo() == {'total': 7, 'ultima_geracao': '2026-02-07 10:00', 'agentes': 2}
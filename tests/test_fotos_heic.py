@@ -0,0 +1,55 @@
+"""
+Fotos HEIC (iPhone) e formatos que o PDF não embute.
+
+Rodar da raiz do repositório:  python -m pytest -q tests
+"""
+import os
+import sys
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def armazem(tmp_path, monkeypatch):
+    armazem = app.ArmazemFotos(str(tmp_path / 'fotos'), 1024 * 1024)
+    monkeypatch.setattr(app, 'obter_armazem_fotos', lambda: armazem)
+    return armazem
+
+
+def _foto(formato):
+    buffer = BytesIO()
+    Image.new('RGB', (64, 48), (200, 30, 30)).save(buffer, formato)
+    return buffer.getvalue()
+
+
+@pytest.mark.skipif(not app.HEIF_DISPONIVEL, reason="pillow-heif não instalado")
+def test_heic_vira_jpeg(armazem):
+    pytest.importorskip('pillow_heif')
+    heic = _foto('HEIF')
+    assert app.foto_heif(heic)
+
+    foto = app.FotoInfo(heic, sessao_id='sessao')
+    assert app.foto_embutivel_no_pdf(foto.image_bytes)
+    assert foto.get_image().format == 'JPEG'
+
+
+def test_heic_sem_decodificador_e_recusada(armazem, monkeypatch):
+    def sem_decodificador(image_bytes):
+        raise OSError("cannot identify image file")
+
+    monkeypatch.setattr(app, 'normalizar_foto', sem_decodificador)
+    heic = b'\x00\x00\x00\x18ftypheic' + b'\x00' * 32
+    with pytest.raises(ValueError, match="HEIC"):
+        app.FotoInfo(heic, sessao_id='sessao')
+
+    with pytest.raises(ValueError, match="não suportado"):
+        app.FotoInfo(b'GIF89a' + b'\x00' * 32, sessao_id='sessao')
+
+    png = _foto('PNG')
+    assert app.FotoInfo(png, sessao_id='sessao').image_bytes == png
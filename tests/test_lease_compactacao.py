@@ -0,0 +1,100 @@
+"""
+Exclusão mútua da compactação entre processos (LeaseCompactacao) sobre o Drive local.
+
+Rodar da raiz do repositório:  python -m pytest -q tests
+"""
+import os
+import sys
+import threading
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from drive_local import DriveLocal  # noqa: E402
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    monkeypatch.setenv('RF_DADOS_DIR', str(tmp_path / 'dados'))
+    app.obter_cache_downloads_drive.clear()
+    yield DriveLocal(str(tmp_path / 'drive'), latencia=0.005, variacao_latencia=0.02, semente=11)
+    app.obter_cache_downloads_drive.clear()
+
+
+@pytest.fixture
+def pasta():
+    return uuid.uuid4().hex
+
+
+def test_processos_concorrentes_so_um_obtem_o_lease(drive, pasta):
+    # Nenhum arquivo de lease ainda: a disputa inclui a criação do arquivo
+    leases = [app.LeaseCompactacao(drive, pasta) for _ in range(5)]
+    resultados = []
+    largada = threading.Barrier(len(leases))
+
+    def disputar(lease):
+        largada.wait()
+        resultados.append(lease.adquirir())
+
+    threads = [threading.Thread(target=disputar, args=(lease,)) for lease in leases]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert resultados.count(True) == 1
+    assert sum(lease.valido() for lease in leases) == 1
+
+
+def test_lease_liberado_pode_ser_obtido_por_outro(drive, pasta):
+    primeiro = app.LeaseCompactacao(drive, pasta)
+    segundo = app.LeaseCompactacao(drive, pasta)
+
+    assert primeiro.adquirir()
+    assert not segundo.adquirir()
+
+    primeiro.liberar()
+    assert not primeiro.valido()
+    assert segundo.adquirir()
+
+
+def test_lease_vencido_pode_ser_tomado(drive, pasta, monkeypatch):
+    abandonado = app.LeaseCompactacao(drive, pasta)
+    assert abandonado.adquirir()
+
+    # Processo que morreu sem liberar: o lease vence com a tolerância de relógio
+    agora = app.time.time()
+    atraso = app.COMPACTACAO_LEASE_DURACAO + app.COMPACTACAO_LEASE_TOLERANCIA_RELOGIO + 1
+    monkeypatch.setattr(app.time, 'time', lambda: agora + atraso)
+    assert app.LeaseCompactacao(drive, pasta).adquirir()
+
+
+def test_compactacao_sem_lease_nao_toca_o_journal(drive, pasta, monkeypatch):
+    assert app.LeaseCompactacao(drive, pasta).adquirir()
+
+    def nao_chamar(*args, **kwargs):
+        raise AssertionError("compactação sem lease")
+
+    monkeypatch.setattr(app, 'enviar_journal_pendente', nao_chamar)
+    monkeypatch.setattr(app, 'carregar_registros_journal_drive', nao_chamar)
+    assert app.compactar_journal_planilha_master(drive, pasta) == 0
+
+
+def test_falha_da_compactacao_fica_registrada(drive, pasta, monkeypatch):
+    def falhar(*args, **kwargs):
+        raise RuntimeError("cota excedida")
+
+    monkeypatch.setattr(app, 'carregar_registros_journal_drive', falhar)
+    falhas_antes = app.obter_metricas_drive().resumo()['operacoes'].get('compactacao', {}).get('falhas', 0)
+
+    assert app.compactar_journal_planilha_master(drive, pasta) is None
+
+    assert app.obter_metricas_drive().resumo()['operacoes']['compactacao']['falhas'] == falhas_antes + 1
+    if app.TELEMETRIA_ATIVA:
+        span = [e for e in app.obter_telemetria().recentes() if e['etapa'] == 'compactacao'][-1]
+        assert span['status'] == 'erro' and 'cota excedida' in span['erro']
+    # O lease foi devolvido: a próxima compactação pode rodar
+    assert app.LeaseCompactacao(drive, pasta).adquirir()